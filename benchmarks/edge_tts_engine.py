@@ -0,0 +1,71 @@
+"""Compare edge-tts time-to-first-audio: a new session per request vs the shared engine.
+
+Usage: python benchmarks/edge_tts_engine.py [--runs 20] [--concurrency 1] [--text "..."]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+# main.py refuses to import without these; the benchmark never uses them
+os.environ.setdefault("ENCRYPTION_SECRET_KEY", "benchmark")
+os.environ.setdefault("EMBEDDING_API_KEY", "benchmark")
+os.environ.setdefault("VOICE_CATALOGUE_REFRESH", "false")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import edge_tts  # noqa: E402
+import main  # noqa: E402
+
+async def per_request(text: str, voice: str):
+    return edge_tts.Communicate(text=text, voice=voice).stream()
+
+async def engine(text: str, voice: str):
+    return main.synthesis_engine.stream(text, voice)
+
+async def measure(make_stream, text: str, voice: str) -> tuple:
+    started = time.perf_counter()
+    first_audio = None
+    async for chunk in await make_stream(text, voice):
+        if first_audio is None and chunk["type"] == "audio":
+            first_audio = time.perf_counter() - started
+    return first_audio, time.perf_counter() - started
+
+async def run(name: str, make_stream, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one():
+        async with semaphore:
+            return await measure(make_stream, args.text, args.voice)
+
+    results = await asyncio.gather(*(one() for _ in range(args.runs)), return_exceptions=True)
+    timings = [result for result in results if not isinstance(result, BaseException)]
+    errors = len(results) - len(timings)
+    first = sorted(result[0] for result in timings if result[0] is not None)
+    total = sorted(result[1] for result in timings)
+
+    def p95(values):
+        return values[min(len(values) - 1, int(len(values) * 0.95))] * 1000 if values else float("nan")
+
+    print(
+        f"{name:<12} runs={len(timings):<4} errors={errors:<3} "
+        f"first audio p50={statistics.median(first) * 1000 if first else float('nan'):7.1f}ms p95={p95(first):7.1f}ms  "
+        f"total p50={statistics.median(total) * 1000 if total else float('nan'):7.1f}ms p95={p95(total):7.1f}ms"
+    )
+
+async def main_async(args):
+    await run("per-request", per_request, args)
+    if not args.cold:
+        await main.synthesis_engine.check()
+    await run("engine", engine, args)
+    await main.synthesis_engine.aclose()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--text", default="Hello, this is a short reply.")
+    parser.add_argument("--voice", default="en-HK-SamNeural")
+    parser.add_argument("--cold", action="store_true", help="skip the engine warm-up probe")
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,308 @@
+"""Offline load test: boots main.py against local upstream stubs and drives its endpoints.
+
+Reports per-endpoint p50/p95/p99 latency, time to first audio, requests per
+second and server memory. With --baseline, exits non-zero when p95 latency or
+throughput regressed by more than --tolerance compared to an earlier --output.
+
+Usage: python benchmarks/loadtest.py [--concurrency 10] [--requests 100]
+       [--scenarios synthesize,tts_stream,ws_synthesize,ws_tts]
+       [--output results.json] [--baseline results.json] [--env KEY=VALUE ...]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import aiohttp
+import httpx
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+import stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET_KEY = "loadtest-secret-key-0123456789ab"
+SCENARIOS = ("synthesize", "tts_stream", "ws_synthesize", "ws_tts")
+
+def make_auth_key(embedding_api_key: str, llm_api_key: str) -> str:
+    """Encrypt keys the way the PHP frontend does (AES-256-CBC, IV prepended)"""
+    iv = os.urandom(16)
+    padder = padding.PKCS7(128).padder()
+    payload = json.dumps({"embedding_api_key": embedding_api_key, "llm_api_key": llm_api_key}).encode()
+    padded = padder.update(payload) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(SECRET_KEY.encode()[:32]), modes.CBC(iv)).encryptor()
+    return base64.b64encode(iv + encryptor.update(padded) + encryptor.finalize()).decode()
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def rss_kb(pid: int) -> dict:
+    """Current and peak resident memory of a process (Linux only)"""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    memory[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return memory
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+class Scenario:
+    """Issues one kind of request; run() returns (seconds to first audio, total seconds)"""
+
+    def __init__(self, base_url: str, auth_key: str, repeat: bool):
+        self.base_url = base_url
+        self.ws_url = base_url.replace("http://", "ws://", 1)
+        self.auth_key = auth_key
+        # Without --repeat every request is unique, so no cache answers it
+        self.repeat = repeat
+        self.tag = uuid.uuid4().hex[:8]
+
+    def text(self, n: int) -> str:
+        suffix = "" if self.repeat else f" Request {self.tag}-{n}."
+        return "Thanks for calling. Your order has shipped and should arrive on Tuesday." + suffix
+
+    def rag_body(self, n: int) -> dict:
+        return {
+            "query": "How are uploads indexed?" if self.repeat else f"How are uploads indexed? ({self.tag}-{n})",
+            "user_hash": f"user{n % 8}",
+            "instruct": "Answer briefly.",
+            "auth_key": self.auth_key,
+            "collection_name": "loadtest",
+            "top_k": 5,
+            "provider": "z.ai",
+            "model": "glm-4.5-flash",
+            "voice": "en-HK-SamNeural"
+        }
+
+class Synthesize(Scenario):
+    async def run(self, n, client, session):
+        started = time.perf_counter()
+        first_audio = None
+        async with client.stream("POST", f"{self.base_url}/synthesize", json={"text": self.text(n)}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                if first_audio is None and chunk:
+                    first_audio = time.perf_counter() - started
+        return first_audio, time.perf_counter() - started
+
+class TTSStream(Scenario):
+    async def run(self, n, client, session):
+        started = time.perf_counter()
+        first_audio = None
+        async with client.stream("POST", f"{self.base_url}/tts/stream", json=self.rag_body(n)) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if first_audio is None and line == "event: audio":
+                    first_audio = time.perf_counter() - started
+                elif line == "event: error":
+                    raise RuntimeError("error event")
+        return first_audio, time.perf_counter() - started
+
+async def run_websocket(session, url: str, message: dict) -> tuple:
+    started = time.perf_counter()
+    first_audio = None
+    async with session.ws_connect(url) as websocket:
+        await websocket.send_json(dict(message, protocol="binary"))
+        async for received in websocket:
+            if received.type == aiohttp.WSMsgType.BINARY:
+                if first_audio is None:
+                    first_audio = time.perf_counter() - started
+            elif received.type == aiohttp.WSMsgType.TEXT:
+                data = json.loads(received.data)
+                if data.get("type") == "error":
+                    raise RuntimeError(data.get("message"))
+                if data.get("status") == "completed":
+                    break
+            else:
+                raise RuntimeError(f"WebSocket closed early ({received.type})")
+    return first_audio, time.perf_counter() - started
+
+class WSSynthesize(Scenario):
+    async def run(self, n, client, session):
+        return await run_websocket(session, f"{self.ws_url}/ws/synthesize", {"text": self.text(n)})
+
+class WSTTS(Scenario):
+    async def run(self, n, client, session):
+        return await run_websocket(session, f"{self.ws_url}/ws/tts", self.rag_body(n))
+
+SCENARIO_CLASSES = {
+    "synthesize": Synthesize,
+    "tts_stream": TTSStream,
+    "ws_synthesize": WSSynthesize,
+    "ws_tts": WSTTS,
+}
+
+async def run_scenario(scenario: Scenario, args, server_pid: int) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, first_audio, errors = [], [], {}
+    peak_rss = 0
+
+    async def one(n, client, session):
+        async with semaphore:
+            try:
+                first, total = await scenario.run(n, client, session)
+            except Exception as e:
+                name = type(e).__name__
+                errors[name] = errors.get(name, 0) + 1
+                return
+            latencies.append(total)
+            if first is not None:
+                first_audio.append(first)
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_kb(server_pid).get("VmRSS", 0))
+            await asyncio.sleep(0.1)
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client, aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=args.timeout)
+    ) as session:
+        sampler = asyncio.create_task(sample_memory())
+        started = time.perf_counter()
+        await asyncio.gather(*(one(n, client, session) for n in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "requests": args.requests,
+        "ok": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "first_audio_p50_ms": ms(percentile(first_audio, 0.50)),
+        "first_audio_p95_ms": ms(percentile(first_audio, 0.95)),
+        "peak_rss_mb": round(peak_rss / 1024, 1) if peak_rss else None,
+    }
+
+def start_server(port: int, upstreams: dict, extra_env: dict) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "ENCRYPTION_SECRET_KEY": SECRET_KEY,
+        "EMBEDDING_API_KEY": "loadtest",
+        "VOICE_CATALOGUE_REFRESH": "false",
+        "TRACE_LOG_ENABLED": "false",
+        # Only the stubbed provider is reachable
+        "LLM_FALLBACK_MODELS": "",
+        "MISTRAL_API_KEY": "",
+        "GOOGLE_API_KEY": "",
+        "ZAI_API_KEY": "",
+    })
+    env.update(upstreams)
+    env.update(extra_env)
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env
+    )
+
+async def wait_until_healthy(base_url: str, server: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"Server exited with code {server.returncode}")
+            try:
+                if (await client.get(f"{base_url}/health")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not become healthy in time")
+
+def print_report(results: dict):
+    columns = ("ok", "rps", "p50_ms", "p95_ms", "p99_ms", "first_audio_p50_ms", "first_audio_p95_ms", "peak_rss_mb")
+    print(f"{'scenario':<14}" + "".join(f"{column:>20}" for column in columns) + "  errors")
+    for name, result in results.items():
+        cells = "".join(f"{'-' if result[column] is None else result[column]:>20}" for column in columns)
+        print(f"{name:<14}{cells}  {result['errors'] or ''}")
+
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for metric in ("p95_ms", "first_audio_p95_ms"):
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {before[metric]} -> {result[metric]}")
+        if before.get("rps") and result.get("rps") is not None and result["rps"] < before["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {before['rps']} -> {result['rps']}")
+        if result["ok"] < result["requests"] and before.get("ok") == before.get("requests"):
+            regressions.append(f"{name}: {result['requests'] - result['ok']} failed requests")
+    return regressions
+
+async def main_async(args) -> int:
+    runner, stub_url = await stubs.start(stubs.config_from_args(args))
+    extra_env = dict(item.split("=", 1) for item in args.env)
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = start_server(port, stubs.upstream_env(stub_url), extra_env)
+    try:
+        await wait_until_healthy(base_url, server)
+        auth_key = make_auth_key("loadtest", "loadtest")
+        results = {}
+        for name in args.scenarios.split(","):
+            scenario = SCENARIO_CLASSES[name.strip()](base_url, auth_key, args.repeat)
+            results[name.strip()] = await run_scenario(scenario, args, server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        await runner.cleanup()
+
+    print_report(results)
+    report = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "stubs": vars(stubs.config_from_args(args)),
+        "env": extra_env,
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=100, help="per scenario")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--repeat", action="store_true", help="send identical requests so caches can answer them")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server configuration")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    stubs.add_arguments(parser)
+    sys.exit(asyncio.run(main_async(parser.parse_args())))
@@ -0,0 +1,171 @@
+"""Local stand-ins for the upstreams main.py talks to, with configurable latency.
+
+- POST /search                          embedding search (EMBEDDING_API_URL)
+- POST /api/paas/v4/chat/completions    OpenAI-style chat, streamed or not (ZAI_API_URL)
+- GET  /edge/v1                         edge-tts synthesis WebSocket (EDGE_TTS_WSS_URL)
+
+Usage: python benchmarks/stubs.py [--port 9100] [--search-latency 0.05] ...
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import dataclass
+
+from aiohttp import WSMsgType, web
+
+ANSWER = (
+    "Based on the documents, the service stores uploads per user and indexes them for search. "
+    "Each answer is generated from the most relevant passages and read out loud. "
+    "Longer documents are split into chunks so that every part can be found. "
+    "If nothing relevant is found, the assistant says so instead of guessing."
+)
+
+@dataclass
+class StubConfig:
+    search_latency: float = 0.05
+    llm_first_token_latency: float = 0.3
+    llm_token_interval: float = 0.02
+    tts_first_audio_latency: float = 0.15
+    tts_chunk_interval: float = 0.0
+    # Seconds of +/- uniform jitter applied to every latency above
+    jitter: float = 0.0
+    # edge-tts sends ~48 kbps MP3; at ~15 spoken characters per second that
+    # is about 400 bytes of audio per character of text
+    audio_bytes_per_char: int = 400
+    audio_chunk_size: int = 4096
+
+    def delay(self, seconds: float) -> float:
+        if self.jitter:
+            seconds += random.uniform(-self.jitter, self.jitter)
+        return max(0.0, seconds)
+
+async def search(request: web.Request) -> web.Response:
+    config: StubConfig = request.app["config"]
+    body = await request.json()
+    await asyncio.sleep(config.delay(config.search_latency))
+    results = [
+        {
+            "score": 0.9 - rank * 0.05,
+            "text": f"Passage {rank} about {body.get('query', '')}. " + ANSWER,
+            "metadata": {"url": f"https://example.com/{body.get('collection_name', 'docs')}/{rank}.pdf"}
+        }
+        for rank in range(int(body.get("top_k", 5)))
+    ]
+    return web.json_response({"results": results})
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    config: StubConfig = request.app["config"]
+    body = await request.json()
+    await asyncio.sleep(config.delay(config.llm_first_token_latency))
+    if not body.get("stream"):
+        return web.json_response({"choices": [{"message": {"role": "assistant", "content": ANSWER}}]})
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for token in re.findall(r"\S+\s*", ANSWER):
+        chunk = {"choices": [{"delta": {"content": token}}]}
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        if config.llm_token_interval:
+            await asyncio.sleep(config.delay(config.llm_token_interval))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+async def warm(request: web.Request) -> web.Response:
+    return web.Response()
+
+def _text_message(request_id: str, path: str, body: str) -> str:
+    return f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\nPath:{path}\r\n\r\n{body}"
+
+def _audio_message(request_id: str, data: bytes) -> bytes:
+    # edge-tts reads a 2-byte length, then parses that many bytes (length
+    # prefix included) as headers, skips \r\n and takes the rest as audio
+    headers = f"X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\nPath:audio".encode()
+    return (len(headers) + 2).to_bytes(2, "big") + headers + b"\r\n" + data
+
+async def edge_tts_socket(request: web.Request) -> web.WebSocketResponse:
+    config: StubConfig = request.app["config"]
+    websocket = web.WebSocketResponse()
+    await websocket.prepare(request)
+    async for message in websocket:
+        if message.type != WSMsgType.TEXT or "Path:ssml" not in message.data:
+            continue
+        started = time.perf_counter()
+        request_id = uuid.uuid4().hex
+        ssml = message.data.split("\r\n\r\n", 1)[-1]
+        text = re.sub(r"<[^>]+>", "", ssml).strip()
+        await websocket.send_str(_text_message(request_id, "turn.start", "{}"))
+        await asyncio.sleep(max(0.0, config.delay(config.tts_first_audio_latency) - (time.perf_counter() - started)))
+        remaining = max(1, len(text)) * config.audio_bytes_per_char
+        while remaining > 0:
+            size = min(remaining, config.audio_chunk_size)
+            await websocket.send_bytes(_audio_message(request_id, b"\xff" * size))
+            remaining -= size
+            if remaining and config.tts_chunk_interval:
+                await asyncio.sleep(config.delay(config.tts_chunk_interval))
+        await websocket.send_str(_text_message(request_id, "turn.end", "{}"))
+    return websocket
+
+def create_app(config: StubConfig) -> web.Application:
+    app = web.Application()
+    app["config"] = config
+    app.router.add_post("/search", search)
+    app.router.add_post("/api/paas/v4/chat/completions", chat_completions)
+    app.router.add_get("/edge/v1", edge_tts_socket)
+    app.router.add_route("HEAD", "/", warm)
+    return app
+
+async def start(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> tuple:
+    """Serve the stubs in the running loop; returns (runner, base URL)"""
+    runner = web.AppRunner(create_app(config), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+def upstream_env(base_url: str) -> dict:
+    """Environment that points main.py at stubs served from base_url"""
+    return {
+        "EMBEDDING_API_URL": base_url,
+        "ZAI_API_URL": f"{base_url}/api/paas/v4/chat/completions",
+        "EDGE_TTS_WSS_URL": base_url.replace("http://", "ws://", 1) + "/edge/v1?TrustedClientToken=stub",
+    }
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = StubConfig()
+    for field in ("search_latency", "llm_first_token_latency", "llm_token_interval",
+                  "tts_first_audio_latency", "tts_chunk_interval", "jitter"):
+        parser.add_argument(f"--{field.replace('_', '-')}", type=float, default=getattr(defaults, field))
+    parser.add_argument("--audio-bytes-per-char", type=int, default=defaults.audio_bytes_per_char)
+
+def config_from_args(args) -> StubConfig:
+    return StubConfig(
+        search_latency=args.search_latency,
+        llm_first_token_latency=args.llm_first_token_latency,
+        llm_token_interval=args.llm_token_interval,
+        tts_first_audio_latency=args.tts_first_audio_latency,
+        tts_chunk_interval=args.tts_chunk_interval,
+        jitter=args.jitter,
+        audio_bytes_per_char=args.audio_bytes_per_char
+    )
+
+async def serve_forever(args):
+    runner, base_url = await start(config_from_args(args), args.host, args.port)
+    for key, value in upstream_env(base_url).items():
+        print(f"{key}={value}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    asyncio.run(serve_forever(parser.parse_args()))
@@ -54,6 +54,89 @@ function getApiKey() {
     return $api_key;
 }
 
+/**
+ * Get the TTS backend (FastAPI) URL from global_setting table
+ */
+function getTtsApiUrl() {
+    $conn = getDBConnection();
+    if (!$conn) {
+        return null;
+    }
+
+    $stmt = $conn->prepare("SELECT api_url FROM global_setting WHERE id = 1");
+    $stmt->execute();
+    $result = $stmt->get_result();
+    $api_url = null;
+
+    if ($row = $result->fetch_assoc()) {
+        $api_url = $row['api_url'];
+    }
+
+    $stmt->close();
+    closeDBConnection($conn);
+
+    return $api_url;
+}
+
+/**
+ * Tell the TTS backend to drop cached search results for a collection
+ * so new or deleted documents show up in answers right away
+ *
+ * @param string $user_hash User's unique hash
+ * @param string $collection_name Qdrant collection name
+ * @return array ['success' => bool, 'error' => string|null]
+ */
+function invalidateSearchCache($user_hash, $collection_name) {
+    $api_url = getTtsApiUrl();
+    // Same embedding API key the backend has as EMBEDDING_API_KEY
+    $api_key = getApiKey();
+    if (empty($api_url) || empty($api_key)) {
+        return [
+            'success' => false,
+            'error' => 'TTS API URL or API key not found in database'
+        ];
+    }
+
+    $payload = [
+        'api_key' => $api_key,
+        'user_hash' => $user_hash,
+        'collection_name' => $collection_name
+    ];
+
+    $ch = curl_init(rtrim($api_url, '/') . '/cache/invalidate');
+    curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
+    curl_setopt($ch, CURLOPT_POST, true);
+    curl_setopt($ch, CURLOPT_POSTFIELDS, json_encode($payload));
+    curl_setopt($ch, CURLOPT_HTTPHEADER, [
+        'Content-Type: application/json'
+    ]);
+    curl_setopt($ch, CURLOPT_TIMEOUT, 5); // Best effort, never block the upload
+
+    $response = curl_exec($ch);
+    $http_code = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+    $curl_error = curl_error($ch);
+    curl_close($ch);
+
+    if ($curl_error) {
+        return [
+            'success' => false,
+            'error' => 'cURL error: ' . $curl_error
+        ];
+    }
+
+    if ($http_code !== 200) {
+        return [
+            'success' => false,
+            'error' => 'API returned HTTP ' . $http_code . ': ' . $response
+        ];
+    }
+
+    return [
+        'success' => true,
+        'error' => null
+    ];
+}
+
 /**
  * Call the embedding API to create embeddings for uploaded document
  *
@@ -373,6 +373,18 @@ class TranscriptionService {
     }
 }
 
+/**
+ * Decode a base64 string into bytes
+ */
+function base64ToBytes(base64) {
+    const binaryString = atob(base64);
+    const bytes = new Uint8Array(binaryString.length);
+    for (let i = 0; i < binaryString.length; i++) {
+        bytes[i] = binaryString.charCodeAt(i);
+    }
+    return bytes;
+}
+
 /**
  * APIService - Handles WebSocket communication with backend
  */
@@ -394,6 +406,8 @@ class APIService {
                 console.log('Connecting to WebSocket:', wsUrl);
 
                 this.ws = new WebSocket(wsUrl);
+                // Audio arrives as raw binary frames when the server supports it
+                this.ws.binaryType = 'arraybuffer';
 
                 let audioChunksData = [];
                 let aiResponseText = '';
@@ -422,7 +436,8 @@ class APIService {
                         collection_name: this.config.collectionName,
                         top_k: 5,
                         provider: this.config.provider,
-                        model: this.config.model
+                        model: this.config.model,
+                        protocol: 'binary'
                     };
 
                     console.log('Sending request:', requestData);
@@ -431,6 +446,13 @@ class APIService {
 
                 this.ws.onmessage = async (event) => {
                     try {
+                        if (event.data instanceof ArrayBuffer) {
+                            // Binary protocol: the frame is a raw MP3 chunk
+                            audioChunksData.push(new Uint8Array(event.data));
+                            this.callbacks.onAudioChunk(audioChunksData);
+                            return;
+                        }
+
                         const data = JSON.parse(event.data);
                         console.log('Received message type:', data.type, data);
 
@@ -448,8 +470,9 @@ class APIService {
                             console.log('AI response chunk received, total length:', aiResponseText.length);
                             this.callbacks.onAIResponse(aiResponseText);
                         } else if (data.type === 'audio') {
+                            // JSON protocol (older servers): base64 encoded chunk
                             console.log('Audio chunk received, size:', data.data.length);
-                            audioChunksData.push(data.data);
+                            audioChunksData.push(base64ToBytes(data.data));
                             this.callbacks.onAudioChunk(audioChunksData);
                         } else if (data.type === 'word_boundary') {
                             console.log('Word boundary:', data.text);
@@ -543,14 +566,7 @@ class AudioPlayer {
                     URL.revokeObjectURL(oldUrl);
                 }
 
-                const concatenatedBase64 = this.audioChunksData.join('');
-                const binaryString = atob(concatenatedBase64);
-                const bytes = new Uint8Array(binaryString.length);
-                for (let i = 0; i < binaryString.length; i++) {
-                    bytes[i] = binaryString.charCodeAt(i);
-                }
-
-                const audioBlob = new Blob([bytes], { type: 'audio/mpeg' });
+                const audioBlob = new Blob(this.audioChunksData, { type: 'audio/mpeg' });
                 const audioUrl = URL.createObjectURL(audioBlob);
 
                 this.currentAudio = new Audio(audioUrl);
@@ -1,22 +1,63 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from starlette.routing import Match
+from pydantic import BaseModel, field_validator
 import edge_tts
+import aiohttp
 import asyncio
 import os
 import uuid
-from typing import Optional, Dict
+from typing import AsyncIterator, Optional, Dict, List
 import uvicorn
 import httpx
 from mistralai import Mistral
 from google import genai
 import json
 import base64
+import re
+import gzip
+import io
+import zipfile
+import hashlib
+import mmap
+import heapq
+import hmac
+import shutil
+import time
+import bisect
+import math
+import random
+import sqlite3
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
-app = FastAPI(title="EdgeTTS API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create shared resources on startup and release them on shutdown"""
+    audio_store.reconcile()
+    background_tasks = [asyncio.create_task(audio_store.run_janitor())]
+    if VOICE_CATALOGUE_REFRESH:
+        background_tasks.append(asyncio.create_task(voice_catalogue.run_refresher()))
+    if EDGE_TTS_HEALTH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(synthesis_engine.run_health_checks()))
+    if shared_state is not None:
+        background_tasks.append(asyncio.create_task(shared_state.run_sync(invalidate_cached_collection)))
+        if METRICS_ENABLED:
+            background_tasks.append(asyncio.create_task(shared_state.run_metrics_publisher(metrics.collect)))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await llm_clients.aclose()
+    await http_clients.aclose()
+    await synthesis_engine.aclose()
+
+app = FastAPI(title="EdgeTTS API", version="1.0.0", lifespan=lifespan)
 
 # CORS Configuration
 # Load allowed origins from environment variable
@@ -33,8 +74,227 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Audio-URL", "X-Trace-Id"],
 )
 
+# Metrics configuration
+# Prometheus text-format metrics served at /metrics. Pipeline stage timings
+# are labelled with the endpoint that triggered them via a context variable.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+current_endpoint: ContextVar[str] = ContextVar("current_endpoint", default="")
+
+class Metric:
+    """A metric family holding one value per label combination"""
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[tuple, float] = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> List[tuple]:
+        """(name suffix, labels, value) of every sample"""
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            # One count per bucket plus +Inf, then the sum of observed values
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for key, counts in self.values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append(("_bucket", dict(labels, le=str(bound)), cumulative))
+            samples.append(("_sum", labels, counts[-1]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+class MetricsRegistry:
+    """Metrics owned by this process plus collectors that read live stats"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors = []
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self) -> List[tuple]:
+        """(name, type, help, samples) of every metric family"""
+        families = [(metric.name, metric.type, metric.help, metric.samples()) for metric in self.metrics]
+        for collector in self.collectors:
+            families.extend(collector())
+        return families
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def render_metrics(families: List[tuple]) -> str:
+    """Prometheus text exposition format"""
+    lines = []
+    for name, metric_type, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape_label(item)}"' for key, item in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {float(value)!r}" if label_text else f"{name}{suffix} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+requests_total = metrics.add(Counter("tts_requests_total", "Requests handled", ("endpoint", "method", "status")))
+requests_in_flight = metrics.add(Gauge("tts_requests_in_flight", "Requests currently being handled", ("endpoint",)))
+request_seconds = metrics.add(Histogram("tts_request_seconds", "Time until the response (or WebSocket session) finished", ("endpoint",)))
+response_bytes_total = metrics.add(Counter("tts_response_bytes_total", "Bytes sent to clients", ("endpoint",)))
+search_seconds = metrics.add(Histogram("tts_search_seconds", "Embedding search latency", ("endpoint",)))
+llm_first_token_seconds = metrics.add(Histogram("tts_llm_first_token_seconds", "LLM time to first token", ("endpoint", "provider", "model")))
+llm_seconds = metrics.add(Histogram("tts_llm_seconds", "LLM total generation time", ("endpoint", "provider", "model")))
+tts_first_audio_seconds = metrics.add(Histogram("tts_synthesis_first_audio_seconds", "edge-tts time to first audio chunk", ("endpoint",)))
+tts_seconds = metrics.add(Histogram("tts_synthesis_seconds", "edge-tts total synthesis time", ("endpoint",)))
+
+def route_template(scope) -> str:
+    """Path template of the route a request matches (keeps label cardinality low)"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests, in-flight requests and bytes sent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+
+        endpoint = route_template(scope)
+        method = scope.get("method", "WS")
+        token = current_endpoint.set(endpoint)
+        state = {"status": 500 if scope["type"] == "http" else 403}
+        started = time.perf_counter()
+        requests_in_flight.inc(endpoint=endpoint)
+
+        async def send_and_count(message):
+            message_type = message["type"]
+            if message_type == "http.response.start":
+                state["status"] = message["status"]
+            elif message_type == "http.response.body":
+                response_bytes_total.inc(len(message.get("body", b"")), endpoint=endpoint)
+            elif message_type == "websocket.accept":
+                state["status"] = 101
+            elif message_type == "websocket.send":
+                sent = message.get("bytes")
+                if sent is None:
+                    sent = (message.get("text") or "").encode("utf-8")
+                response_bytes_total.inc(len(sent), endpoint=endpoint)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_count)
+        finally:
+            requests_in_flight.dec(endpoint=endpoint)
+            requests_total.inc(endpoint=endpoint, method=method, status=state["status"])
+            request_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+            current_endpoint.reset(token)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# Tracing configuration
+# Every RAG request gets a trace id and timing marks (milliseconds since the
+# request started) that are logged as one JSON line when it finishes.
+TRACE_LOG_ENABLED = os.getenv("TRACE_LOG_ENABLED", "true").lower() == "true"
+_TRACE_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+class Trace:
+    """Trace id and stage timing marks of one request"""
+
+    def __init__(self, trace_id: Optional[str] = None, **attributes):
+        # Reuse a caller supplied id so browser and server logs line up
+        self.trace_id = trace_id if trace_id and _TRACE_ID.match(trace_id) else uuid.uuid4().hex
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.stages: Dict[str, dict] = {}
+
+    def mark(self, name: str):
+        """Record when a stage was reached (only the first time counts)"""
+        if name not in self.spans:
+            self.spans[name] = round((time.perf_counter() - self.started) * 1000, 1)
+
+    def stage(self, name: str, started: float):
+        """Record the start and end (now) of a pipeline stage begun at perf_counter() == started"""
+        self.stages[name] = {
+            "start": round((started - self.started) * 1000, 1),
+            "end": round((time.perf_counter() - self.started) * 1000, 1),
+        }
+
+    def timing(self) -> dict:
+        return {"trace_id": self.trace_id, "spans": dict(self.spans), "stages": dict(self.stages)}
+
+    def finish(self, status: str = "ok", error: Optional[str] = None):
+        """Write the trace as a structured JSON log line"""
+        if not TRACE_LOG_ENABLED:
+            return
+        record = {
+            "event": "trace",
+            "trace_id": self.trace_id,
+            "endpoint": current_endpoint.get(),
+            "status": status,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "spans": self.spans,
+            "stages": self.stages,
+            **self.attributes
+        }
+        if error:
+            record["error"] = error
+        print(json.dumps(record, ensure_ascii=False))
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+def trace_mark(name: str):
+    """Mark a stage on the trace of the request being handled, if any"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.mark(name)
+
 # Create temp directory for audio files
 TEMP_DIR = "/tmp/tts_audio"
 os.makedirs(TEMP_DIR, exist_ok=True)
@@ -52,6 +312,58 @@ if not EMBEDDING_API_KEY:
     raise ValueError("EMBEDDING_API_KEY environment variable is required")
 EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "https://embedding.2ai.dev")
 
+# Decrypted auth_key cache configuration
+# The frontend sends the same encrypted blob for hours, so parsed keys are
+# cached (in memory only) under a hash of the ciphertext.
+AUTH_KEY_CACHE_SIZE = int(os.getenv("AUTH_KEY_CACHE_SIZE", "1024"))
+AUTH_KEY_CACHE_TTL = float(os.getenv("AUTH_KEY_CACHE_TTL", "3600"))
+
+class AuthKeyCache:
+    """Bounded TTL cache of decrypted auth keys (never logged or exposed)"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(encrypted_data: str) -> str:
+        return hashlib.sha256(encrypted_data.encode("utf-8")).hexdigest()
+
+    def get(self, encrypted_data: str) -> Optional[Dict[str, str]]:
+        key = self._key(encrypted_data)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, encrypted_data: str, keys_dict: Dict[str, str]):
+        if self.max_size <= 0:
+            return
+        self.entries[self._key(encrypted_data)] = (time.monotonic() + self.ttl, keys_dict)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+auth_key_cache = AuthKeyCache(AUTH_KEY_CACHE_SIZE, AUTH_KEY_CACHE_TTL)
+
 # Helper function to decrypt auth_key
 def decrypt_auth_key(encrypted_data: str) -> Dict[str, str]:
     """
@@ -63,6 +375,11 @@ def decrypt_auth_key(encrypted_data: str) -> Dict[str, str]:
     Returns:
         Dictionary with 'embedding_api_key' and 'llm_api_key'
     """
+    if isinstance(encrypted_data, str):
+        cached = auth_key_cache.get(encrypted_data)
+        if cached is not None:
+            return cached
+
     try:
         # Decode base64
         encrypted_bytes = base64.b64decode(encrypted_data)
@@ -94,6 +411,7 @@ def decrypt_auth_key(encrypted_data: str) -> Dict[str, str]:
         if 'embedding_api_key' not in keys_dict or 'llm_api_key' not in keys_dict:
             raise ValueError("Invalid auth_key format: missing required keys")
 
+        auth_key_cache.put(encrypted_data, keys_dict)
         return keys_dict
 
     except Exception as e:
@@ -105,16 +423,734 @@ def decrypt_auth_key(encrypted_data: str) -> Dict[str, str]:
             detail=f"Failed to decrypt auth_key: {str(e)}"
         )
 
-# Background task to delete file after delay
-async def delete_file_after_delay(filepath: str, delay_seconds: int = 600):
-    """Delete file after specified delay (default 10 minutes = 600 seconds)"""
-    await asyncio.sleep(delay_seconds)
+# Multi-worker configuration
+# With more than one worker process, the audio index, reader bookkeeping and
+# cache invalidations live in a SQLite file that every worker opens.
+WORKERS = int(os.getenv("WORKERS", "1"))
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB", "/tmp/tts_state.db" if WORKERS > 1 else "")
+# How often workers pick up cache invalidations published by other workers
+SHARED_STATE_POLL_INTERVAL = float(os.getenv("SHARED_STATE_POLL_INTERVAL", "0.5"))
+
+class SharedState:
+    """
+    SQLite database shared by all worker processes.
+
+    The connection is opened lazily per process so that forked workers
+    never reuse their parent's handle.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS audio_files (
+            filename TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS audio_files_expires_at ON audio_files (expires_at);
+        CREATE TABLE IF NOT EXISTS audio_readers (
+            id INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL,
+            started REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS audio_readers_filename ON audio_readers (filename);
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            collection_name TEXT NOT NULL,
+            user_hash TEXT,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            job_id TEXT PRIMARY KEY,
+            created REAL NOT NULL,
+            job TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS metrics_snapshots (
+            pid INTEGER PRIMARY KEY,
+            updated REAL NOT NULL,
+            families TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None
+        self._pid = None
+        self._executor = None
+        self._executor_db = None
+        self._executor_pid = None
+        self.last_invalidation = 0
+        self.published = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(self.SCHEMA)
+        return db
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            db = self._connect()
+            self._db, self._pid = db, os.getpid()
+            # Only invalidations published after this worker started matter
+            self.last_invalidation = db.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations").fetchone()[0]
+        return self._db
+
+    async def run(self, query, *args):
+        """
+        Call query(db, *args) on the state's own thread and connection.
+
+        Used on request paths, where waiting for another worker's lock
+        must not stall the event loop.
+        """
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+            self._executor_db, self._executor_pid = None, os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._run, query, args)
+
+    def _run(self, query, args: tuple):
+        if self._executor_db is None:
+            self._executor_db = self._connect()
+        return query(self._executor_db, *args)
+
+    @contextmanager
+    def transaction(self):
+        """Write transaction that holds the database lock from the start"""
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def publish_invalidation(self, collection_name: str, user_hash: Optional[str] = None):
+        """Tell the other workers to drop cached results for a collection"""
+        cursor = self.db.execute(
+            "INSERT INTO cache_invalidations (collection_name, user_hash, created) VALUES (?, ?, ?)",
+            (collection_name, user_hash, time.time())
+        )
+        self.published.add(cursor.lastrowid)
+
+    def poll_invalidations(self) -> List[tuple]:
+        """(collection_name, user_hash) invalidations published by other workers since the last poll"""
+        rows = self.db.execute(
+            "SELECT id, collection_name, user_hash FROM cache_invalidations WHERE id > ? ORDER BY id",
+            (self.last_invalidation,)
+        ).fetchall()
+        invalidations = []
+        for row_id, collection_name, user_hash in rows:
+            self.last_invalidation = row_id
+            if row_id in self.published:
+                self.published.discard(row_id)
+            else:
+                invalidations.append((collection_name, user_hash))
+        return invalidations
+
+    async def run_sync(self, apply, interval: float = SHARED_STATE_POLL_INTERVAL):
+        """Periodically apply invalidations published by other workers"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for collection_name, user_hash in self.poll_invalidations():
+                    apply(collection_name, user_hash)
+                # Drop the log once every worker has had ample time to see it
+                self.db.execute("DELETE FROM cache_invalidations WHERE created < ?", (time.time() - 3600,))
+            except Exception as e:
+                print(f"Shared state sync error: {e}")
+
+    def publish_metrics(self, families: List[tuple]):
+        """Store this worker's current metrics for /metrics on any worker"""
+        self.db.execute(
+            "INSERT OR REPLACE INTO metrics_snapshots (pid, updated, families) VALUES (?, ?, ?)",
+            (os.getpid(), time.time(), json.dumps(families))
+        )
+
+    def save_batch_job(self, job: dict):
+        self.db.execute(
+            "INSERT OR REPLACE INTO batch_jobs (job_id, created, job) VALUES (?, ?, ?)",
+            (job["job_id"], job["created"], json.dumps(job))
+        )
+
+    def load_batch_job(self, job_id: str) -> Optional[dict]:
+        row = self.db.execute("SELECT job FROM batch_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def prune_batch_jobs(self, created_before: float):
+        self.db.execute("DELETE FROM batch_jobs WHERE created < ?", (created_before,))
+
+    def collect_metrics(self, max_age: float = 60.0) -> List[tuple]:
+        """(pid, families) of every worker that published recently"""
+        rows = self.db.execute(
+            "SELECT pid, families FROM metrics_snapshots WHERE updated > ? ORDER BY pid",
+            (time.time() - max_age,)
+        ).fetchall()
+        return [(pid, json.loads(families)) for pid, families in rows]
+
+    async def run_metrics_publisher(self, collect, interval: float = 5.0):
+        """Periodically publish this worker's metrics"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.publish_metrics(collect())
+            except Exception as e:
+                print(f"Metrics publish error: {e}")
+
+shared_state = SharedState(SHARED_STATE_DB) if SHARED_STATE_DB else None
+
+# Audio store configuration
+# Generated files are kept for AUDIO_TTL_SECONDS and removed by one periodic
+# janitor instead of a sleeping task per file.
+AUDIO_TTL_SECONDS = int(os.getenv("AUDIO_TTL_SECONDS", "600"))
+AUDIO_JANITOR_INTERVAL = int(os.getenv("AUDIO_JANITOR_INTERVAL", "30"))
+AUDIO_STORE_MAX_BYTES = int(os.getenv("AUDIO_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Readers older than this are assumed to have been abandoned by the client
+AUDIO_READER_TIMEOUT = int(os.getenv("AUDIO_READER_TIMEOUT", "300"))
+# Where audio bytes live: "disk" (TEMP_DIR), "memory" or "mmap"
+AUDIO_STORE_BACKEND = os.getenv("AUDIO_STORE_BACKEND", "disk").lower()
+# Backing file of the "mmap" backend (sized to AUDIO_STORE_MAX_BYTES)
+AUDIO_MMAP_PATH = os.getenv("AUDIO_MMAP_PATH", "/tmp/tts_audio.segment")
+
+class AudioBackend:
+    """
+    Storage for generated audio bytes.
+
+    write() returns the names of any entries the backend had to drop to make
+    room, so the AudioStore index can forget them.
+    """
+    # Whether calls touch the filesystem and should run in a worker thread
+    blocking = False
+
+    def write(self, filename: str, audio: bytes) -> List[str]:
+        raise NotImplementedError
+
+    def read(self, filename: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        """Return bytes [start, end) of a stored entry"""
+        raise NotImplementedError
+
+    def size(self, filename: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def delete(self, filename: str):
+        raise NotImplementedError
+
+    def entries(self) -> List[tuple]:
+        """(filename, size, mtime) of everything currently stored"""
+        raise NotImplementedError
+
+class DiskAudioBackend(AudioBackend):
+    """One file per entry in a directory (survives restarts)"""
+    blocking = True
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def write(self, filename, audio):
+        with open(self._path(filename), "wb") as audio_file:
+            audio_file.write(audio)
+        return []
+
+    def read(self, filename, start=0, end=None):
+        with open(self._path(filename), "rb") as audio_file:
+            audio_file.seek(start)
+            return audio_file.read() if end is None else audio_file.read(end - start)
+
+    def size(self, filename):
+        try:
+            return os.path.getsize(self._path(filename))
+        except OSError:
+            return None
+
+    def delete(self, filename):
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            try:
+                stat = os.stat(self._path(filename))
+            except OSError:
+                continue
+            if os.path.isfile(self._path(filename)):
+                entries.append((filename, stat.st_size, stat.st_mtime))
+        return entries
+
+class MemoryAudioBackend(AudioBackend):
+    """Bounded in-process LRU of audio bytes (no disk round trip)"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.data: "OrderedDict[str, tuple]" = OrderedDict()  # filename -> (bytes, mtime)
+        self.total_bytes = 0
+
+    def write(self, filename, audio):
+        self.delete(filename)
+        self.data[filename] = (bytes(audio), time.time())
+        self.total_bytes += len(audio)
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self.data) > 1:
+            old_name, (old_audio, _) = self.data.popitem(last=False)
+            self.total_bytes -= len(old_audio)
+            evicted.append(old_name)
+        return evicted
+
+    def read(self, filename, start=0, end=None):
+        audio, _ = self.data[filename]
+        self.data.move_to_end(filename)
+        return audio[start:end]
+
+    def size(self, filename):
+        entry = self.data.get(filename)
+        return len(entry[0]) if entry else None
+
+    def delete(self, filename):
+        entry = self.data.pop(filename, None)
+        if entry:
+            self.total_bytes -= len(entry[0])
+
+    def entries(self):
+        return [(filename, len(audio), mtime) for filename, (audio, mtime) in self.data.items()]
+
+class MmapAudioBackend(AudioBackend):
+    """
+    Ring buffer inside one preallocated memory-mapped segment file.
+
+    Entries are appended at the write position and wrap around to the start
+    when the end is reached, overwriting (and evicting) the oldest entries.
+    """
+
+    def __init__(self, path: str, capacity: int):
+        self.capacity = capacity
+        self.file = open(path, "w+b")
+        self.file.truncate(capacity)
+        self.map = mmap.mmap(self.file.fileno(), capacity)
+        self.position = 0
+        self.index: "OrderedDict[str, tuple]" = OrderedDict()  # filename -> (offset, size, mtime)
+
+    def write(self, filename, audio):
+        size = len(audio)
+        if size > self.capacity:
+            raise ValueError("Audio is larger than the mmap segment")
+        self.delete(filename)
+        if self.position + size > self.capacity:
+            self.position = 0
+        start, end = self.position, self.position + size
+        evicted = [
+            name for name, (offset, length, _) in self.index.items()
+            if offset < end and start < offset + length
+        ]
+        for name in evicted:
+            del self.index[name]
+        self.map[start:end] = audio
+        self.index[filename] = (start, size, time.time())
+        self.position = end
+        return evicted
+
+    def read(self, filename, start=0, end=None):
+        offset, size, _ = self.index[filename]
+        end = size if end is None else min(end, size)
+        return self.map[offset + start:offset + end]
+
+    def size(self, filename):
+        entry = self.index.get(filename)
+        return entry[1] if entry else None
+
+    def delete(self, filename):
+        self.index.pop(filename, None)
+
+    def entries(self):
+        return [(filename, size, mtime) for filename, (_, size, mtime) in self.index.items()]
+
+def create_audio_backend(kind: str) -> AudioBackend:
+    """Build the audio backend selected by AUDIO_STORE_BACKEND"""
+    if kind == "memory":
+        return MemoryAudioBackend(AUDIO_STORE_MAX_BYTES)
+    if kind == "mmap":
+        return MmapAudioBackend(AUDIO_MMAP_PATH, AUDIO_STORE_MAX_BYTES)
+    if kind != "disk":
+        print(f"Unknown AUDIO_STORE_BACKEND '{kind}', using disk")
+    return DiskAudioBackend(TEMP_DIR)
+
+class AudioStore:
+    """
+    Index of generated audio with TTL expiry and a size quota.
+
+    Expiry times live in a heap so the janitor only looks at entries that
+    are due. Entries that are currently being served are never removed;
+    their deletion is postponed until the reader is done.
+    """
+
+    def __init__(self, backend: AudioBackend, ttl: int, max_bytes: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.files: Dict[str, tuple] = {}  # filename -> (expires_at, size)
+        self.expiry: List[tuple] = []  # heap of (expires_at, filename)
+        self.total_bytes = 0
+        self.readers: Dict[str, List[float]] = {}
+        self.expired = 0
+        self.evicted = 0
+
+    async def _call(self, method, *args):
+        if self.backend.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    @staticmethod
+    def valid_name(filename: str) -> bool:
+        return bool(filename) and os.path.basename(filename) == filename and not filename.startswith(".")
+
+    def reconcile(self):
+        """Index entries left behind by a previous process, dropping expired ones"""
+        now = time.time()
+        for filename, size, mtime in self.backend.entries():
+            if filename in self.files:
+                continue
+            expires_at = mtime + self.ttl
+            if expires_at <= now:
+                self._remove(filename)
+                self.expired += 1
+            else:
+                self._register(filename, size, expires_at)
+        self._enforce_quota()
+
+    def _register(self, filename: str, size: int, expires_at: float):
+        if filename in self.files:
+            self.total_bytes -= self.files[filename][1]
+        self.files[filename] = (expires_at, size)
+        self.total_bytes += size
+        heapq.heappush(self.expiry, (expires_at, filename))
+
+    def _forget(self, filename: str):
+        entry = self.files.pop(filename, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def _remove(self, filename: str):
+        self._forget(filename)
+        try:
+            self.backend.delete(filename)
+        except Exception as e:
+            print(f"Error deleting file {filename}: {e}")
+
+    async def save(self, filename: str, audio: bytes, ttl: Optional[int] = None):
+        """Store audio under filename and schedule its expiry (after ttl, default the store's)"""
+        evicted = await self._call(self.backend.write, filename, audio)
+        for name in evicted:
+            self._forget(name)
+        self.evicted += len(evicted)
+        self._register(filename, len(audio), time.time() + (self.ttl if ttl is None else ttl))
+        self._enforce_quota()
+
+    async def exists(self, filename: str) -> bool:
+        if not self.valid_name(filename):
+            return False
+        return filename in self.files or self.backend.size(filename) is not None
+
+    def size(self, filename: str) -> Optional[int]:
+        return self.backend.size(filename) if self.valid_name(filename) else None
+
+    async def read(self, filename: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        """Read a byte range while protecting the entry from cleanup"""
+        await self.acquire(filename)
+        try:
+            return await self._call(self.backend.read, filename, start, end)
+        finally:
+            await self.release(filename)
+
+    async def acquire(self, filename: str):
+        """Mark an entry as being read so cleanup leaves it alone"""
+        self.readers.setdefault(filename, []).append(time.time())
+
+    async def release(self, filename: str):
+        readers = self.readers.get(filename)
+        if readers:
+            readers.pop(0)
+        if not readers:
+            self.readers.pop(filename, None)
+
+    def in_use(self, filename: str) -> bool:
+        cutoff = time.time() - AUDIO_READER_TIMEOUT
+        return any(started > cutoff for started in self.readers.get(filename, ()))
+
+    def purge_expired(self) -> int:
+        """Delete entries whose TTL has passed; returns how many were removed"""
+        now = time.time()
+        removed = 0
+        postponed = []
+        while self.expiry and self.expiry[0][0] <= now:
+            expires_at, filename = heapq.heappop(self.expiry)
+            entry = self.files.get(filename)
+            if entry is None or entry[0] != expires_at:
+                continue  # Stale heap entry (file removed or re-registered)
+            if self.in_use(filename):
+                postponed.append(filename)
+                continue
+            self._remove(filename)
+            removed += 1
+        for filename in postponed:
+            # Check again on the next janitor pass
+            self._register(filename, self.files[filename][1], now + AUDIO_JANITOR_INTERVAL)
+        self.expired += removed
+        return removed
+
+    def _enforce_quota(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Evict the entries closest to expiry first
+        for filename, (expires_at, size) in sorted(self.files.items(), key=lambda item: item[1][0]):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if self.in_use(filename):
+                continue
+            self._remove(filename)
+            self.evicted += 1
+
+    def cleanup(self) -> tuple:
+        """Remove every entry that is not being served; returns (removed, skipped)"""
+        removed = 0
+        skipped = 0
+        for filename, _, _ in self.backend.entries():
+            if self.in_use(filename):
+                skipped += 1
+                continue
+            self._remove(filename)
+            removed += 1
+        return removed, skipped
+
+    async def run_janitor(self, interval: int = AUDIO_JANITOR_INTERVAL):
+        """Periodically delete expired entries"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = self.purge_expired()
+                if removed:
+                    print(f"Deleted {removed} expired audio files")
+            except Exception as e:
+                print(f"Audio janitor error: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "files": len(self.files),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "active_readers": sum(len(readers) for readers in self.readers.values()),
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+class SharedAudioStore(AudioStore):
+    """
+    AudioStore whose index lives in the shared SQLite database.
+
+    Any worker can serve, expire or evict any entry, and an entry being read
+    by one worker is protected from cleanup in all of them.
+    """
+
+    def __init__(self, backend: AudioBackend, ttl: int, max_bytes: int, state: SharedState):
+        super().__init__(backend, ttl, max_bytes)
+        self.state = state
+
+    def reconcile(self):
+        now = time.time()
+        with self.state.transaction() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO audio_files (filename, size, expires_at) VALUES (?, ?, ?)",
+                [(filename, size, mtime + self.ttl) for filename, size, mtime in self.backend.entries()]
+            )
+            # Readers left behind by workers that died mid-request
+            db.execute("DELETE FROM audio_readers WHERE started < ?", (now - AUDIO_READER_TIMEOUT,))
+        self.purge_expired()
+        self._enforce_quota()
+
+    def _register(self, filename: str, size: int, expires_at: float):
+        self.state.db.execute(
+            "INSERT OR REPLACE INTO audio_files (filename, size, expires_at) VALUES (?, ?, ?)",
+            (filename, size, expires_at)
+        )
+
+    def _forget(self, filename: str):
+        self.state.db.execute("DELETE FROM audio_files WHERE filename = ?", (filename,))
+
+    @staticmethod
+    def _indexed(db: sqlite3.Connection, filename: str) -> bool:
+        return db.execute("SELECT 1 FROM audio_files WHERE filename = ?", (filename,)).fetchone() is not None
+
+    @staticmethod
+    def _add_reader(db: sqlite3.Connection, filename: str) -> int:
+        return db.execute(
+            "INSERT INTO audio_readers (filename, started) VALUES (?, ?)",
+            (filename, time.time())
+        ).lastrowid
+
+    @staticmethod
+    def _remove_reader(db: sqlite3.Connection, reader_id: int):
+        db.execute("DELETE FROM audio_readers WHERE id = ?", (reader_id,))
+
+    # Request paths go through the state's thread, cleanup stays on the loop
+    async def exists(self, filename: str) -> bool:
+        if not self.valid_name(filename):
+            return False
+        return await self.state.run(self._indexed, filename) or self.backend.size(filename) is not None
+
+    async def acquire(self, filename: str):
+        reader_id = await self.state.run(self._add_reader, filename)
+        self.readers.setdefault(filename, []).append(reader_id)
+
+    async def release(self, filename: str):
+        readers = self.readers.get(filename)
+        reader_id = readers.pop(0) if readers else None
+        if not readers:
+            self.readers.pop(filename, None)
+        if reader_id is not None:
+            await self.state.run(self._remove_reader, reader_id)
+
+    def in_use(self, filename: str) -> bool:
+        row = self.state.db.execute(
+            "SELECT 1 FROM audio_readers WHERE filename = ? AND started > ?",
+            (filename, time.time() - AUDIO_READER_TIMEOUT)
+        ).fetchone()
+        return row is not None
+
+    def _claim(self, query: str, params: tuple, limit_bytes: Optional[int] = None) -> List[str]:
+        """Atomically drop index rows selected by query, skipping entries being read"""
+        cutoff = time.time() - AUDIO_READER_TIMEOUT
+        claimed = []
+        with self.state.transaction() as db:
+            over = None
+            if limit_bytes is not None:
+                over = db.execute("SELECT COALESCE(SUM(size), 0) FROM audio_files").fetchone()[0] - limit_bytes
+                if over <= 0:
+                    return []
+            for filename, size in db.execute(query, params).fetchall():
+                if db.execute(
+                    "SELECT 1 FROM audio_readers WHERE filename = ? AND started > ?", (filename, cutoff)
+                ).fetchone():
+                    continue  # Checked again on the next janitor pass
+                db.execute("DELETE FROM audio_files WHERE filename = ?", (filename,))
+                claimed.append(filename)
+                if over is not None:
+                    over -= size
+                    if over <= 0:
+                        break
+        # Only the worker that claimed a row deletes its bytes
+        for filename in claimed:
+            try:
+                self.backend.delete(filename)
+            except Exception as e:
+                print(f"Error deleting file {filename}: {e}")
+        return claimed
+
+    def purge_expired(self) -> int:
+        removed = len(self._claim(
+            "SELECT filename, size FROM audio_files WHERE expires_at <= ?", (time.time(),)
+        ))
+        self.expired += removed
+        return removed
+
+    def _enforce_quota(self):
+        self.evicted += len(self._claim(
+            "SELECT filename, size FROM audio_files ORDER BY expires_at", (), limit_bytes=self.max_bytes
+        ))
+
+    def stats(self) -> dict:
+        files, total_bytes = self.state.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM audio_files"
+        ).fetchone()
+        active_readers = self.state.db.execute(
+            "SELECT COUNT(*) FROM audio_readers WHERE started > ?", (time.time() - AUDIO_READER_TIMEOUT,)
+        ).fetchone()[0]
+        return {
+            "backend": type(self.backend).__name__,
+            "shared_state": self.state.path,
+            "files": files,
+            "bytes": total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "active_readers": active_readers,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+def create_audio_store() -> AudioStore:
+    """Process-local index, or the shared SQLite index when running several workers"""
+    if shared_state is None:
+        return AudioStore(
+            create_audio_backend(AUDIO_STORE_BACKEND),
+            ttl=AUDIO_TTL_SECONDS,
+            max_bytes=AUDIO_STORE_MAX_BYTES
+        )
+    if AUDIO_STORE_BACKEND != "disk":
+        # memory/mmap bytes are private to one process
+        print(f"AUDIO_STORE_BACKEND '{AUDIO_STORE_BACKEND}' cannot be shared between workers, using disk")
+    return SharedAudioStore(
+        DiskAudioBackend(TEMP_DIR),
+        ttl=AUDIO_TTL_SECONDS,
+        max_bytes=AUDIO_STORE_MAX_BYTES,
+        state=shared_state
+    )
+
+audio_store = create_audio_store()
+
+_RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def parse_range_header(range_header: Optional[str], size: int) -> Optional[tuple]:
+    """
+    Parse a single-range "Range: bytes=..." header.
+
+    Returns (start, end) with end exclusive, None when the whole entity
+    should be sent, and raises ValueError for unsatisfiable ranges.
+    """
+    if not range_header:
+        return None
+    match = _RANGE_HEADER.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None  # Unsupported (e.g. multiple ranges): send everything
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size
+    start = int(first)
+    end = size if last == "" else min(int(last) + 1, size)
+    if start >= size or start >= end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+# Helper function to serve stored audio (with HTTP Range support)
+async def audio_response(filename: str, range_header: Optional[str] = None, headers: Optional[dict] = None) -> Response:
+    """Serve audio from whichever backend holds it"""
+    size = audio_store.size(filename)
+    if size is None:
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    response_headers = {"Accept-Ranges": "bytes"}
+    response_headers.update(headers or {})
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            print(f"Deleted audio file: {filepath}")
-    except Exception as e:
-        print(f"Error deleting file {filepath}: {e}")
+        byte_range = parse_range_header(range_header, size)
+    except ValueError:
+        return Response(
+            status_code=416,
+            headers={"Content-Range": f"bytes */{size}", **response_headers}
+        )
+    if byte_range is None:
+        content = await audio_store.read(filename)
+        return Response(content=content, media_type=audio_media_type(filename), headers=response_headers)
+    start, end = byte_range
+    content = await audio_store.read(filename, start, end)
+    response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    return Response(content=content, status_code=206, media_type=audio_media_type(filename), headers=response_headers)
 
 # Helper function to format SSE messages
 def format_sse(data: dict, event: str = None) -> str:
@@ -125,145 +1161,2479 @@ def format_sse(data: dict, event: str = None) -> str:
     message += f"data: {json.dumps(data)}\n\n"
     return message
 
-# Helper function to call LLM (non-streaming)
-def call_llm_complete(provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str) -> str:
-    """Call LLM provider and return complete response"""
-    if provider.lower() == "mistral":
-        with Mistral(api_key=api_key) as mistral:
-            chat_response = mistral.chat.complete(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ]
+# WebSocket audio protocols
+# "json" sends audio as base64 inside JSON messages (original protocol);
+# "binary" sends raw MP3 bytes as binary frames and keeps JSON text frames
+# for status, text and word boundary messages.
+WS_PROTOCOLS = ("json", "binary")
+
+def negotiate_ws_protocol(websocket: WebSocket, data: dict) -> str:
+    """Pick the audio protocol requested in the message or ?protocol= query"""
+    protocol = data.get("protocol") or websocket.query_params.get("protocol") or "json"
+    return protocol if protocol in WS_PROTOCOLS else "json"
+
+async def send_ws_busy(websocket: WebSocket, error: "UpstreamBusy", trace_id: Optional[str] = None):
+    """Report a saturated upstream and close with 1013 (try again later)"""
+    message = {
+        "type": "error",
+        "status": "busy",
+        "message": str(error),
+        "retry_after": error.retry_after
+    }
+    if trace_id:
+        message["trace_id"] = trace_id
+    try:
+        await websocket.send_json(message)
+        await websocket.close(code=1013)
+    except Exception:
+        pass
+
+async def send_ws_audio(websocket: WebSocket, audio: bytes, protocol: str):
+    """Send one audio chunk using the negotiated protocol"""
+    if protocol == "binary":
+        await websocket.send_bytes(audio)
+    else:
+        await websocket.send_json({
+            "type": "audio",
+            "data": base64.b64encode(audio).decode("utf-8")
+        })
+
+# Shared HTTP connection pools
+# One long-lived client per upstream so TCP/TLS connections are reused
+# between requests instead of paying a handshake every time.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+# Maximum number of provider SDK clients kept alive (one per provider + API key)
+LLM_CLIENT_CACHE_SIZE = int(os.getenv("LLM_CLIENT_CACHE_SIZE", "64"))
+
+try:
+    import h2  # noqa: F401 -- required by httpx for HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+class HTTPClientPool:
+    """Lazily created, long-lived httpx.AsyncClient per upstream"""
+
+    def __init__(self):
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.requests: Dict[str, int] = {}
+
+    def get(self, upstream: str) -> httpx.AsyncClient:
+        client = self.clients.get(upstream)
+        if client is None or client.is_closed:
+            self.requests.setdefault(upstream, 0)
+
+            async def count_request(request: httpx.Request):
+                self.requests[upstream] += 1
+
+            client = httpx.AsyncClient(
+                http2=HTTP2_ENABLED and HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+                ),
+                timeout=30.0,
+                event_hooks={"request": [count_request]}
             )
-            return chat_response.choices[0].message.content
-
-    elif provider.lower() == "google":
-        client = genai.Client(api_key=api_key)
-        response = client.models.generate_content(
-            model=model,
-            contents=[
-                {"role": "user", "parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]}
-            ]
-        )
-        return response.text
-
-    elif provider.lower() == "z.ai":
-        with httpx.Client() as client:
-            response = client.post(
-                "https://api.z.ai/api/paas/v4/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": model,
-                    "thinking": {"type": "disabled"},
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ]
-                },
-                timeout=30.0
+            self.clients[upstream] = client
+        return client
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+        self.clients.clear()
+
+    @staticmethod
+    def _connections(client: httpx.AsyncClient) -> list:
+        # httpx does not expose pool state publicly; read it defensively
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        return list(getattr(pool, "connections", None) or [])
+
+    def has_connection(self, upstream: str) -> bool:
+        client = self.clients.get(upstream)
+        return client is not None and not client.is_closed and bool(self._connections(client))
+
+    def stats(self) -> dict:
+        upstreams = {}
+        for upstream, client in self.clients.items():
+            connections = self._connections(client)
+            upstreams[upstream] = {
+                "requests": self.requests.get(upstream, 0),
+                "connections": len(connections),
+                "idle_connections": sum(1 for conn in connections if conn.is_idle()),
+            }
+        return {
+            "http2": HTTP2_ENABLED and HTTP2_AVAILABLE,
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "max_keepalive_connections": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            "keepalive_expiry": HTTP_KEEPALIVE_EXPIRY,
+            "upstreams": upstreams,
+        }
+
+class ProviderClientCache:
+    """
+    Bounded LRU of provider SDK clients keyed by provider and API key.
+
+    A client evicted while requests are still using it (see lease()) is
+    closed when the last of them is done.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.clients: "OrderedDict[tuple, object]" = OrderedDict()
+        self.leases: Dict[int, int] = {}  # id(client) -> requests using it
+        self.retired: Dict[int, object] = {}  # evicted clients still leased
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, provider: str, api_key: str, factory):
+        # Never keep raw API keys around as dictionary keys
+        key = (provider, hashlib.sha256(api_key.encode()).hexdigest())
+        client = self.clients.get(key)
+        if client is not None:
+            self.hits += 1
+            self.clients.move_to_end(key)
+            return client
+        self.misses += 1
+        client = factory()
+        self.clients[key] = client
+        while len(self.clients) > self.max_size:
+            _, evicted = self.clients.popitem(last=False)
+            self.evictions += 1
+            if self.leases.get(id(evicted)):
+                self.retired[id(evicted)] = evicted
+            else:
+                asyncio.create_task(self._close(evicted))
+        return client
+
+    @contextmanager
+    def lease(self, client):
+        """Keep client open while a request uses it"""
+        self.leases[id(client)] = self.leases.get(id(client), 0) + 1
+        try:
+            yield client
+        finally:
+            self.leases[id(client)] -= 1
+            if not self.leases[id(client)]:
+                del self.leases[id(client)]
+                retired = self.retired.pop(id(client), None)
+                if retired is not None:
+                    asyncio.create_task(self._close(retired))
+
+    @staticmethod
+    async def _close(client):
+        try:
+            aio = getattr(client, "aio", None)
+            if aio is not None:
+                await aio.aclose()
+        except Exception as e:
+            print(f"Error closing provider client: {e}")
+
+    async def aclose(self):
+        for client in [*self.clients.values(), *self.retired.values()]:
+            await self._close(client)
+        self.clients.clear()
+        self.retired.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.clients),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "retired": len(self.retired),
+        }
+
+http_clients = HTTPClientPool()
+llm_clients = ProviderClientCache(LLM_CLIENT_CACHE_SIZE)
+
+# Upstream concurrency configuration
+# Calls to edge-tts, the embedding API and each LLM provider are admitted
+# through a per-upstream limit. Callers beyond it wait in a bounded queue that
+# is served round-robin per user_hash; when the queue is full (429) or the
+# wait times out (503) the request fails fast with a Retry-After hint.
+UPSTREAM_CONCURRENCY = {
+    name.strip(): int(limit)
+    for name, _, limit in (
+        item.partition("=") for item in os.getenv(
+            "UPSTREAM_CONCURRENCY", "edge-tts=16,embedding=16,mistral=8,google=8,z.ai=8"
+        ).split(",")
+    )
+    if name.strip() and limit.strip().isdigit()
+}
+UPSTREAM_DEFAULT_CONCURRENCY = int(os.getenv("UPSTREAM_DEFAULT_CONCURRENCY", "8"))
+UPSTREAM_QUEUE_SIZE = int(os.getenv("UPSTREAM_QUEUE_SIZE", "100"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "15"))
+
+# The user whose request is being handled, for fair upstream scheduling
+current_user: ContextVar[str] = ContextVar("current_user", default="")
+
+class UpstreamBusy(Exception):
+    """An upstream is saturated; the client should retry after a while"""
+
+    def __init__(self, upstream: str, status_code: int, retry_after: int):
+        reason = "queue is full" if status_code == 429 else "timed out waiting for a slot"
+        super().__init__(f"Upstream {upstream} is busy ({reason}), retry after {retry_after}s")
+        self.upstream = upstream
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class FairLimiter:
+    """
+    Concurrency limit with a bounded wait queue.
+
+    Waiters are grouped per user and a freed slot goes to the next user in
+    round-robin order, so one user's burst cannot starve everyone else.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, timeout: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+        # Moving average of how long a slot is held, for Retry-After
+        self.average_hold = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil((self.waiting + 1) / self.limit * self.average_hold))
+
+    def check(self):
+        """Fail fast (without queueing) when no more waiters would be accepted"""
+        if self.active >= self.limit and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamBusy(self.name, 429, self.retry_after())
+
+    async def acquire(self, user: str = ""):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            return
+        self.check()
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(user, deque()).append(future)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up
+                if isinstance(e, asyncio.TimeoutError):
+                    self.admitted += 1
+                    return
+                self.release()
+                raise
+            future.cancel()
+            self._discard(user, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                raise UpstreamBusy(self.name, 503, self.retry_after()) from None
+            raise
+        self.admitted += 1
+
+    def _discard(self, user: str, future: asyncio.Future):
+        queue = self.queues.get(user)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self.waiting -= 1
+        if not queue:
+            del self.queues[user]
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.limit and self.queues:
+            user, queue = next(iter(self.queues.items()))
+            future = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                self.queues.move_to_end(user)
+            else:
+                del self.queues[user]
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user: Optional[str] = None):
+        """Hold one upstream slot for the duration of the block"""
+        await self.acquire(current_user.get() if user is None else user)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.average_hold = 0.8 * self.average_hold + 0.2 * (time.monotonic() - started)
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "waiting_users": len(self.queues),
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "average_hold": round(self.average_hold, 3),
+        }
+
+class UpstreamLimits:
+    """One FairLimiter per upstream, created on first use"""
+
+    def __init__(self):
+        self.limiters: Dict[str, FairLimiter] = {}
+
+    @staticmethod
+    def known() -> set:
+        """Upstreams that can have a limiter; anything else is a bad name from a request"""
+        return {"embedding", "edge-tts", *LLM_PROVIDERS}
+
+    def get(self, upstream: str) -> FairLimiter:
+        limiter = self.limiters.get(upstream)
+        if limiter is None:
+            if upstream not in self.known():
+                raise ValueError(f"Unknown upstream: {upstream}")
+            limiter = FairLimiter(
+                upstream,
+                UPSTREAM_CONCURRENCY.get(upstream, UPSTREAM_DEFAULT_CONCURRENCY),
+                UPSTREAM_QUEUE_SIZE,
+                UPSTREAM_QUEUE_TIMEOUT
             )
-            response.raise_for_status()
-            response_data = response.json()
-            return response_data["choices"][0]["message"]["content"]
+            self.limiters[upstream] = limiter
+        return limiter
 
-    else:
-        raise ValueError(f"Unsupported provider: {provider}. Use 'mistral', 'google', or 'z.ai'")
+    def check(self, *upstreams: str):
+        """Reject up front when any upstream a request needs is saturated"""
+        for upstream in upstreams:
+            self.get((upstream or "").lower()).check()
+
+    def stats(self) -> dict:
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+upstream_limits = UpstreamLimits()
+
+@app.exception_handler(UpstreamBusy)
+async def upstream_busy_handler(request: Request, exc: UpstreamBusy):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": str(exc), "retry_after": exc.retry_after},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# Search result cache configuration
+SEARCH_CACHE_ENABLED = os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true"
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+
+class SearchCache:
+    """
+    TTL + LRU cache of embedding search results with single-flight.
+
+    Entries are keyed by (query, user_hash, collection_name, top_k) and can
+    be dropped per collection when its documents change.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, enabled: bool = True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.inflight: Dict[tuple, asyncio.Future] = {}
+        # Bumped on invalidation so searches already in flight are not stored
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+
+    async def get_or_fetch(self, key: tuple, collection_name: str, fetch) -> dict:
+        if not self.enabled:
+            return await fetch()
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.entries[key]
+
+        if key in self.inflight:
+            self.coalesced += 1
+            value = await asyncio.shield(self.inflight[key])
+            if value is not None:
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        generation = self.generations.get(collection_name, 0)
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        value = None
+        try:
+            value = await fetch()
+            if self.generations.get(collection_name, 0) == generation:
+                self.entries[key] = (time.monotonic() + self.ttl, value)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return value
+        finally:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+            # Waiters fall back to their own search if this one failed
+            if not future.done():
+                future.set_result(value)
+
+    def invalidate(self, collection_name: str, user_hash: Optional[str] = None) -> int:
+        """Drop cached results for a collection (optionally only for one user)"""
+        self.generations[collection_name] = self.generations.get(collection_name, 0) + 1
+        stale = [
+            key for key in self.entries
+            if key[2] == collection_name and (user_hash is None or key[1] == user_hash)
+        ]
+        for key in stale:
+            del self.entries[key]
+        # Make in-flight searches for this collection start over for new callers
+        for key in [key for key in self.inflight if key[2] == collection_name]:
+            del self.inflight[key]
+        self.invalidations += 1
+        return len(stale)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+search_cache = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES, enabled=SEARCH_CACHE_ENABLED)
+
+# Helper function to query the embedding search API
+async def search_embeddings(query: str, user_hash: str, collection_name: str, top_k: int) -> dict:
+    """Run a vector search against the embedding API (cached)"""
+    started = time.perf_counter()
+    try:
+        return await search_cache.get_or_fetch(
+            (query, user_hash, collection_name, top_k),
+            collection_name,
+            lambda: fetch_search_results(query, user_hash, collection_name, top_k)
+        )
+    finally:
+        search_seconds.observe(time.perf_counter() - started, endpoint=current_endpoint.get())
+        trace_mark("search")
+
+async def fetch_search_results(query: str, user_hash: str, collection_name: str, top_k: int) -> dict:
+    """Run a vector search against the embedding API"""
+    async with upstream_limits.get("embedding").slot(user_hash):
+        search_response = await http_clients.get("embedding").post(
+            f"{EMBEDDING_API_URL}/search",
+            json={
+                "api_key": EMBEDDING_API_KEY,
+                "query": query,
+                "user_hash": user_hash,
+                "collection_name": collection_name,
+                "top_k": top_k
+            },
+            timeout=30.0
+        )
+    search_response.raise_for_status()
+    return search_response.json()
+
+# RAG context configuration
+# Search results below this score are not sent to the LLM (or linked)
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.4"))
+# Default token budget for the retrieved context
+RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1500"))
+# Per-model overrides, e.g. "glm-4.6=1000,gemini-2.5-flash=4000"
+RAG_CONTEXT_TOKENS_BY_MODEL = {
+    model.strip(): int(tokens)
+    for model, _, tokens in (
+        item.partition("=") for item in os.getenv("RAG_CONTEXT_TOKENS_BY_MODEL", "").split(",")
+    )
+    if model.strip() and tokens.strip().isdigit()
+}
+# Fraction of a chunk's word 5-grams already present in the context above
+# which the chunk is considered a duplicate
+RAG_DUPLICATE_OVERLAP = float(os.getenv("RAG_DUPLICATE_OVERLAP", "0.8"))
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token for BPE tokenizers)"""
+    return (len(text) + 3) // 4
+
+def context_token_budget(model: Optional[str]) -> int:
+    return RAG_CONTEXT_TOKENS_BY_MODEL.get(model or "", RAG_CONTEXT_TOKENS)
+
+def extract_chunk_text(doc: dict) -> str:
+    """Pull the chunk text out of a search result, whatever field it uses"""
+    metadata = doc.get("metadata") or {}
+    for source in (doc, metadata):
+        for field in ("text", "content", "chunk", "page_content"):
+            value = source.get(field)
+            if isinstance(value, str) and value.strip():
+                return " ".join(value.split())
+    return ""
+
+def _shingles(text: str, size: int = 5) -> set:
+    words = text.lower().split()
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def build_rag_context(search_data: dict, model: Optional[str] = None) -> str:
+    """
+    Assemble a compact context from search results.
+
+    Keeps only chunk text from results above RAG_MIN_SCORE (best first),
+    drops chunks that mostly repeat text already included, and stops at the
+    model's token budget (truncating the last chunk at a word boundary).
+    """
+    results = [
+        doc for doc in search_data.get("results", [])
+        if isinstance(doc, dict) and doc.get("score", 0) > RAG_MIN_SCORE
+    ]
+    results.sort(key=lambda doc: doc.get("score", 0), reverse=True)
+
+    budget = context_token_budget(model)
+    seen: set = set()
+    chunks = []
+    used = 0
+    for doc in results:
+        text = extract_chunk_text(doc)
+        if not text:
+            continue
+        shingles = _shingles(text)
+        if len(shingles & seen) >= RAG_DUPLICATE_OVERLAP * len(shingles):
+            continue
+        tokens = estimate_tokens(text) + 2  # numbering and separator
+        if used + tokens > budget:
+            remaining_chars = (budget - used - 2) * 4
+            if remaining_chars >= 200:
+                chunks.append(text[:remaining_chars].rsplit(" ", 1)[0] + " ...")
+            break
+        seen |= shingles
+        chunks.append(text)
+        used += tokens
+
+    if not chunks:
+        return "No relevant documents found."
+    return "\n\n".join(f"[{number}] {chunk}" for number, chunk in enumerate(chunks, 1))
+
+def build_user_prompt(query: str, search_data: dict, model: Optional[str] = None, history: Optional[List[tuple]] = None) -> str:
+    """User prompt sent to the LLM for a RAG query, after the (query, answer) turns before it"""
+    prompt = f"Query: {query}\n\nContext:\n{build_rag_context(search_data, model)}"
+    if history:
+        conversation = "\n\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in history)
+        prompt = f"Conversation so far:\n{conversation}\n\n{prompt}"
+    return prompt
+
+def extract_document_urls(search_data: dict) -> List[str]:
+    """Source URLs of the results relevant enough to show to the user"""
+    return [
+        doc.get("metadata", {}).get("url", "")
+        for doc in search_data.get("results", [])
+        if doc.get("score", 0) > RAG_MIN_SCORE and doc.get("metadata", {}).get("url")
+    ]
+
+# LLM provider layer
+# Every provider exposes the same async interface so the request handlers can
+# await a full completion or iterate a token stream without ever blocking the
+# event loop.
+# OpenAI-style chat completions endpoint of z.ai (overridable, e.g. for a stub)
+ZAI_API_URL = os.getenv("ZAI_API_URL", "https://api.z.ai/api/paas/v4/chat/completions")
+
+def _chat_messages(system_prompt: str, user_prompt: str) -> list:
+    """Build an OpenAI-style message list"""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+class LLMProvider:
+    """Base class for async LLM providers"""
+    name = ""
+    # Requested once to open a pooled connection before the first real call
+    warm_url = ""
+
+    async def warm(self, api_key: str):
+        """Set up the client and connection a request with this key will use"""
+        if self.warm_url and not http_clients.has_connection(self.name):
+            try:
+                await http_clients.get(self.name).head(self.warm_url, timeout=5.0)
+            except httpx.HTTPError:
+                pass
+
+    async def stream(self, model: str, api_key: str, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        """Yield response text chunks as they are generated"""
+        raise NotImplementedError
+        yield
+
+class MistralProvider(LLMProvider):
+    name = "mistral"
+    warm_url = "https://api.mistral.ai/"
+
+    async def warm(self, api_key):
+        self.client(api_key)
+        await super().warm(api_key)
+
+    def client(self, api_key: str) -> Mistral:
+        return llm_clients.get(
+            self.name, api_key,
+            lambda: Mistral(api_key=api_key, async_client=http_clients.get(self.name))
+        )
+
+    async def stream(self, model, api_key, system_prompt, user_prompt):
+        with llm_clients.lease(self.client(api_key)) as client:
+            chat_stream = await client.chat.stream_async(
+                model=model,
+                messages=_chat_messages(system_prompt, user_prompt)
+            )
+            async for chunk in chat_stream:
+                if chunk.data.choices[0].delta.content:
+                    yield chunk.data.choices[0].delta.content
+
+class GoogleProvider(LLMProvider):
+    name = "google"
+
+    @staticmethod
+    def _contents(system_prompt: str, user_prompt: str) -> list:
+        return [
+            {"role": "user", "parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]}
+        ]
+
+    def client(self, api_key: str) -> genai.Client:
+        return llm_clients.get(self.name, api_key, lambda: genai.Client(api_key=api_key))
+
+    async def warm(self, api_key):
+        # The SDK has its own transport; building the client is what can be done early
+        self.client(api_key)
+
+    async def stream(self, model, api_key, system_prompt, user_prompt):
+        with llm_clients.lease(self.client(api_key)) as client:
+            stream = await client.aio.models.generate_content_stream(
+                model=model,
+                contents=self._contents(system_prompt, user_prompt)
+            )
+            async for chunk in stream:
+                if hasattr(chunk, 'text') and chunk.text:
+                    yield chunk.text
+
+class ZAIProvider(LLMProvider):
+    name = "z.ai"
+    url = ZAI_API_URL
+    warm_url = str(httpx.URL(ZAI_API_URL).join("/"))
+
+    @staticmethod
+    def _headers(api_key: str) -> dict:
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    async def stream(self, model, api_key, system_prompt, user_prompt):
+        async with http_clients.get(self.name).stream(
+            "POST",
+            self.url,
+            headers=self._headers(api_key),
+            json={
+                "model": model,
+                "thinking": {"type": "disabled"},
+                "messages": _chat_messages(system_prompt, user_prompt),
+                "stream": True
+            },
+            timeout=30.0
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    # Parse SSE format: "data: {json}"
+                    if line.startswith("data: "):
+                        data_str = line[6:]  # Remove "data: " prefix
+                        if data_str.strip() == "[DONE]":
+                            break
+                        try:
+                            chunk_data = json.loads(data_str)
+                            if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
+                                delta = chunk_data["choices"][0].get("delta", {})
+                                content = delta.get("content", "")
+                                if content:
+                                    yield content
+                        except json.JSONDecodeError:
+                            continue
+
+LLM_PROVIDERS: Dict[str, LLMProvider] = {
+    provider.name: provider
+    for provider in (MistralProvider(), GoogleProvider(), ZAIProvider())
+}
+
+def get_llm_provider(provider: str) -> LLMProvider:
+    """Look up a provider by name (case-insensitive)"""
+    llm_provider = LLM_PROVIDERS.get((provider or "").lower())
+    if llm_provider is None:
+        raise ValueError(f"Unsupported provider: {provider}. Use 'mistral', 'google', or 'z.ai'")
+    return llm_provider
+
+# Helper function to call LLM (streaming)
+async def call_llm_stream(provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+    """Call LLM provider and yield response chunks as they arrive"""
+    llm_provider = get_llm_provider(provider)
+    async with upstream_limits.get(llm_provider.name).slot():
+        async for content in llm_provider.stream(model, api_key, system_prompt, user_prompt):
+            yield content
+
+# LLM call policy configuration
+# RAG answers wait at most LLM_FIRST_TOKEN_TIMEOUT for the first token. A
+# hedged second request can be sent once the usual (p95) first-token latency
+# has passed, failed calls are retried with jittered backoff, and finally
+# other models from LLM_FALLBACK_MODELS are tried.
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "15"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "2"))  # per model
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+# Hedge delay floor, also used until enough latencies have been observed
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1.0"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+# Ordered provider:model list tried after the requested model
+LLM_FALLBACK_MODELS = [
+    (provider.strip().lower(), model.strip())
+    for provider, _, model in (
+        item.partition(":") for item in os.getenv(
+            "LLM_FALLBACK_MODELS", "mistral:mistral-small-latest,google:gemini-flash-lite-latest,z.ai:glm-4.5-flash"
+        ).split(",")
+    )
+    if provider.strip() and model.strip()
+]
+# auth_key only carries a key for the requested provider; falling back to
+# another provider needs a server-side key for it
+LLM_FALLBACK_API_KEYS = {
+    "mistral": os.getenv("MISTRAL_API_KEY", ""),
+    "google": os.getenv("GOOGLE_API_KEY", ""),
+    "z.ai": os.getenv("ZAI_API_KEY", ""),
+}
+# Model lists maintained by refresh_models.php
+LLM_MODEL_FILES = {
+    "mistral": "mistral_model.json",
+    "google": "google_model.json",
+    "z.ai": "zai_model.json",
+}
+
+_model_catalogues: Dict[str, tuple] = {}  # provider -> (mtime, {model: aliases})
+
+def provider_models(provider: str) -> Optional[Dict[str, set]]:
+    """Chat models in the provider's *_model.json as {id: aliases}, None if unavailable"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), LLM_MODEL_FILES.get(provider, ""))
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _model_catalogues.get(provider)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, "r", encoding="utf-8") as models_file:
+            data = json.load(models_file)
+    except (OSError, ValueError) as e:
+        print(f"Error reading {path}: {e}")
+        return None
+    models = {}
+    if provider == "google":
+        for entry in data.get("models", []):
+            if "generateContent" in entry.get("supportedGenerationMethods", []):
+                models[entry["name"].split("/", 1)[-1]] = set()
+    else:
+        for entry in data.get("data", []):
+            capabilities = entry.get("capabilities") or {}
+            if capabilities.get("completion_chat", True) and not entry.get("deprecation"):
+                models[entry["id"]] = set(entry.get("aliases") or [])
+    _model_catalogues[provider] = (mtime, models)
+    return models
+
+def llm_metric_labels(provider: str, model: str) -> dict:
+    """provider/model metric labels; names the server does not know are reported as 'other'"""
+    llm_provider = LLM_PROVIDERS.get((provider or "").lower())
+    if llm_provider is None:
+        return {"provider": "other", "model": "other"}
+    models = provider_models(llm_provider.name) or {}
+    known = (
+        model in models
+        or any(model in aliases for aliases in models.values())
+        or (llm_provider.name, model) in LLM_FALLBACK_MODELS
+    )
+    return {"provider": llm_provider.name, "model": model if known else "other"}
+
+LLM_TRANSPORT_ERRORS = (asyncio.TimeoutError, httpx.TransportError, aiohttp.ClientConnectionError, ConnectionError)
+
+def upstream_status(error: Exception) -> Optional[int]:
+    """HTTP status of a provider error (httpx, Mistral and Google SDKs), None for anything else"""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    for attribute in ("status_code", "code"):
+        if status is None:
+            status = getattr(error, attribute, None)
+    return status if isinstance(status, int) and 100 <= status <= 599 else None
+
+def is_upstream_error(error: Exception) -> bool:
+    """Whether the provider (or the way to it) failed, as opposed to a bug in our code"""
+    return isinstance(error, LLM_TRANSPORT_ERRORS) or upstream_status(error) is not None
+
+def is_retryable(error: Exception) -> bool:
+    """Timeouts, connection problems, throttling and 5xx are worth retrying"""
+    if isinstance(error, LLM_TRANSPORT_ERRORS):
+        return True
+    status = upstream_status(error)
+    return status is not None and (status in (408, 409, 425, 429) or status >= 500)
+
+llm_retries_total = metrics.add(Counter("tts_llm_retries_total", "LLM calls retried", ("provider", "model")))
+llm_hedges_total = metrics.add(Counter("tts_llm_hedges_total", "Hedged second LLM requests sent", ("provider", "model")))
+llm_fallbacks_total = metrics.add(Counter("tts_llm_fallbacks_total", "Answers moved to a fallback model", ("provider", "model")))
+
+class LLMAttempt:
+    """One streaming LLM request pumped into a queue by its own task"""
+
+    def __init__(self, provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str):
+        self.first_token = asyncio.get_running_loop().create_future()
+        self.tokens: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._pump(provider, model, api_key, system_prompt, user_prompt))
+
+    async def _pump(self, provider, model, api_key, system_prompt, user_prompt):
+        try:
+            async for token in call_llm_stream(provider, model, api_key, system_prompt, user_prompt):
+                if not self.first_token.done():
+                    self.first_token.set_result(None)
+                await self.tokens.put(token)
+            if not self.first_token.done():
+                self.first_token.set_result(None)
+            await self.tokens.put(_PIPELINE_DONE)
+        except Exception as e:
+            if not self.first_token.done():
+                self.first_token.set_exception(e)
+            else:
+                await self.tokens.put(e)
+
+    async def remaining(self) -> AsyncIterator[str]:
+        try:
+            while True:
+                token = await self.tokens.get()
+                if token is _PIPELINE_DONE:
+                    return
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        finally:
+            self.task.cancel()
+
+class LLMPolicy:
+    """Timeout, hedging, retry and fallback rules around the provider calls"""
+
+    def __init__(self):
+        self.first_token_latency: Dict[tuple, deque] = {}
+        self.timeouts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+
+    def hedge_delay(self, provider: str, model: str) -> float:
+        samples = sorted(self.first_token_latency.get((provider, model), ()))
+        if len(samples) < 20:
+            return LLM_HEDGE_MIN_DELAY
+        return max(LLM_HEDGE_MIN_DELAY, samples[int(LLM_HEDGE_QUANTILE * (len(samples) - 1))])
+
+    def candidates(self, provider: str, model: str, api_key: str) -> List[tuple]:
+        """(provider, model, api_key) to try in order, starting with the requested one"""
+        provider = (provider or "").lower()
+        candidates = [(provider, model, api_key)]
+        requested = provider_models(provider) or {}
+        tried = {model} | requested.get(model, set())
+        for fallback_provider, fallback_model in LLM_FALLBACK_MODELS:
+            key = api_key if fallback_provider == provider else LLM_FALLBACK_API_KEYS.get(fallback_provider)
+            if not key or fallback_provider not in LLM_PROVIDERS:
+                continue
+            if fallback_provider == provider and fallback_model in tried:
+                continue
+            known = provider_models(fallback_provider)
+            if known is not None and fallback_model not in known:
+                continue  # No longer offered by the provider
+            candidates.append((fallback_provider, fallback_model, key))
+        return candidates
+
+    async def first_token(self, provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str) -> LLMAttempt:
+        """Start a request (plus a hedge if it is slow) and return the first to produce a token"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + LLM_FIRST_TOKEN_TIMEOUT
+        hedge_at = started + self.hedge_delay(provider, model) if LLM_HEDGE_ENABLED else None
+        primary = LLMAttempt(provider, model, api_key, system_prompt, user_prompt)
+        attempts = [primary]
+        error = None
+        try:
+            while attempts:
+                wake_at = deadline if hedge_at is None else min(hedge_at, deadline)
+                await asyncio.wait(
+                    [attempt.first_token for attempt in attempts],
+                    timeout=max(0.0, wake_at - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for attempt in [attempt for attempt in attempts if attempt.first_token.done()]:
+                    attempts.remove(attempt)
+                    if attempt.first_token.exception() is not None:
+                        error = attempt.first_token.exception()
+                        continue
+                    self.first_token_latency.setdefault(
+                        (provider, model), deque(maxlen=LLM_LATENCY_WINDOW)
+                    ).append(loop.time() - started)
+                    if attempt is not primary:
+                        self.hedge_wins += 1
+                    return attempt
+                if not attempts:
+                    break
+                if hedge_at is not None and loop.time() >= hedge_at:
+                    hedge_at = None
+                    self.hedges += 1
+                    llm_hedges_total.inc(**llm_metric_labels(provider, model))
+                    trace_mark("llm_hedge")
+                    attempts.append(LLMAttempt(provider, model, api_key, system_prompt, user_prompt))
+                elif loop.time() >= deadline:
+                    self.timeouts += 1
+                    raise asyncio.TimeoutError(f"No first token from {provider}/{model} within {LLM_FIRST_TOKEN_TIMEOUT}s")
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.task.cancel()
+
+    async def stream(self, provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+        """Stream an answer from the first candidate model that starts producing tokens"""
+        error = None
+        busy_providers = set()
+        for index, (candidate_provider, candidate_model, candidate_key) in enumerate(
+            self.candidates(provider, model, api_key)
+        ):
+            if candidate_provider in busy_providers:
+                continue
+            if index:
+                self.fallbacks += 1
+                llm_fallbacks_total.inc(**llm_metric_labels(candidate_provider, candidate_model))
+                trace_mark("llm_fallback")
+                print(f"LLM falling back to {candidate_provider}/{candidate_model}: {error}")
+            for attempt_number in range(max(1, LLM_MAX_ATTEMPTS)):
+                if attempt_number:
+                    self.retries += 1
+                    llm_retries_total.inc(**llm_metric_labels(candidate_provider, candidate_model))
+                    backoff = min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** (attempt_number - 1))
+                    await asyncio.sleep(random.uniform(0, backoff))
+                try:
+                    attempt = await self.first_token(
+                        candidate_provider, candidate_model, candidate_key, system_prompt, user_prompt
+                    )
+                except UpstreamBusy as e:
+                    error = e
+                    busy_providers.add(candidate_provider)
+                    break
+                except ValueError:
+                    raise  # Unsupported provider or bad request, retrying will not help
+                except Exception as e:
+                    if not is_upstream_error(e):
+                        raise  # A bug in the adapter, another attempt or provider would only hide it
+                    error = e
+                    print(f"LLM call to {candidate_provider}/{candidate_model} failed: {e}")
+                    if not is_retryable(e):
+                        break
+                    continue
+                # Once tokens flow the answer is committed to this model;
+                # a failure now is raised instead of repeating the answer
+                async for token in attempt.remaining():
+                    yield token
+                return
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            "first_token_timeout": LLM_FIRST_TOKEN_TIMEOUT,
+            "max_attempts": LLM_MAX_ATTEMPTS,
+            "hedge_enabled": LLM_HEDGE_ENABLED,
+            "hedge_delays": {
+                f"{provider}/{model}": round(self.hedge_delay(provider, model), 3)
+                for provider, model in self.first_token_latency
+            },
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "fallbacks": self.fallbacks,
+        }
+
+llm_policy = LLMPolicy()
+
+# Helper function to stream LLM tokens under the call policy
+async def call_llm_stream_with_fallback(provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str) -> AsyncIterator[str]:
+    """
+    Stream LLM tokens under the retry/hedge/fallback policy.
+
+    Retries and fallbacks only happen while nothing has been yielded yet;
+    once text has been sent to the client (and possibly spoken) an error is
+    re-raised instead of repeating the answer.
+    """
+    labels = {"endpoint": current_endpoint.get(), **llm_metric_labels(provider, model)}
+    started = time.perf_counter()
+    streamed = False
+    try:
+        async for content in llm_policy.stream(provider, model, api_key, system_prompt, user_prompt):
+            if not streamed:
+                llm_first_token_seconds.observe(time.perf_counter() - started, **labels)
+                trace_mark("llm_first_token")
+            streamed = True
+            yield content
+    finally:
+        llm_seconds.observe(time.perf_counter() - started, **labels)
+        trace_mark("llm_done")
+
+# edge-tts engine configuration
+# edge-tts opens one WebSocket per synthesis and the service does not accept
+# several requests on one socket, so the engine keeps everything around the
+# socket warm instead: one shared aiohttp connector with a long-lived DNS
+# cache, a startup probe that also settles edge-tts' clock skew correction,
+# and periodic health checks that rebuild the connector when the service
+# keeps failing.
+EDGE_TTS_DNS_TTL = int(os.getenv("EDGE_TTS_DNS_TTL", "300"))
+EDGE_TTS_CONNECT_TIMEOUT = int(os.getenv("EDGE_TTS_CONNECT_TIMEOUT", "10"))
+EDGE_TTS_RECEIVE_TIMEOUT = int(os.getenv("EDGE_TTS_RECEIVE_TIMEOUT", "60"))
+# Seconds between health probes; 0 disables the probe and the startup warm-up
+EDGE_TTS_HEALTH_INTERVAL = int(os.getenv("EDGE_TTS_HEALTH_INTERVAL", "120"))
+EDGE_TTS_HEALTH_VOICE = os.getenv("EDGE_TTS_HEALTH_VOICE", "en-HK-SamNeural")
+# Retries of a synthesis whose connection failed before any audio arrived
+EDGE_TTS_RETRIES = int(os.getenv("EDGE_TTS_RETRIES", "1"))
+# Consecutive connection failures after which the connector is rebuilt
+EDGE_TTS_RECONNECT_AFTER = int(os.getenv("EDGE_TTS_RECONNECT_AFTER", "3"))
+# Alternative synthesis WebSocket, e.g. the stub in benchmarks/ (keep the
+# ?TrustedClientToken= query, edge-tts appends its own parameters with &)
+EDGE_TTS_WSS_URL = os.getenv("EDGE_TTS_WSS_URL", "")
+if EDGE_TTS_WSS_URL:
+    edge_tts.communicate.WSS_URL = EDGE_TTS_WSS_URL
+
+EDGE_TTS_CONNECTION_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, edge_tts.exceptions.WebSocketError)
+
+class SharedConnector(aiohttp.TCPConnector):
+    """TCPConnector that outlives the short-lived sessions edge-tts creates"""
+
+    async def close(self, *args, **kwargs):
+        # Every edge_tts.Communicate closes its session, and with it the connector
+        return
+
+    async def shutdown(self):
+        await super().close()
+
+class SynthesisEngine:
+    """Runs edge-tts syntheses on a shared, health-checked connector"""
+
+    def __init__(self):
+        self._connector: Optional[SharedConnector] = None
+        self._retired: set = set()
+        self._probe: Optional[asyncio.Task] = None
+        self.healthy: Optional[bool] = None
+        self.last_check = 0.0
+        self.last_check_seconds: Optional[float] = None
+        self.last_error = ""
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.reconnects = 0
+
+    @property
+    def connector(self) -> SharedConnector:
+        if self._connector is None or self._connector.closed:
+            self._connector = SharedConnector(ttl_dns_cache=EDGE_TTS_DNS_TTL)
+        return self._connector
+
+    def communicate(self, text: str, voice: str, rate: str = "+0%", pitch: str = "+0Hz", volume: str = "+0%") -> edge_tts.Communicate:
+        return edge_tts.Communicate(
+            text=text,
+            voice=voice,
+            rate=rate,
+            pitch=pitch,
+            volume=volume,
+            # edge-tts 7 reports sentence boundaries unless asked for words
+            boundary="WordBoundary",
+            connector=self.connector,
+            connect_timeout=EDGE_TTS_CONNECT_TIMEOUT,
+            receive_timeout=EDGE_TTS_RECEIVE_TIMEOUT
+        )
+
+    async def stream(self, text: str, voice: str, rate: str = "+0%", pitch: str = "+0Hz", volume: str = "+0%") -> AsyncIterator[dict]:
+        """Yield edge-tts chunks, retrying connection failures that happen before any audio"""
+        self.requests += 1
+        attempt = 0
+        while True:
+            received = False
+            try:
+                async for chunk in self.communicate(text, voice, rate, pitch, volume).stream():
+                    received = True
+                    yield chunk
+            except EDGE_TTS_CONNECTION_ERRORS as e:
+                await self._failed(e)
+                if received or attempt >= EDGE_TTS_RETRIES:
+                    raise
+                attempt += 1
+                self.retries += 1
+                continue
+            self._succeeded()
+            return
+
+    def _succeeded(self):
+        self.consecutive_failures = 0
+        self.healthy = True
+
+    async def _failed(self, error: Exception):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        if self.consecutive_failures >= EDGE_TTS_RECONNECT_AFTER:
+            self.healthy = False
+            await self.reconnect()
+
+    async def reconnect(self):
+        """Start over with a new connector and DNS cache"""
+        old, self._connector = self._connector, None
+        self.consecutive_failures = 0
+        self.reconnects += 1
+        tts_reconnects_total.inc()
+        print(f"edge-tts connector rebuilt after repeated failures ({self.last_error})")
+        if old is not None:
+            # Syntheses still running on the old connector get to finish first
+            self._retired.add(old)
+            asyncio.create_task(self._shutdown_later(old))
+
+    async def _shutdown_later(self, connector: SharedConnector):
+        await asyncio.sleep(EDGE_TTS_CONNECT_TIMEOUT + EDGE_TTS_RECEIVE_TIMEOUT)
+        self._retired.discard(connector)
+        await connector.shutdown()
+
+    async def check(self) -> bool:
+        """Synthesize a short probe; the first one warms DNS and the clock skew correction"""
+        started = time.perf_counter()
+        try:
+            audio = 0
+            async for chunk in self.stream("OK", EDGE_TTS_HEALTH_VOICE):
+                if chunk["type"] == "audio":
+                    audio += len(chunk["data"])
+            if not audio:
+                raise edge_tts.exceptions.NoAudioReceived("Health probe returned no audio")
+            self._succeeded()
+        except Exception as e:
+            self.healthy = False
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"edge-tts health check failed: {self.last_error}")
+        self.last_check = time.time()
+        self.last_check_seconds = time.perf_counter() - started
+        return bool(self.healthy)
+
+    async def warm(self):
+        """Probe unless a recent probe found the service reachable, sharing probes in flight"""
+        if self._probe is None or self._probe.done():
+            if self.healthy and time.time() - self.last_check < EDGE_TTS_DNS_TTL:
+                return
+            if self.healthy is False and time.time() - self.last_check < EDGE_TTS_CONNECT_TIMEOUT:
+                return
+            self._probe = asyncio.create_task(self.check())
+        # A cancelled request must not cancel the probe other requests wait for
+        await asyncio.shield(self._probe)
+
+    async def run_health_checks(self, interval: int = EDGE_TTS_HEALTH_INTERVAL):
+        while True:
+            await self.check()
+            await asyncio.sleep(interval)
+
+    async def aclose(self):
+        for connector in [self._connector, *self._retired]:
+            if connector is not None:
+                await connector.shutdown()
+        self._connector = None
+        self._retired.clear()
+
+    def stats(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "last_check": self.last_check,
+            "last_check_seconds": self.last_check_seconds,
+            "last_error": self.last_error,
+            "requests": self.requests,
+            "failures": self.failures,
+            "retries": self.retries,
+            "reconnects": self.reconnects,
+            "dns_cache_ttl": EDGE_TTS_DNS_TTL,
+        }
+
+tts_reconnects_total = metrics.add(Counter("tts_synthesis_reconnects_total", "Times the edge-tts connector was rebuilt"))
+synthesis_engine = SynthesisEngine()
+
+# TTS pipeline configuration
+# Number of sentence segments synthesized concurrently while the LLM streams
+TTS_PIPELINE_CONCURRENCY = int(os.getenv("TTS_PIPELINE_CONCURRENCY", "3"))
+# Segments shorter than this are held back so tiny fragments are not spoken alone
+TTS_SEGMENT_MIN_CHARS = int(os.getenv("TTS_SEGMENT_MIN_CHARS", "20"))
+# Segments longer than this are split at the last clause break or space
+TTS_SEGMENT_MAX_CHARS = int(os.getenv("TTS_SEGMENT_MAX_CHARS", "200"))
+
+# edge-tts produces 24 kHz / 48 kbps CBR MP3; boundary offsets use 100ns ticks
+MP3_BYTES_PER_SECOND = 48000 // 8
+TICKS_PER_SECOND = 10_000_000
+
+def audio_duration_ticks(num_bytes: int) -> int:
+    """Convert a number of MP3 bytes into edge-tts offset ticks"""
+    return num_bytes * TICKS_PER_SECOND // MP3_BYTES_PER_SECOND
+
+# Helper function to stream audio chunks for a piece of text
+async def tts_stream(text: str, voice: str, rate: str = "+0%", pitch: str = "+0Hz", volume: str = "+0%") -> AsyncIterator[dict]:
+    """Synthesize text with edge-tts and yield its audio/boundary chunks"""
+    async with upstream_limits.get("edge-tts").slot():
+        endpoint = current_endpoint.get()
+        started = time.perf_counter()
+        first_audio = True
+        try:
+            async for chunk in synthesis_engine.stream(text, voice, rate, pitch, volume):
+                if first_audio and chunk["type"] == "audio":
+                    tts_first_audio_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+                    first_audio = False
+                yield chunk
+        finally:
+            tts_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+
+# Output format configuration
+# edge-tts always returns 24 kHz / 48 kbps mono MP3. The other formats, named
+# after the speech service's own output formats, are produced from it with
+# ffmpeg and are only offered when ffmpeg is installed.
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+FFMPEG_AVAILABLE = shutil.which(FFMPEG_PATH) is not None
+OPUS_BITRATE = os.getenv("OPUS_BITRATE", "24k")
+DEFAULT_OUTPUT_FORMAT = "audio-24khz-48kbitrate-mono-mp3"
+
+class OutputFormat:
+    """Media type, file extension and ffmpeg encoder arguments of an output format"""
+
+    def __init__(self, name: str, media_type: str, extension: str, ffmpeg_args: tuple = ()):
+        self.name = name
+        self.media_type = media_type
+        self.extension = extension
+        self.ffmpeg_args = ffmpeg_args
+
+    @property
+    def native(self) -> bool:
+        return not self.ffmpeg_args
+
+def _opus(container: str, sample_rate: int) -> tuple:
+    return ("-ac", "1", "-ar", str(sample_rate), "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip", "-f", container)
+
+OUTPUT_FORMATS: Dict[str, OutputFormat] = {
+    output_format.name: output_format for output_format in (
+        OutputFormat(DEFAULT_OUTPUT_FORMAT, "audio/mpeg", "mp3"),
+        OutputFormat("audio-16khz-32kbitrate-mono-mp3", "audio/mpeg", "mp3",
+                     ("-ac", "1", "-ar", "16000", "-c:a", "libmp3lame", "-b:a", "32k", "-f", "mp3")),
+        OutputFormat("ogg-16khz-16bit-mono-opus", "audio/ogg", "ogg", _opus("ogg", 16000)),
+        OutputFormat("ogg-24khz-16bit-mono-opus", "audio/ogg", "ogg", _opus("ogg", 24000)),
+        OutputFormat("webm-16khz-16bit-mono-opus", "audio/webm", "webm", _opus("webm", 16000)),
+        OutputFormat("webm-24khz-16bit-mono-opus", "audio/webm", "webm", _opus("webm", 24000)),
+    )
+}
+# Short names clients can use instead
+OUTPUT_FORMAT_ALIASES = {
+    "mp3": DEFAULT_OUTPUT_FORMAT,
+    "mp3-low": "audio-16khz-32kbitrate-mono-mp3",
+    "ogg": "ogg-24khz-16bit-mono-opus",
+    "webm": "webm-24khz-16bit-mono-opus",
+    "opus": "webm-24khz-16bit-mono-opus",
+}
+AUDIO_EXTENSIONS = {output_format.extension for output_format in OUTPUT_FORMATS.values()}
+AUDIO_MEDIA_TYPES = {output_format.extension: output_format.media_type for output_format in OUTPUT_FORMATS.values()}
+
+def validate_output_format(output_format: str) -> str:
+    """Canonical name of a requested output format"""
+    name = OUTPUT_FORMAT_ALIASES.get(output_format, output_format)
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output_format: {output_format}. Use one of {', '.join([*OUTPUT_FORMATS, *OUTPUT_FORMAT_ALIASES])}")
+    if not OUTPUT_FORMATS[name].native and not FFMPEG_AVAILABLE:
+        raise ValueError(f"output_format {output_format} is not available on this server (ffmpeg is not installed)")
+    return name
+
+def audio_filename(output_format: str = DEFAULT_OUTPUT_FORMAT) -> str:
+    return f"{uuid.uuid4()}.{OUTPUT_FORMATS[output_format].extension}"
+
+def audio_media_type(filename: str) -> str:
+    return AUDIO_MEDIA_TYPES.get(filename.rsplit(".", 1)[-1], "audio/mpeg")
+
+async def _start_ffmpeg(output_format: OutputFormat):
+    return await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-f", "mp3", "-i", "pipe:0",
+        *output_format.ffmpeg_args, "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+async def transcode(audio: bytes, output_format: str) -> bytes:
+    """Convert complete edge-tts MP3 audio to output_format"""
+    target = OUTPUT_FORMATS[output_format]
+    if target.native or not audio:
+        return audio
+    process = await _start_ffmpeg(target)
+    stdout, stderr = await process.communicate(audio)
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace').strip()}")
+    return stdout
+
+async def transcode_stream(chunks: AsyncIterator[dict], output_format: str) -> AsyncIterator[dict]:
+    """Transcode the audio of an edge-tts style chunk stream as it flows; other chunks pass through"""
+    target = OUTPUT_FORMATS[output_format]
+    if target.native:
+        async for chunk in chunks:
+            yield chunk
+        return
+
+    process = await _start_ffmpeg(target)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def feed():
+        try:
+            async for chunk in chunks:
+                if chunk["type"] == "audio":
+                    process.stdin.write(chunk["data"])
+                    await process.stdin.drain()
+                else:
+                    await queue.put(chunk)
+        finally:
+            process.stdin.close()
+
+    async def read():
+        while True:
+            data = await process.stdout.read(64 * 1024)
+            if not data:
+                return
+            await queue.put({"type": "audio", "data": data})
+
+    tasks = [asyncio.create_task(feed()), asyncio.create_task(read())]
+    done = asyncio.gather(*tasks)
+    done.add_done_callback(lambda _: queue.put_nowait(None))
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        await done
+        if await process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed: {(await process.stderr.read()).decode(errors='replace').strip()}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        if done.done() and not done.cancelled():
+            done.exception()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+# Synthesis cache configuration
+# Synthesized audio is content-addressed by (text, voice, rate, pitch, volume)
+# plus the output format when it is not edge-tts' own MP3
+SYNTHESIS_CACHE_ENABLED = os.getenv("SYNTHESIS_CACHE_ENABLED", "true").lower() == "true"
+SYNTHESIS_CACHE_DIR = os.getenv("SYNTHESIS_CACHE_DIR", "/tmp/tts_cache")
+SYNTHESIS_CACHE_MAX_BYTES = int(os.getenv("SYNTHESIS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+SYNTHESIS_CACHE_MEMORY_BYTES = int(os.getenv("SYNTHESIS_CACHE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+
+class SynthesizedAudio:
+    """Audio bytes plus the boundary events edge-tts produced for them"""
+
+    def __init__(self, audio: bytes, boundaries: list):
+        self.audio = audio
+        self.boundaries = boundaries
+
+    @property
+    def size(self) -> int:
+        return len(self.audio)
+
+    def chunks(self) -> List[dict]:
+        """Replay the audio in the same chunk format as edge-tts"""
+        return [{"type": "audio", "data": self.audio}] + [dict(boundary) for boundary in self.boundaries]
+
+def synthesis_cache_key(text: str, voice: str, rate: str, pitch: str, volume: str, output_format: str = DEFAULT_OUTPUT_FORMAT) -> str:
+    """Content address of a synthesis request"""
+    parts = [text, voice, rate, pitch, volume]
+    if output_format != DEFAULT_OUTPUT_FORMAT:
+        parts.append(output_format)
+    payload = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class SynthesisCache:
+    """
+    Two-tier cache of synthesized speech.
+
+    A small in-memory LRU holds hot entries; every entry is also written to
+    disk (audio + JSON boundaries) under a size-bounded LRU. Transcoded
+    formats are cached next to the MP3 they were made from. Concurrent
+    requests for the same key are coalesced so only one of them reaches
+    edge-tts (single-flight).
+    """
+
+    def __init__(self, directory: str, max_disk_bytes: int, max_memory_bytes: int, enabled: bool = True):
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.enabled = enabled
+        self.memory: "OrderedDict[str, SynthesizedAudio]" = OrderedDict()
+        self.memory_bytes = 0
+        self.disk: "OrderedDict[str, int]" = OrderedDict()
+        self.disk_bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def _load_index(self):
+        """Rebuild the disk LRU from what a previous process left behind"""
+        entries = []
+        for name in os.listdir(self.directory):
+            key, _, extension = name.partition(".")
+            if extension not in AUDIO_EXTENSIONS:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_bytes += size
+        self._evict_disk()
+
+    def _remember(self, key: str, entry: SynthesizedAudio):
+        if entry.size > self.max_memory_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key).size
+        self.memory[key] = entry
+        self.memory_bytes += entry.size
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.size
+
+    def _evict_disk(self):
+        while self.disk_bytes > self.max_disk_bytes and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            for extension in (*AUDIO_EXTENSIONS, "json"):
+                try:
+                    os.remove(self._path(key, extension))
+                except FileNotFoundError:
+                    pass
+
+    def _read(self, key: str, extension: str) -> SynthesizedAudio:
+        with open(self._path(key, extension), "rb") as audio_file:
+            audio = audio_file.read()
+        try:
+            with open(self._path(key, "json"), "r", encoding="utf-8") as boundaries_file:
+                boundaries = json.load(boundaries_file)
+        except FileNotFoundError:
+            boundaries = []
+        os.utime(self._path(key, extension))
+        return SynthesizedAudio(audio, boundaries)
+
+    def _write(self, key: str, entry: SynthesizedAudio, audio_extension: str):
+        # Write the boundaries first so a visible audio file always has its metadata
+        for extension, mode, content in (
+            ("json", "w", json.dumps(entry.boundaries)),
+            (audio_extension, "wb", entry.audio),
+        ):
+            temp_path = self._path(key, f"{extension}.{uuid.uuid4().hex}.tmp")
+            with open(temp_path, mode) as cache_file:
+                cache_file.write(content)
+            os.replace(temp_path, self._path(key, extension))
+
+    async def get(self, key: str, extension: str = "mp3") -> Optional[SynthesizedAudio]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry
+        if key not in self.disk and not (shared_state and os.path.exists(self._path(key, extension))):
+            return None
+        try:
+            entry = await asyncio.to_thread(self._read, key, extension)
+        except FileNotFoundError:
+            self.disk_bytes -= self.disk.pop(key, 0)
+            return None
+        if key not in self.disk:
+            # Written by another worker; adopt it into this worker's LRU
+            self.disk[key] = entry.size
+            self.disk_bytes += entry.size
+        self.disk.move_to_end(key)
+        self._remember(key, entry)
+        return entry
+
+    async def put(self, key: str, entry: SynthesizedAudio, extension: str = "mp3"):
+        self._remember(key, entry)
+        try:
+            await asyncio.to_thread(self._write, key, entry, extension)
+        except OSError as e:
+            print(f"Error writing synthesis cache entry {key}: {e}")
+            return
+        self.disk_bytes -= self.disk.pop(key, 0)
+        self.disk[key] = entry.size
+        self.disk_bytes += entry.size
+        self._evict_disk()
+
+    async def stream(self, text: str, voice: str, rate: str = "+0%", pitch: str = "+0Hz", volume: str = "+0%") -> AsyncIterator[dict]:
+        """Yield edge-tts style chunks, served from cache whenever possible"""
+        source = long_text_stream if is_long_text(text) else tts_stream
+        if not self.enabled:
+            async for chunk in source(text, voice, rate, pitch, volume):
+                yield chunk
+            return
+
+        key = synthesis_cache_key(text, voice, rate, pitch, volume)
+        entry = await self.get(key)
+        if entry is None and key in self.inflight:
+            # Someone is already synthesizing this; wait for their result
+            self.coalesced += 1
+            entry = await asyncio.shield(self.inflight[key])
+        if entry is not None:
+            self.hits += 1
+            for chunk in entry.chunks():
+                yield chunk
+            return
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        audio = bytearray()
+        boundaries = []
+        try:
+            async for chunk in source(text, voice, rate, pitch, volume):
+                if chunk["type"] == "audio":
+                    audio += chunk["data"]
+                else:
+                    boundaries.append(chunk)
+                yield chunk
+            entry = SynthesizedAudio(bytes(audio), boundaries)
+            await self.put(key, entry)
+        finally:
+            self.inflight.pop(key, None)
+            # Waiters fall back to their own synthesis if this one failed
+            if not future.done():
+                future.set_result(entry)
+
+    async def synthesize(self, text: str, voice: str, rate: str = "+0%", pitch: str = "+0Hz", volume: str = "+0%",
+                         output_format: str = DEFAULT_OUTPUT_FORMAT) -> SynthesizedAudio:
+        """Return the complete audio for a text, from cache when possible"""
+        target = OUTPUT_FORMATS[output_format]
+        if not target.native:
+            key = synthesis_cache_key(text, voice, rate, pitch, volume, output_format)
+            entry = await self.get(key, target.extension) if self.enabled else None
+            if entry is not None:
+                self.hits += 1
+                return entry
+            source = await self.synthesize(text, voice, rate, pitch, volume)
+            entry = SynthesizedAudio(await transcode(source.audio, output_format), source.boundaries)
+            if self.enabled:
+                await self.put(key, entry, target.extension)
+            return entry
+
+        audio = bytearray()
+        boundaries = []
+        async for chunk in self.stream(text, voice, rate, pitch, volume):
+            if chunk["type"] == "audio":
+                audio += chunk["data"]
+            else:
+                boundaries.append(chunk)
+        return SynthesizedAudio(bytes(audio), boundaries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "max_memory_bytes": self.max_memory_bytes,
+            "disk_entries": len(self.disk),
+            "disk_bytes": self.disk_bytes,
+            "max_disk_bytes": self.max_disk_bytes,
+        }
+
+synthesis_cache = SynthesisCache(
+    SYNTHESIS_CACHE_DIR,
+    max_disk_bytes=SYNTHESIS_CACHE_MAX_BYTES,
+    max_memory_bytes=SYNTHESIS_CACHE_MEMORY_BYTES,
+    enabled=SYNTHESIS_CACHE_ENABLED
+)
+
+_SENTENCE_END = re.compile(r'[.!?\u3002\uff01\uff1f\u2026]+["\'\)\]\u201d\u2019]*\s+|\n+')
+_CLAUSE_BREAK = re.compile(r'[,;:\u3001\uff0c\uff1b\uff1a]\s+')
+
+class SentenceSegmenter:
+    """Incrementally split streamed text into speakable sentence/clause segments"""
+
+    def __init__(self, min_chars: int = TTS_SEGMENT_MIN_CHARS, max_chars: int = TTS_SEGMENT_MAX_CHARS):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    def _next_cut(self) -> int:
+        # Prefer a sentence end once the segment is long enough to be worth speaking
+        for match in _SENTENCE_END.finditer(self.buffer):
+            if len(self.buffer[:match.start()].strip()) >= self.min_chars:
+                return match.end()
+        if len(self.buffer) <= self.max_chars:
+            return 0
+        # Too long without a sentence end: cut at the last clause break, then space
+        head = self.buffer[:self.max_chars]
+        clause_breaks = list(_CLAUSE_BREAK.finditer(head))
+        if clause_breaks:
+            return clause_breaks[-1].end()
+        space = head.rfind(" ")
+        return space + 1 if space > 0 else self.max_chars
+
+    def feed(self, text: str) -> List[str]:
+        """Add streamed text and return any segments that are now complete"""
+        self.buffer += text
+        segments = []
+        while True:
+            cut = self._next_cut()
+            if not cut:
+                break
+            segment, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if segment:
+                segments.append(segment)
+        return segments
+
+    def flush(self) -> List[str]:
+        """Return whatever text is left once the stream has ended"""
+        segment, self.buffer = self.buffer.strip(), ""
+        return [segment] if segment else []
+
+def is_speakable(text: str) -> bool:
+    """edge-tts returns no audio for text without letters or digits"""
+    return any(char.isalnum() for char in text)
+
+# Long text configuration
+# Texts longer than LONG_TEXT_MIN_CHARS are split at sentence/paragraph breaks
+# into segments of about LONG_TEXT_SEGMENT_CHARS that are synthesized in
+# parallel and stitched back together in order, so a long read neither takes
+# one upstream call's time end to end nor restarts from scratch on a hiccup.
+LONG_TEXT_MIN_CHARS = int(os.getenv("LONG_TEXT_MIN_CHARS", "3000"))  # 0 disables
+LONG_TEXT_SEGMENT_CHARS = int(os.getenv("LONG_TEXT_SEGMENT_CHARS", "1000"))
+LONG_TEXT_CONCURRENCY = int(os.getenv("LONG_TEXT_CONCURRENCY", "4"))
+LONG_TEXT_RETRIES = int(os.getenv("LONG_TEXT_RETRIES", "2"))  # per segment
+LONG_TEXT_RETRY_DELAY = float(os.getenv("LONG_TEXT_RETRY_DELAY", "1.0"))
+
+long_text_retries_total = metrics.add(Counter("tts_long_text_segment_retries_total", "Long text segments synthesized again after a failure"))
+
+def is_long_text(text: str) -> bool:
+    return LONG_TEXT_MIN_CHARS > 0 and len(text) > LONG_TEXT_MIN_CHARS
+
+def split_long_text(text: str) -> List[str]:
+    """Sentence/paragraph aligned segments of roughly LONG_TEXT_SEGMENT_CHARS"""
+    segmenter = SentenceSegmenter(min_chars=LONG_TEXT_SEGMENT_CHARS, max_chars=2 * LONG_TEXT_SEGMENT_CHARS)
+    return [segment for segment in segmenter.feed(text) + segmenter.flush() if is_speakable(segment)]
+
+async def synthesize_segment(text: str, voice: str, rate: str, pitch: str, volume: str) -> SynthesizedAudio:
+    """Synthesize one segment completely, retrying failures with a growing delay"""
+    for attempt in range(LONG_TEXT_RETRIES + 1):
+        audio = bytearray()
+        boundaries = []
+        try:
+            async for chunk in tts_stream(text, voice, rate, pitch, volume):
+                if chunk["type"] == "audio":
+                    audio += chunk["data"]
+                else:
+                    boundaries.append(chunk)
+            return SynthesizedAudio(bytes(audio), boundaries)
+        except Exception as e:
+            if attempt == LONG_TEXT_RETRIES:
+                raise
+            long_text_retries_total.inc()
+            print(f"Long text segment failed (attempt {attempt + 1}), retrying: {e}")
+            delay = e.retry_after if isinstance(e, UpstreamBusy) else LONG_TEXT_RETRY_DELAY * (attempt + 1)
+            await asyncio.sleep(delay)
+
+async def long_text_stream(text: str, voice: str, rate: str = "+0%", pitch: str = "+0Hz", volume: str = "+0%") -> AsyncIterator[dict]:
+    """
+    Synthesize a long text as parallel segments.
+
+    Yields edge-tts style chunks in text order as soon as every segment
+    before them is done; boundary offsets are shifted by the audio that
+    precedes their segment.
+    """
+    segments = split_long_text(text)
+    semaphore = asyncio.Semaphore(max(1, LONG_TEXT_CONCURRENCY))
+
+    async def run(segment: str) -> SynthesizedAudio:
+        async with semaphore:
+            return await synthesize_segment(segment, voice, rate, pitch, volume)
+
+    tasks = [asyncio.create_task(run(segment)) for segment in segments]
+    offset = 0
+    try:
+        for task in tasks:
+            result = await task
+            yield {"type": "audio", "data": result.audio}
+            for boundary in result.boundaries:
+                boundary = dict(boundary)
+                if "offset" in boundary:
+                    boundary["offset"] += offset
+                yield boundary
+            # edge-tts MP3 is CBR, so the byte count gives the duration
+            offset += audio_duration_ticks(len(result.audio))
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# Sentinel marking the end of a pipeline queue
+_PIPELINE_DONE = object()
+
+async def speak_token_stream(
+    token_stream: AsyncIterator[str],
+    voice: str,
+    rate: str = "+0%",
+    pitch: str = "+0Hz",
+    volume: str = "+0%",
+    concurrency: int = TTS_PIPELINE_CONCURRENCY
+) -> AsyncIterator[dict]:
+    """
+    Speak an LLM token stream sentence by sentence while it is still generating.
+
+    Tokens are split into segments as soon as a sentence (or long clause) is
+    complete, each segment is synthesized concurrently (at most `concurrency`
+    at a time) and the audio is emitted strictly in segment order.
+
+    Yields dictionaries with a "type" of:
+        text         -- a token from the LLM ("content")
+        audio        -- MP3 bytes of the current segment ("segment", "data")
+        WordBoundary -- edge-tts boundary with the offset shifted to the whole answer
+        segment_end  -- a segment finished playing out ("segment", "text")
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    segments: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    synth_tasks = []
+
+    async def synthesize(text: str, chunks: asyncio.Queue):
+        async with semaphore:
+            try:
+                async for chunk in synthesis_cache.stream(text, voice, rate, pitch, volume):
+                    await chunks.put(chunk)
+                await chunks.put(_PIPELINE_DONE)
+            except Exception as e:
+                await chunks.put(e)
+
+    def schedule(text: str):
+        if not is_speakable(text):
+            return
+        chunks: asyncio.Queue = asyncio.Queue()
+        synth_tasks.append(asyncio.create_task(synthesize(text, chunks)))
+        segments.put_nowait((text, chunks))
+
+    async def produce():
+        segmenter = SentenceSegmenter()
+        try:
+            async for token in token_stream:
+                await events.put({"type": "text", "content": token})
+                for text in segmenter.feed(token):
+                    schedule(text)
+            for text in segmenter.flush():
+                schedule(text)
+        except Exception as e:
+            await events.put(e)
+        finally:
+            await segments.put(_PIPELINE_DONE)
+            await events.put(_PIPELINE_DONE)
+
+    async def emit_audio_in_order():
+        offset_shift = 0
+        index = 0
+        try:
+            while True:
+                item = await segments.get()
+                if item is _PIPELINE_DONE:
+                    break
+                text, chunks = item
+                segment_bytes = 0
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is _PIPELINE_DONE:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    if chunk["type"] == "audio":
+                        segment_bytes += len(chunk["data"])
+                        await events.put({"type": "audio", "segment": index, "data": chunk["data"]})
+                    else:
+                        shifted = dict(chunk)
+                        shifted["offset"] = (chunk.get("offset") or 0) + offset_shift
+                        await events.put(shifted)
+                offset_shift += audio_duration_ticks(segment_bytes)
+                await events.put({"type": "segment_end", "segment": index, "text": text})
+                index += 1
+        except Exception as e:
+            await events.put(e)
+        finally:
+            await events.put(_PIPELINE_DONE)
+
+    workers = [asyncio.create_task(produce()), asyncio.create_task(emit_audio_in_order())]
+    try:
+        finished = 0
+        while finished < len(workers):
+            event = await events.get()
+            if event is _PIPELINE_DONE:
+                finished += 1
+            elif isinstance(event, Exception):
+                raise event
+            else:
+                yield event
+    finally:
+        for task in workers + synth_tasks:
+            task.cancel()
+
+# RAG stage graph configuration
+# A RAG request is a small graph of stages: the embedding search, the auth key
+# decrypt and warm-ups of the LLM provider connection and edge-tts start
+# together, and only the LLM call waits for the search. Stage start/end
+# times go on the trace and into tts_rag_stage_seconds.
+RAG_WARMUP_ENABLED = os.getenv("RAG_WARMUP_ENABLED", "true").lower() == "true"
+
+rag_stage_seconds = metrics.add(Histogram("tts_rag_stage_seconds", "RAG pipeline stage latency", ("endpoint", "stage")))
+
+class StageGraph:
+    """Async stages that start as soon as the stages they depend on have finished"""
+
+    def __init__(self, trace: Optional[Trace] = None):
+        self.trace = trace
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def add(self, name: str, stage, after: tuple = (), optional: bool = False):
+        """Schedule stage(*results of after); failures of optional stages are only logged"""
+        dependencies = [self.tasks[dependency] for dependency in after]
+
+        async def run():
+            try:
+                results = [await task for task in dependencies]
+                started = time.perf_counter()
+                try:
+                    return await stage(*results)
+                finally:
+                    rag_stage_seconds.observe(time.perf_counter() - started, endpoint=current_endpoint.get(), stage=name)
+                    if self.trace is not None:
+                        self.trace.stage(name, started)
+            except Exception as e:
+                if not optional:
+                    raise
+                print(f"Optional stage {name} failed: {e}")
+
+        self.tasks[name] = asyncio.create_task(run())
+
+    async def result(self, name: str):
+        return await self.tasks[name]
+
+    def close(self):
+        """Cancel stages nobody waited for and collect errors nobody read"""
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+async def warm_llm_provider(provider: str, api_key: str):
+    await get_llm_provider(provider).warm(api_key)
+
+def start_rag_stages(auth_key: str, query: str, user_hash: str, collection_name: str, top_k: int, provider: str,
+                     keys: Optional[dict] = None) -> StageGraph:
+    """Start the search together with the work that does not depend on it (keys: already decrypted auth_key)"""
+    stages = StageGraph(current_trace.get())
+
+    async def decrypt():
+        return keys if keys is not None else decrypt_auth_key(auth_key)
+
+    # The search goes first so its request is in flight while the rest runs
+    stages.add("search", lambda: search_embeddings(
+        query=query,
+        user_hash=user_hash,
+        collection_name=collection_name,
+        top_k=top_k
+    ))
+    stages.add("auth", decrypt)
+    if RAG_WARMUP_ENABLED:
+        stages.add("llm_warmup", lambda keys: warm_llm_provider(provider, keys["llm_api_key"]), after=("auth",), optional=True)
+        stages.add("tts_warmup", synthesis_engine.warm, optional=True)
+    return stages
+
+# Answer cache configuration
+# Opt-in cache of complete RAG answers (text, document links and audio) so
+# repeated questions skip search, LLM and TTS and replay at full speed.
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "256"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_QUERY_TRAILING = re.compile(r'[\s.!?。！？…]+$')
+
+def normalize_query(query: str) -> str:
+    """Fold case, width and whitespace so near-identical questions share a key"""
+    query = unicodedata.normalize("NFKC", query or "").casefold()
+    query = " ".join(query.split())
+    return _QUERY_TRAILING.sub("", query)
+
+class CachedAnswer:
+    """A finished RAG answer with the audio of each spoken segment"""
+
+    def __init__(self, ai_response: str, document_urls: list, segments: List[tuple]):
+        self.ai_response = ai_response
+        self.document_urls = document_urls
+        self.segments = segments  # [(text, SynthesizedAudio), ...]
+
+    @property
+    def size(self) -> int:
+        return len(self.ai_response.encode("utf-8")) + sum(audio.size for _, audio in self.segments)
+
+    @property
+    def audio(self) -> bytes:
+        return b"".join(audio.audio for _, audio in self.segments)
+
+    async def events(self) -> AsyncIterator[dict]:
+        """Replay the answer in the same event format as speak_token_stream"""
+        yield {"type": "text", "content": self.ai_response}
+        for index, (text, audio) in enumerate(self.segments):
+            yield {"type": "audio", "segment": index, "data": audio.audio}
+            for boundary in audio.boundaries:
+                yield dict(boundary)
+            yield {"type": "segment_end", "segment": index, "text": text}
+
+class AnswerCache:
+    """
+    TTL + LRU cache of complete RAG answers, bounded by entries and bytes.
+
+    Keys are (normalized query, user_hash, collection_name, top_k,
+    instruct hash, provider, model, voice). Entries are dropped per
+    collection when its documents change, like the search cache.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, enabled: bool = True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.total_bytes = 0
+        # Bumped on invalidation so answers already being generated are not stored
+        self.generations: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def key(self, query: str, user_hash: str, collection_name: str, top_k: int,
+            instruct: str, provider: str, model: str, voice: str) -> Optional[tuple]:
+        """Cache key for a request, or None when the cache is disabled"""
+        if not self.enabled:
+            return None
+        instruct_hash = hashlib.sha256((instruct or "").encode("utf-8")).hexdigest()
+        return (normalize_query(query), user_hash, collection_name, top_k, instruct_hash, provider, model, voice)
+
+    def get(self, key: Optional[tuple]) -> Optional[CachedAnswer]:
+        if key is None:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires_at, answer = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return answer
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def generation(self, collection_name: str) -> int:
+        return self.generations.get(collection_name, 0)
+
+    def put(self, key: tuple, generation: int, answer: CachedAnswer):
+        if self.generation(key[2]) != generation or answer.size > self.max_bytes:
+            return
+        self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, answer)
+        self.total_bytes += answer.size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1].size
+
+    async def record(self, key: Optional[tuple], generation: int, document_urls: list,
+                     events: AsyncIterator[dict]) -> AsyncIterator[dict]:
+        """Pass pipeline events through and store the answer once it completes"""
+        ai_response = ""
+        segments = []
+        audio = bytearray()
+        boundaries = []
+        async for event in events:
+            if key is not None:
+                if event["type"] == "text":
+                    ai_response += event["content"]
+                elif event["type"] == "audio":
+                    audio += event["data"]
+                elif event["type"] == "segment_end":
+                    segments.append((event["text"], SynthesizedAudio(bytes(audio), boundaries)))
+                    audio = bytearray()
+                    boundaries = []
+                else:
+                    boundaries.append(dict(event))
+            yield event
+        if key is not None and ai_response:
+            self.put(key, generation, CachedAnswer(ai_response, document_urls, segments))
+
+    def invalidate(self, collection_name: str, user_hash: Optional[str] = None) -> int:
+        """Drop cached answers for a collection (optionally only for one user)"""
+        self.generations[collection_name] = self.generation(collection_name) + 1
+        stale = [
+            key for key in self.entries
+            if key[2] == collection_name and (user_hash is None or key[1] == user_hash)
+        ]
+        for key in stale:
+            self._remove(key)
+        self.invalidations += 1
+        return len(stale)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+answer_cache = AnswerCache(
+    ANSWER_CACHE_TTL,
+    ANSWER_CACHE_MAX_ENTRIES,
+    ANSWER_CACHE_MAX_BYTES,
+    enabled=ANSWER_CACHE_ENABLED
+)
+
+def invalidate_cached_collection(collection_name: str, user_hash: Optional[str] = None) -> dict:
+    """Drop this worker's cached search results and answers for a collection"""
+    return {
+        "search": search_cache.invalidate(collection_name, user_hash),
+        "answers": answer_cache.invalidate(collection_name, user_hash)
+    }
+
+# Voice catalogue configuration
+# Loaded from the bundled voices.json at startup and refreshed from edge-tts
+# in the background so requests never wait on the upstream voice list.
+VOICES_FILE = os.getenv("VOICES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "voices.json"))
+VOICE_CATALOGUE_REFRESH = os.getenv("VOICE_CATALOGUE_REFRESH", "true").lower() == "true"
+VOICE_CATALOGUE_TTL = int(os.getenv("VOICE_CATALOGUE_TTL", str(24 * 3600)))
+
+class VoiceCatalogue:
+    """In-memory voice list indexed by ShortName, locale and gender"""
+
+    def __init__(self):
+        self.voices: List[dict] = []
+        self.by_name: Dict[str, dict] = {}
+        self.by_locale: Dict[str, List[dict]] = {}
+        self.by_gender: Dict[str, List[dict]] = {}
+        self.etag = ""
+        self.source = ""
+        self.loaded_at = 0.0
+        self._gzipped_all: Optional[bytes] = None
+
+    def load(self, voices: List[dict], source: str):
+        by_name = {}
+        by_locale: Dict[str, List[dict]] = {}
+        by_gender: Dict[str, List[dict]] = {}
+        for voice in voices:
+            for name in (voice.get("ShortName"), voice.get("Name")):
+                if name:
+                    by_name[name] = voice
+            by_locale.setdefault((voice.get("Locale") or "").lower(), []).append(voice)
+            by_gender.setdefault((voice.get("Gender") or "").lower(), []).append(voice)
+        payload = json.dumps(voices, sort_keys=True).encode("utf-8")
+        self.voices = voices
+        self.by_name = by_name
+        self.by_locale = by_locale
+        self.by_gender = by_gender
+        self.etag = hashlib.sha256(payload).hexdigest()[:32]
+        self.source = source
+        self.loaded_at = time.time()
+        self._gzipped_all = None
+
+    def load_file(self, path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as voices_file:
+                data = json.load(voices_file)
+            self.load(data["voices"] if isinstance(data, dict) else data, source="file")
+        except Exception as e:
+            print(f"Could not load voice catalogue from {path}: {e}")
+
+    async def refresh(self):
+        """Reload the catalogue from edge-tts, keeping the old one on failure"""
+        try:
+            voices = await edge_tts.list_voices()
+        except Exception as e:
+            print(f"Voice catalogue refresh failed: {e}")
+            return
+        if voices:
+            self.load(voices, source="edge-tts")
+
+    async def run_refresher(self, ttl: int = VOICE_CATALOGUE_TTL):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(ttl)
+
+    def is_valid(self, voice: str) -> bool:
+        # Without a catalogue there is nothing to validate against
+        return not self.by_name or voice in self.by_name
+
+    def query(self, locale: Optional[str] = None, gender: Optional[str] = None) -> List[dict]:
+        """Filter by locale ("en-US", or a language prefix such as "en") and gender"""
+        voices = self.voices
+        if locale:
+            locale = locale.lower()
+            if locale in self.by_locale:
+                voices = self.by_locale[locale]
+            else:
+                voices = [
+                    voice for key, group in self.by_locale.items()
+                    if key.split("-")[0] == locale
+                    for voice in group
+                ]
+        if gender:
+            gender_voices = self.by_gender.get(gender.lower(), [])
+            if voices is self.voices:
+                voices = gender_voices
+            else:
+                allowed = {id(voice) for voice in gender_voices}
+                voices = [voice for voice in voices if id(voice) in allowed]
+        return voices
+
+    def gzipped_all(self, body: bytes) -> bytes:
+        """The unfiltered response is requested most, so compress it once"""
+        if self._gzipped_all is None:
+            self._gzipped_all = gzip.compress(body)
+        return self._gzipped_all
+
+    def stats(self) -> dict:
+        return {
+            "voices": len(self.voices),
+            "locales": len(self.by_locale),
+            "source": self.source,
+            "etag": self.etag,
+            "loaded_at": self.loaded_at,
+        }
+
+voice_catalogue = VoiceCatalogue()
+voice_catalogue.load_file(VOICES_FILE)
+
+def validate_voice(voice: str) -> str:
+    """Reject unknown voices before any upstream call"""
+    if not voice_catalogue.is_valid(voice):
+        raise ValueError(f"Unknown voice: {voice}")
+    return voice
+
+class TTSRequest(BaseModel):
+    text: str
+    voice: str = "en-HK-SamNeural"
+    rate: str = "+10%"
+    pitch: str = "-18Hz"
+    volume: str = "+0%"
+    output_format: str = DEFAULT_OUTPUT_FORMAT  # See OUTPUT_FORMATS / OUTPUT_FORMAT_ALIASES
+
+    @field_validator("voice")
+    @classmethod
+    def check_voice(cls, voice: str) -> str:
+        return validate_voice(voice)
+
+    @field_validator("output_format")
+    @classmethod
+    def check_output_format(cls, output_format: str) -> str:
+        return validate_output_format(output_format)
+
+class TTSWithRAGRequest(BaseModel):
+    query: str
+    user_hash: str
+    instruct: str
+    auth_key: str  # Encrypted auth key containing both embedding and LLM API keys
+    collection_name: str
+    top_k: int
+    voice: str = "en-HK-SamNeural"
+    # LLM provider settings
+    provider: str  # "mistral", "google", or "z.ai"
+    model: str  # e.g., "mistral-3b-latest", "gemma-2-9b-it"
+    use_cache: bool = True  # Replay a cached answer when ANSWER_CACHE_ENABLED
+    timing: bool = False  # Send a "timing" event with the trace spans (streaming only)
+    output_format: str = DEFAULT_OUTPUT_FORMAT
+
+    @field_validator("voice")
+    @classmethod
+    def check_voice(cls, voice: str) -> str:
+        return validate_voice(voice)
+
+    @field_validator("output_format")
+    @classmethod
+    def check_output_format(cls, output_format: str) -> str:
+        return validate_output_format(output_format)
+
+def rag_answer_key(request: TTSWithRAGRequest) -> Optional[tuple]:
+    """Answer cache key for a RAG request"""
+    return answer_cache.key(
+        query=request.query,
+        user_hash=request.user_hash,
+        collection_name=request.collection_name,
+        top_k=request.top_k,
+        instruct=request.instruct,
+        provider=request.provider,
+        model=request.model,
+        voice=request.voice
+    )
+
+class CacheInvalidateRequest(BaseModel):
+    api_key: str  # Must match EMBEDDING_API_KEY
+    collection_name: str
+    user_hash: Optional[str] = None
+
+class VoiceListResponse(BaseModel):
+    voices: list
+
+# Batch synthesis configuration
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+# Distinct items synthesized at the same time per batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# How long finished jobs can still be polled
+BATCH_JOB_TTL = int(os.getenv("BATCH_JOB_TTL", "3600"))
+# Batch audio stays downloadable for as long as its job can be polled
+BATCH_AUDIO_TTL = max(AUDIO_TTL_SECONDS, BATCH_JOB_TTL)
+# Times an item waits out a saturated edge-tts before it is reported as failed
+BATCH_BUSY_ATTEMPTS = int(os.getenv("BATCH_BUSY_ATTEMPTS", "5"))
+BATCH_OUTPUTS = ("job", "ndjson", "zip")
+
+class TTSBatchRequest(BaseModel):
+    items: List[TTSRequest]
+    output: str = "job"  # "job" (poll for progress), "ndjson" or "zip" (streamed)
+
+    @field_validator("items")
+    @classmethod
+    def check_items(cls, items: List[TTSRequest]) -> List[TTSRequest]:
+        if not items:
+            raise ValueError("items must not be empty")
+        if len(items) > BATCH_MAX_ITEMS:
+            raise ValueError(f"At most {BATCH_MAX_ITEMS} items per batch")
+        return items
+
+    @field_validator("output")
+    @classmethod
+    def check_output(cls, output: str) -> str:
+        if output not in BATCH_OUTPUTS:
+            raise ValueError(f"output must be one of {', '.join(BATCH_OUTPUTS)}")
+        return output
+
+async def synthesize_batch_item(item: TTSRequest) -> SynthesizedAudio:
+    """Synthesize one item, waiting out a saturated edge-tts instead of failing"""
+    attempts = max(1, BATCH_BUSY_ATTEMPTS)
+    for attempt in range(attempts):
+        try:
+            return await synthesis_cache.synthesize(
+                text=item.text,
+                voice=item.voice,
+                rate=item.rate,
+                pitch=item.pitch,
+                volume=item.volume,
+                output_format=item.output_format
+            )
+        except UpstreamBusy as e:
+            if attempt == attempts - 1:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+async def run_synthesis_batch(items: List[TTSRequest], store: bool = True) -> AsyncIterator[tuple]:
+    """
+    Synthesize a batch with a bounded worker pool.
+
+    Identical items are synthesized (and stored) once. Yields
+    (result, audio) for every item as soon as its audio is ready, where
+    audio is None for failed items.
+    """
+    groups: "OrderedDict[str, List[int]]" = OrderedDict()
+    for index, item in enumerate(items):
+        key = synthesis_cache_key(item.text, item.voice, item.rate, item.pitch, item.volume, item.output_format)
+        groups.setdefault(key, []).append(index)
+    pending: asyncio.Queue = asyncio.Queue()
+    for indices in groups.values():
+        pending.put_nowait(indices)
+    finished: asyncio.Queue = asyncio.Queue()
+
+    async def worker():
+        while True:
+            try:
+                indices = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                result = await synthesize_batch_item(items[indices[0]])
+            except Exception as e:
+                result = e
+            await finished.put((indices, result))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(max(1, BATCH_CONCURRENCY), len(groups)))]
+    try:
+        for _ in range(len(groups)):
+            indices, result = await finished.get()
+            if isinstance(result, Exception):
+                for index in indices:
+                    yield {"index": index, "status": "error", "error": str(result)}, None
+                continue
+            output_format = items[indices[0]].output_format
+            entry = {"status": "ok", "bytes": result.size, "output_format": output_format}
+            if store:
+                filename = audio_filename(output_format)
+                await audio_store.save(filename, result.audio, ttl=BATCH_AUDIO_TTL)
+                entry.update(filename=filename, audio_url=f"/audio/{filename}")
+            for index in indices:
+                yield {"index": index, **entry}, result.audio
+    finally:
+        for task in workers:
+            task.cancel()
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable sink for zipfile whose output is drained after every entry"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+class BatchJobStore:
+    """
+    Progress and results of background batch jobs.
+
+    With several workers the job state is mirrored into the shared SQLite
+    database so any worker can answer a poll.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.jobs: Dict[str, dict] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.saved_at: Dict[str, float] = {}
+
+    def create(self, total: int) -> dict:
+        self.prune()
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "running",
+            "total": total,
+            "completed": 0,
+            "failed": 0,
+            "created": time.time(),
+            "results": [{"index": index, "status": "pending"} for index in range(total)],
+        }
+        self.jobs[job_id] = job
+        self.save(job, force=True)
+        return job
 
-# Helper function to call LLM (streaming)
-def call_llm_stream(provider: str, model: str, api_key: str, system_prompt: str, user_prompt: str):
-    """Call LLM provider and return streaming response"""
-    if provider.lower() == "mistral":
-        with Mistral(api_key=api_key) as mistral:
-            chat_stream = mistral.chat.stream(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            for chunk in chat_stream:
-                if chunk.data.choices[0].delta.content:
-                    yield chunk.data.choices[0].delta.content
+    def save(self, job: dict, force: bool = False):
+        """Publish job progress to other workers (at most twice a second)"""
+        if shared_state is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.saved_at.get(job["job_id"], 0) < 0.5:
+            return
+        self.saved_at[job["job_id"]] = now
+        shared_state.save_batch_job(job)
 
-    elif provider.lower() == "google":
-        client = genai.Client(api_key=api_key)
-        stream = client.models.generate_content_stream(
-            model=model,
-            contents=[
-                {"role": "user", "parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]}
-            ]
-        )
-        for chunk in stream:
-            if hasattr(chunk, 'text') and chunk.text:
-                yield chunk.text
-
-    elif provider.lower() == "z.ai":
-        with httpx.Client() as client:
-            with client.stream(
-                "POST",
-                "https://api.z.ai/api/paas/v4/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": model,
-                    "thinking": {"type": "disabled"},
-                    "messages": [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "stream": True
-                },
-                timeout=30.0
-            ) as response:
-                response.raise_for_status()
-                for line in response.iter_lines():
-                    if line.strip():
-                        # Parse SSE format: "data: {json}"
-                        if line.startswith("data: "):
-                            data_str = line[6:]  # Remove "data: " prefix
-                            if data_str.strip() == "[DONE]":
-                                break
-                            try:
-                                chunk_data = json.loads(data_str)
-                                if "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-                                    delta = chunk_data["choices"][0].get("delta", {})
-                                    content = delta.get("content", "")
-                                    if content:
-                                        yield content
-                            except json.JSONDecodeError:
-                                continue
+    def get(self, job_id: str) -> Optional[dict]:
+        job = self.jobs.get(job_id)
+        if job is None and shared_state is not None:
+            job = shared_state.load_batch_job(job_id)
+        return job
 
-    else:
-        raise ValueError(f"Unsupported provider: {provider}. Use 'mistral', 'google', or 'z.ai'")
+    def prune(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["created"] < cutoff]:
+            del self.jobs[job_id]
+            self.saved_at.pop(job_id, None)
+            task = self.tasks.pop(job_id, None)
+            if task is not None:
+                task.cancel()
+        if shared_state is not None:
+            shared_state.prune_batch_jobs(cutoff)
 
-class TTSRequest(BaseModel):
-    text: str
-    voice: str = "en-HK-SamNeural"
-    rate: str = "+10%"
-    pitch: str = "-18Hz"
-    volume: str = "+0%"
+    async def run(self, job: dict, items: List[TTSRequest]):
+        # One batch counts as one user in the fair upstream queues
+        current_user.set(f"batch:{job['job_id']}")
+        try:
+            async for result, _ in run_synthesis_batch(items):
+                job["results"][result["index"]] = result
+                job["completed" if result["status"] == "ok" else "failed"] += 1
+                self.save(job)
+            job["status"] = "completed"
+        except Exception as e:
+            print(f"Batch job {job['job_id']} failed: {e}")
+            job["status"] = "error"
+            job["error"] = str(e)
+        finally:
+            self.tasks.pop(job["job_id"], None)
+            self.save(job, force=True)
 
-class TTSWithRAGRequest(BaseModel):
-    query: str
-    user_hash: str
-    instruct: str
-    auth_key: str  # Encrypted auth key containing both embedding and LLM API keys
-    collection_name: str
-    top_k: int
-    voice: str = "en-HK-SamNeural"
-    # LLM provider settings
-    provider: str  # "mistral", "google", or "z.ai"
-    model: str  # e.g., "mistral-3b-latest", "gemma-2-9b-it"
+    def start(self, items: List[TTSRequest]) -> dict:
+        job = self.create(len(items))
+        self.tasks[job["job_id"]] = asyncio.create_task(self.run(job, items))
+        return job
 
-class VoiceListResponse(BaseModel):
-    voices: list
+batch_jobs = BatchJobStore(BATCH_JOB_TTL)
 
 @app.get("/")
 async def root():
@@ -272,202 +3642,348 @@ async def root():
         "endpoints": {
             "POST /synthesize": "Convert text to speech",
             "POST /synthesize/stream": "Convert text to speech with SSE",
+            "POST /synthesize/chunked": "Stream MP3 audio while it is synthesized",
+            "POST /synthesize/batch": "Synthesize many texts (job, NDJSON or ZIP)",
             "WS /ws/synthesize": "Stream audio chunks via WebSocket",
             "POST /tts": "TTS with RAG",
             "POST /tts/stream": "TTS with RAG using SSE",
             "WS /ws/tts": "Stream TTS with RAG via WebSocket",
             "GET /voices": "List available voices",
+            "GET /pool/stats": "Connection pool statistics",
+            "GET /cache/stats": "Cache statistics",
+            "POST /cache/invalidate": "Invalidate cached results for a collection",
+            "GET /metrics": "Prometheus metrics",
             "GET /health": "Health check"
         }
     }
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    # Reports the last edge-tts probe; the probe itself runs in the background
+    return {
+        "status": "degraded" if synthesis_engine.healthy is False else "healthy",
+        "edge_tts": synthesis_engine.healthy
+    }
+
+@app.get("/pool/stats")
+async def pool_stats():
+    """Connection pool and provider client cache statistics"""
+    return {
+        "http": http_clients.stats(),
+        "llm_clients": llm_clients.stats(),
+        "upstreams": upstream_limits.stats(),
+        "llm_policy": llm_policy.stats(),
+        "edge_tts": synthesis_engine.stats()
+    }
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit rates and sizes of the server-side caches"""
+    return {
+        "synthesis": synthesis_cache.stats(),
+        "search": search_cache.stats(),
+        "audio_store": audio_store.stats(),
+        "voices": voice_catalogue.stats(),
+        "auth_keys": auth_key_cache.stats(),
+        "answers": answer_cache.stats()
+    }
+
+def collect_cache_metrics() -> List[tuple]:
+    """Cache and audio store figures read from their live stats"""
+    caches = {
+        "synthesis": synthesis_cache.stats(),
+        "search": search_cache.stats(),
+        "answers": answer_cache.stats(),
+        "auth_keys": auth_key_cache.stats()
+    }
+    store = audio_store.stats()
+    return [
+        ("tts_cache_hits_total", "counter", "Cache hits",
+         [("", {"cache": name}, stats["hits"]) for name, stats in caches.items()]),
+        ("tts_cache_misses_total", "counter", "Cache misses",
+         [("", {"cache": name}, stats["misses"]) for name, stats in caches.items()]),
+        ("tts_cache_hit_ratio", "gauge", "Cache hits / lookups since start",
+         [("", {"cache": name}, stats["hit_rate"]) for name, stats in caches.items()]),
+        ("tts_audio_store_files", "gauge", "Generated audio files being kept", [("", {}, store["files"])]),
+        ("tts_audio_store_bytes", "gauge", "Bytes of generated audio being kept", [("", {}, store["bytes"])]),
+    ]
+
+metrics.collectors.append(collect_cache_metrics)
+
+def collect_upstream_metrics() -> List[tuple]:
+    """Slots in use, queued waiters and refusals per upstream"""
+    upstreams = upstream_limits.stats()
+    return [
+        ("tts_upstream_active", "gauge", "Upstream calls in progress",
+         [("", {"upstream": name}, stats["active"]) for name, stats in upstreams.items()]),
+        ("tts_upstream_waiting", "gauge", "Calls waiting for an upstream slot",
+         [("", {"upstream": name}, stats["waiting"]) for name, stats in upstreams.items()]),
+        ("tts_upstream_rejected_total", "counter", "Calls refused because the wait queue was full",
+         [("", {"upstream": name}, stats["rejected"]) for name, stats in upstreams.items()]),
+        ("tts_upstream_timeouts_total", "counter", "Calls that timed out waiting for a slot",
+         [("", {"upstream": name}, stats["timeouts"]) for name, stats in upstreams.items()]),
+    ]
+
+metrics.collectors.append(collect_upstream_metrics)
+
+def merge_worker_metrics(snapshots: List[tuple]) -> List[tuple]:
+    """Combine the metric families of several workers, labelling samples by worker pid"""
+    merged = {}
+    for worker, families in snapshots:
+        for name, metric_type, help_text, samples in families:
+            family = merged.setdefault(name, (name, metric_type, help_text, []))
+            family[3].extend((suffix, dict(labels, worker=str(worker)), value) for suffix, labels, value in samples)
+    return list(merged.values())
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus metrics (request counts, stage latency histograms, cache hit rates)"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    families = metrics.collect()
+    if shared_state is not None:
+        shared_state.publish_metrics(families)
+        families = merge_worker_metrics(shared_state.collect_metrics())
+    return Response(content=render_metrics(families), media_type="text/plain; version=0.0.4")
+
+@app.post("/cache/invalidate")
+async def invalidate_cache(request: CacheInvalidateRequest):
+    """Drop cached search results and answers after a collection's documents change"""
+    if not hmac.compare_digest(request.api_key, EMBEDDING_API_KEY):
+        raise HTTPException(status_code=403, detail="Invalid api_key")
+    removed = invalidate_cached_collection(request.collection_name, request.user_hash)
+    if shared_state is not None:
+        shared_state.publish_invalidation(request.collection_name, request.user_hash)
+    return {"status": "ok", "removed": removed}
 
 @app.post("/tts")
-async def tts_with_rag(request: TTSWithRAGRequest):
+async def tts_with_rag(request: TTSWithRAGRequest, http_request: Request):
+    trace = Trace(http_request.headers.get("x-trace-id"), provider=request.provider, model=request.model)
+    current_trace.set(trace)
+    current_user.set(request.user_hash)
+    stages = None
     try:
-        # Decrypt auth_key to get API keys
-        keys = decrypt_auth_key(request.auth_key)
-        embedding_api_key = keys['embedding_api_key']
-        llm_api_key = keys['llm_api_key']
-
-        # Step 1: Call the embedding search API
-        async with httpx.AsyncClient() as client:
-            search_response = await client.post(
-                f"{EMBEDDING_API_URL}/search",
-                json={
-                    "api_key": EMBEDDING_API_KEY,
-                    "query": request.query,
-                    "user_hash": request.user_hash,
-                    "collection_name": request.collection_name,
-                    "top_k": request.top_k
-                },
-                timeout=30.0
+        answer_key = rag_answer_key(request) if request.use_cache else None
+        cached = answer_cache.get(answer_key)
+        if cached is not None:
+            trace.mark("cache_hit")
+            # Cached answers are still only served to a valid auth_key
+            decrypt_auth_key(request.auth_key)
+            events = cached.events()
+            document_urls = cached.document_urls
+        else:
+            generation = answer_cache.generation(request.collection_name)
+
+            # Step 1: Call the embedding search API while the auth_key is
+            # decrypted and the LLM and TTS connections are warmed up
+            stages = start_rag_stages(
+                request.auth_key, request.query, request.user_hash,
+                request.collection_name, request.top_k, request.provider
             )
-            search_response.raise_for_status()
-            search_data = search_response.json()
-
-        # Step 2: Call LLM with the instruction and search results
-        ai_response = call_llm_complete(
-            provider=request.provider,
-            model=request.model,
-            api_key=llm_api_key,
-            system_prompt=request.instruct,
-            user_prompt=f"Query: {request.query}\n\nSearch Results: {search_data}"
-        )
+            llm_api_key = (await stages.result("auth"))['llm_api_key']
+            search_data = await stages.result("search")
 
-        # Step 3: Synthesize speech from AI response
-        filename = f"{uuid.uuid4()}.mp3"
-        filepath = os.path.join(TEMP_DIR, filename)
+            # Filter documents with score > RAG_MIN_SCORE
+            document_urls = extract_document_urls(search_data)
 
-        communicate = edge_tts.Communicate(
-            text=ai_response,
-            voice=request.voice,
-            rate="+0%",
-            pitch="+0Hz"
-        )
+            # Step 2 + 3: Stream the LLM answer and synthesize it sentence by sentence
+            events = answer_cache.record(answer_key, generation, document_urls, speak_token_stream(
+                call_llm_stream_with_fallback(
+                    provider=request.provider,
+                    model=request.model,
+                    api_key=llm_api_key,
+                    system_prompt=request.instruct,
+                    user_prompt=build_user_prompt(request.query, search_data, request.model)
+                ),
+                voice=request.voice
+            ))
 
-        await communicate.save(filepath)
+        ai_response = ""
+        audio = bytearray()
+        async for event in events:
+            if event["type"] == "text":
+                ai_response += event["content"]
+            elif event["type"] == "audio":
+                trace.mark("tts_first_chunk")
+                audio += event["data"]
+        trace.mark("tts_done")
 
-        # Schedule file deletion after 10 minutes
-        asyncio.create_task(delete_file_after_delay(filepath, 600))
+        filename = audio_filename(request.output_format)
+        await audio_store.save(filename, await transcode(bytes(audio), request.output_format))
 
         # Generate audio URL (adjust base URL as needed)
         audio_url = f"/audio/{filename}"
 
-        # Filter documents with score > 0.4
-        document_urls = []
-        if "results" in search_data:
-            document_urls = [
-                doc.get("metadata", {}).get("url", "")
-                for doc in search_data["results"]
-                if doc.get("score", 0) > 0.4 and doc.get("metadata", {}).get("url")
-            ]
-
+        trace.finish()
         return JSONResponse({
             "status": "success",
             "query": request.query,
             "ai_response": ai_response,
             "document_url": document_urls,
-            "audio_url": audio_url
-        })
+            "audio_url": audio_url,
+            "cached": cached is not None,
+            "trace_id": trace.trace_id
+        }, headers={"X-Trace-Id": trace.trace_id})
 
+    except UpstreamBusy as e:
+        trace.finish("busy", str(e))
+        raise
     except httpx.HTTPError as e:
+        trace.finish("error", f"Error calling embedding API: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error calling embedding API: {str(e)}")
     except Exception as e:
         import traceback
         print(f"ERROR: {str(e)}")
         print(traceback.format_exc())
+        trace.finish("error", str(e))
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if stages is not None:
+            stages.close()
 
 @app.post("/tts/stream")
-async def tts_with_rag_stream(request: TTSWithRAGRequest):
+async def tts_with_rag_stream(request: TTSWithRAGRequest, http_request: Request):
     """Stream TTS with RAG using Server-Sent Events"""
-    # Decrypt auth_key to get API keys
-    keys = decrypt_auth_key(request.auth_key)
-    embedding_api_key = keys['embedding_api_key']
-    llm_api_key = keys['llm_api_key']
+    # Reject a bad auth_key before the stream starts
+    decrypt_auth_key(request.auth_key)
 
-    async def event_generator():
-        try:
-            # Step 1: Call the embedding search API
-            yield format_sse({"status": "searching", "message": "Searching embeddings..."}, "progress")
-
-            async with httpx.AsyncClient() as client:
-                search_response = await client.post(
-                    f"{EMBEDDING_API_URL}/search",
-                    json={
-                        "api_key": EMBEDDING_API_KEY,
-                        "query": request.query,
-                        "user_hash": request.user_hash,
-                        "collection_name": request.collection_name,
-                        "top_k": request.top_k
-                    },
-                    timeout=30.0
-                )
-                search_response.raise_for_status()
-                search_data = search_response.json()
+    trace = Trace(http_request.headers.get("x-trace-id"), provider=request.provider, model=request.model)
 
-            yield format_sse({"status": "search_complete", "message": f"Found {len(search_data.get('results', []))} results"}, "progress")
+    try:
+        llm_provider = get_llm_provider(request.provider)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-            # Step 2: Call LLM with streaming
-            yield format_sse({"status": "generating", "message": "Generating AI response..."}, "progress")
+    # Refuse before the stream starts while the upstreams are saturated
+    upstream_limits.check("embedding", llm_provider.name, "edge-tts")
 
-            ai_response = ""
-            try:
-                # Try streaming
-                for content in call_llm_stream(
-                    provider=request.provider,
-                    model=request.model,
-                    api_key=llm_api_key,
-                    system_prompt=request.instruct,
-                    user_prompt=f"Query: {request.query}\n\nSearch Results: {search_data}"
-                ):
-                    ai_response += content
-                    # Stream AI response chunks
-                    yield format_sse({"status": "ai_chunk", "content": content}, "ai_response")
+    async def event_generator():
+        # Stages deeper in the pipeline (search, LLM) mark this trace
+        current_trace.set(trace)
+        current_user.set(request.user_hash)
+        status, error = "cancelled", None
+        stages = None
+        try:
+            answer_key = rag_answer_key(request) if request.use_cache else None
+            cached = answer_cache.get(answer_key)
+            if cached is not None:
+                trace.mark("cache_hit")
+                # Replay the cached answer as fast as the client can take it
+                yield format_sse({"status": "cache_hit", "message": "Replaying cached answer...", "trace_id": trace.trace_id}, "progress")
+                events = cached.events()
+                document_urls = cached.document_urls
+            else:
+                generation = answer_cache.generation(request.collection_name)
 
-            except Exception as stream_error:
-                # Fallback to non-streaming if streaming fails
-                print(f"Streaming failed, falling back to non-streaming: {stream_error}")
-                ai_response = call_llm_complete(
-                    provider=request.provider,
-                    model=request.model,
-                    api_key=llm_api_key,
-                    system_prompt=request.instruct,
-                    user_prompt=f"Query: {request.query}\n\nSearch Results: {search_data}"
+                # Step 1: Call the embedding search API
+                stages = start_rag_stages(
+                    request.auth_key, request.query, request.user_hash,
+                    request.collection_name, request.top_k, request.provider
                 )
-                yield format_sse({"status": "ai_complete", "content": ai_response}, "ai_response")
+                yield format_sse({"status": "searching", "message": "Searching embeddings...", "trace_id": trace.trace_id}, "progress")
 
-            yield format_sse({"status": "synthesizing", "message": "Converting response to speech..."}, "progress")
+                llm_api_key = (await stages.result("auth"))['llm_api_key']
+                search_data = await stages.result("search")
 
-            # Step 3: Synthesize speech from AI response
-            filename = f"{uuid.uuid4()}.mp3"
-            filepath = os.path.join(TEMP_DIR, filename)
+                yield format_sse({"status": "search_complete", "message": f"Found {len(search_data.get('results', []))} results"}, "progress")
 
-            communicate = edge_tts.Communicate(
-                text=ai_response,
-                voice=request.voice,
-                rate="+0%",
-                pitch="+0Hz"
-            )
+                # Filter documents with score > RAG_MIN_SCORE
+                document_urls = extract_document_urls(search_data)
 
-            await communicate.save(filepath)
+                # Step 2: Stream the LLM answer; each finished sentence is
+                # synthesized right away and sent as an audio segment
+                yield format_sse({"status": "generating", "message": "Generating AI response..."}, "progress")
 
-            # Schedule file deletion after 10 minutes
-            asyncio.create_task(delete_file_after_delay(filepath, 600))
+                events = answer_cache.record(answer_key, generation, document_urls, speak_token_stream(
+                    call_llm_stream_with_fallback(
+                        provider=request.provider,
+                        model=request.model,
+                        api_key=llm_api_key,
+                        system_prompt=request.instruct,
+                        user_prompt=build_user_prompt(request.query, search_data, request.model)
+                    ),
+                    voice=request.voice
+                ))
+
+            ai_response = ""
+            audio = bytearray()
+            segment_audio = bytearray()
+            segment = -1
+            synthesizing = False
+            # One continuous stream in the requested format across all segments:
+            # MP3 segments are complete files, transcoded segments are consecutive
+            # slices of one file (ffmpeg lags behind, so the last slice follows
+            # the last segment) that the client joins
+            async for event in transcode_stream(events, request.output_format):
+                if event["type"] == "text":
+                    ai_response += event["content"]
+                    # Stream AI response chunks
+                    yield format_sse({"status": "ai_chunk", "content": event["content"]}, "ai_response")
+                elif event["type"] == "audio":
+                    if not synthesizing:
+                        synthesizing = True
+                        trace.mark("tts_first_chunk")
+                        yield format_sse({"status": "synthesizing", "message": "Converting response to speech..."}, "progress")
+                    segment_audio += event["data"]
+                elif event["type"] == "segment_end":
+                    segment = event["segment"]
+                    audio += segment_audio
+                    yield format_sse({
+                        "status": "audio_segment",
+                        "segment": segment,
+                        "text": event["text"],
+                        "data": base64.b64encode(segment_audio).decode("utf-8")
+                    }, "audio")
+                    segment_audio = bytearray()
+            if segment_audio:
+                audio += segment_audio
+                yield format_sse({
+                    "status": "audio_segment",
+                    "segment": segment + 1,
+                    "text": "",
+                    "data": base64.b64encode(segment_audio).decode("utf-8")
+                }, "audio")
+            trace.mark("tts_done")
+
+            # Step 3: Keep the full answer audio available for replay
+            filename = audio_filename(request.output_format)
+            await audio_store.save(filename, bytes(audio))
 
             # Generate audio URL
             audio_url = f"/audio/{filename}"
 
-            # Filter documents with score > 0.4
-            document_urls = []
-            if "results" in search_data:
-                document_urls = [
-                    doc.get("metadata", {}).get("url", "")
-                    for doc in search_data["results"]
-                    if doc.get("score", 0) > 0.4 and doc.get("metadata", {}).get("url")
-                ]
+            if request.timing:
+                yield format_sse(trace.timing(), "timing")
 
             # Send final completion event
+            status = "ok"
             yield format_sse({
                 "status": "completed",
                 "message": "All processing completed",
                 "query": request.query,
                 "ai_response": ai_response,
                 "document_url": document_urls,
-                "audio_url": audio_url
+                "audio_url": audio_url,
+                "cached": cached is not None,
+                "trace_id": trace.trace_id
             }, "complete")
 
+        except UpstreamBusy as e:
+            status, error = "busy", str(e)
+            yield format_sse({"status": "busy", "message": str(e), "retry_after": e.retry_after, "trace_id": trace.trace_id}, "error")
         except httpx.HTTPError as e:
-            yield format_sse({"status": "error", "message": f"Error calling embedding API: {str(e)}"}, "error")
+            status, error = "error", f"Error calling embedding API: {str(e)}"
+            yield format_sse({"status": "error", "message": error, "trace_id": trace.trace_id}, "error")
         except Exception as e:
             import traceback
             print(f"ERROR: {str(e)}")
             print(traceback.format_exc())
-            yield format_sse({"status": "error", "message": str(e)}, "error")
+            status, error = "error", str(e)
+            yield format_sse({"status": "error", "message": str(e), "trace_id": trace.trace_id}, "error")
+        finally:
+            if stages is not None:
+                stages.close()
+            trace.finish(status, error)
 
     return StreamingResponse(
         event_generator(),
@@ -475,78 +3991,140 @@ async def tts_with_rag_stream(request: TTSWithRAGRequest):
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
+            "X-Accel-Buffering": "no",
+            "X-Trace-Id": trace.trace_id
         }
     )
 
 @app.post("/synthesize")
 async def synthesize_speech(request: TTSRequest):
+    if is_long_text(request.text):
+        # Long texts are streamed as soon as their beginning is ready, still as a download
+        return await stream_synthesized_audio(request, store=True, disposition="attachment")
     try:
         # Generate unique filename
-        filename = f"{uuid.uuid4()}.mp3"
-        filepath = os.path.join(TEMP_DIR, filename)
+        filename = audio_filename(request.output_format)
 
-        # Create TTS
-        communicate = edge_tts.Communicate(
+        # Synthesize (or reuse cached audio) and save the file
+        result = await synthesis_cache.synthesize(
             text=request.text,
             voice=request.voice,
             rate=request.rate,
             pitch=request.pitch,
-            volume=request.volume
+            volume=request.volume,
+            output_format=request.output_format
         )
+        await audio_store.save(filename, result.audio)
 
-        # Save audio file
-        await communicate.save(filepath)
-
-        # Schedule file deletion after 10 minutes
-        asyncio.create_task(delete_file_after_delay(filepath, 600))
-
-        # Return the audio file
-        return FileResponse(
-            filepath,
-            media_type="audio/mpeg",
-            filename=filename,
+        # Return the audio bytes directly (no need to read the stored copy back)
+        return Response(
+            content=result.audio,
+            media_type=OUTPUT_FORMATS[request.output_format].media_type,
             headers={
                 "Content-Disposition": f"attachment; filename={filename}"
             }
         )
     
+    except UpstreamBusy:
+        raise
+    except Exception as e:
+        import traceback
+        print(f"ERROR: {str(e)}")
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/synthesize/chunked")
+async def synthesize_speech_chunked(request: TTSRequest, store: bool = False):
+    """
+    Stream audio bytes to the client while they are being synthesized.
+
+    Audio is teed into the synthesis cache; with ?store=true it is also kept
+    in the audio store and its URL is announced in the X-Audio-URL header.
+    """
+    return await stream_synthesized_audio(request, store)
+
+async def stream_synthesized_audio(request: TTSRequest, store: bool, disposition: str = "inline") -> StreamingResponse:
+    """Streaming response for /synthesize/chunked, and for long texts on /synthesize"""
+    filename = audio_filename(request.output_format)
+    audio_chunks = (
+        chunk["data"]
+        async for chunk in transcode_stream(synthesis_cache.stream(
+            text=request.text,
+            voice=request.voice,
+            rate=request.rate,
+            pitch=request.pitch,
+            volume=request.volume
+        ), request.output_format)
+        if chunk["type"] == "audio"
+    )
+
+    # Wait for the first chunk so upstream errors still become a 500
+    try:
+        first_chunk = await audio_chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = b""
+    except UpstreamBusy:
+        raise
     except Exception as e:
         import traceback
         print(f"ERROR: {str(e)}")
         print(traceback.format_exc())
         raise HTTPException(status_code=500, detail=str(e))
 
+    async def audio_generator():
+        audio = bytearray(first_chunk)
+        yield first_chunk
+        async for data in audio_chunks:
+            if store:
+                audio += data
+            yield data
+        if store:
+            await audio_store.save(filename, bytes(audio))
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "Content-Disposition": f"{disposition}; filename={filename}"
+    }
+    if store:
+        headers["X-Audio-URL"] = f"/audio/{filename}"
+
+    return StreamingResponse(
+        audio_generator(),
+        media_type=OUTPUT_FORMATS[request.output_format].media_type,
+        headers=headers
+    )
+
 @app.post("/synthesize/stream")
 async def synthesize_speech_stream(request: TTSRequest):
     """Stream TTS generation progress using Server-Sent Events"""
+    # Refuse before the stream starts while edge-tts is saturated
+    upstream_limits.check("edge-tts")
+
     async def event_generator():
         try:
             # Send start event
             yield format_sse({"status": "started", "message": "Starting TTS synthesis"}, "progress")
 
             # Generate unique filename
-            filename = f"{uuid.uuid4()}.mp3"
-            filepath = os.path.join(TEMP_DIR, filename)
+            filename = audio_filename(request.output_format)
 
             yield format_sse({"status": "processing", "message": f"Generating speech for text (length: {len(request.text)} chars)"}, "progress")
 
-            # Create TTS
-            communicate = edge_tts.Communicate(
+            # Synthesize (or reuse cached audio)
+            result = await synthesis_cache.synthesize(
                 text=request.text,
                 voice=request.voice,
                 rate=request.rate,
                 pitch=request.pitch,
-                volume=request.volume
+                volume=request.volume,
+                output_format=request.output_format
             )
 
             yield format_sse({"status": "saving", "message": "Saving audio file"}, "progress")
 
             # Save audio file
-            await communicate.save(filepath)
-
-            # Schedule file deletion after 10 minutes
-            asyncio.create_task(delete_file_after_delay(filepath, 600))
+            await audio_store.save(filename, result.audio)
 
             # Generate audio URL
             audio_url = f"/audio/{filename}"
@@ -559,6 +4137,8 @@ async def synthesize_speech_stream(request: TTSRequest):
                 "filename": filename
             }, "complete")
 
+        except UpstreamBusy as e:
+            yield format_sse({"status": "busy", "message": str(e), "retry_after": e.retry_after}, "error")
         except Exception as e:
             import traceback
             print(f"ERROR: {str(e)}")
@@ -575,26 +4155,122 @@ async def synthesize_speech_stream(request: TTSRequest):
         }
     )
 
+@app.post("/synthesize/batch")
+async def synthesize_batch(request: TTSBatchRequest):
+    """
+    Synthesize many items at once.
+
+    output=job starts a background job (poll GET /synthesize/batch/{job_id});
+    output=ndjson streams one result line per item as it finishes;
+    output=zip streams a ZIP of the audio files plus a manifest.json.
+    """
+    if request.output == "job":
+        job = batch_jobs.start(request.items)
+        return JSONResponse({
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "total": job["total"],
+            "status_url": f"/synthesize/batch/{job['job_id']}"
+        }, status_code=202)
+
+    batch_id = uuid.uuid4().hex
+    # One batch counts as one user in the fair upstream queues
+    current_user.set(f"batch:{batch_id}")
+
+    if request.output == "ndjson":
+        async def ndjson_generator():
+            failed = 0
+            async for result, _ in run_synthesis_batch(request.items):
+                failed += result["status"] != "ok"
+                yield json.dumps(result) + "\n"
+            yield json.dumps({
+                "status": "completed",
+                "total": len(request.items),
+                "succeeded": len(request.items) - failed,
+                "failed": failed
+            }) + "\n"
+
+        return StreamingResponse(ndjson_generator(), media_type="application/x-ndjson")
+
+    async def zip_generator():
+        width = len(str(len(request.items) - 1))
+        sink = _ZipStream()
+        manifest = [None] * len(request.items)
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+            async for result, audio in run_synthesis_batch(request.items, store=False):
+                if audio is not None:
+                    extension = OUTPUT_FORMATS[result["output_format"]].extension
+                    result["filename"] = f"{result['index']:0{width}d}.{extension}"
+                    archive.writestr(result["filename"], audio)
+                manifest[result["index"]] = result
+                yield sink.drain()
+            archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        yield sink.drain()
+
+    return StreamingResponse(
+        zip_generator(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=batch-{batch_id}.zip"}
+    )
+
+@app.get("/synthesize/batch/{job_id}")
+async def synthesize_batch_status(job_id: str):
+    """Progress and per-item results of a batch job"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return job
+
 @app.get("/voices")
-async def list_voices():
+async def list_voices(
+    request: Request,
+    locale: Optional[str] = None,
+    gender: Optional[str] = None,
+    offset: int = 0,
+    limit: Optional[int] = None
+):
+    """List voices from the cached catalogue, optionally filtered and paginated"""
     try:
-        voices = await edge_tts.list_voices()
-        return {"voices": voices}
+        filtered = bool(locale or gender or offset or limit is not None)
+        query_key = f"{locale}|{gender}|{offset}|{limit}"
+        etag = f'W/"{voice_catalogue.etag}-{hashlib.sha256(query_key.encode()).hexdigest()[:8]}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "public, max-age=3600",
+            "Vary": "Accept-Encoding"
+        }
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        voices = voice_catalogue.query(locale=locale, gender=gender)
+        total = len(voices)
+        offset = max(offset, 0)
+        page = voices[offset:offset + limit] if limit is not None else voices[offset:]
+        body = json.dumps({
+            "voices": page,
+            "total": total,
+            "offset": offset,
+            "limit": limit
+        }).encode("utf-8")
+
+        if "gzip" in request.headers.get("accept-encoding", "") and len(body) > 1024:
+            headers["Content-Encoding"] = "gzip"
+            body = gzip.compress(body) if filtered else voice_catalogue.gzipped_all(body)
+        return Response(content=body, media_type="application/json", headers=headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/audio/{filename}")
-async def get_audio(filename: str):
-    """Serve the generated audio file"""
+async def get_audio(filename: str, request: Request):
+    """Serve the generated audio file (supports Range requests for seeking)"""
     try:
-        filepath = os.path.join(TEMP_DIR, filename)
-        if not os.path.exists(filepath):
+        if not await audio_store.exists(filename):
             raise HTTPException(status_code=404, detail="Audio file not found")
 
-        return FileResponse(
-            filepath,
-            media_type="audio/mpeg",
-            filename=filename
+        return await audio_response(
+            filename,
+            range_header=request.headers.get("range"),
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
         )
     except HTTPException:
         raise
@@ -603,14 +4279,10 @@ async def get_audio(filename: str):
 
 @app.delete("/cleanup")
 async def cleanup_temp_files():
-    """Optional endpoint to clean up old temp files"""
+    """Optional endpoint to clean up old temp files (files being served are kept)"""
     try:
-        files = os.listdir(TEMP_DIR)
-        for file in files:
-            filepath = os.path.join(TEMP_DIR, file)
-            if os.path.isfile(filepath):
-                os.remove(filepath)
-        return {"message": f"Cleaned up {len(files)} files"}
+        removed, skipped = audio_store.cleanup()
+        return {"message": f"Cleaned up {removed} files", "skipped_in_use": skipped}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -622,37 +4294,49 @@ async def websocket_synthesize(websocket: WebSocket):
     try:
         # Receive the TTS request data
         data = await websocket.receive_json()
+        protocol = negotiate_ws_protocol(websocket, data)
+
+        voice = data.get("voice", "en-HK-SamNeural")
+        if not voice_catalogue.is_valid(voice):
+            await websocket.send_json({
+                "type": "error",
+                "message": f"Unknown voice: {voice}"
+            })
+            return
+
+        try:
+            output_format = validate_output_format(data.get("output_format", DEFAULT_OUTPUT_FORMAT))
+        except ValueError as e:
+            await websocket.send_json({
+                "type": "error",
+                "message": str(e)
+            })
+            return
 
         # Send start message
         await websocket.send_json({
             "type": "status",
             "status": "started",
-            "message": "Starting TTS synthesis"
+            "message": "Starting TTS synthesis",
+            "protocol": protocol
         })
 
-        # Create TTS with parameters from request
-        communicate = edge_tts.Communicate(
-            text=data.get("text", ""),
-            voice=data.get("voice", "en-HK-SamNeural"),
-            rate=data.get("rate", "+10%"),
-            pitch=data.get("pitch", "-18Hz"),
-            volume=data.get("volume", "+0%")
-        )
-
         await websocket.send_json({
             "type": "status",
             "status": "streaming",
             "message": "Streaming audio chunks..."
         })
 
-        # Stream audio chunks
-        async for chunk in communicate.stream():
+        # Stream audio chunks (replayed from cache when available)
+        async for chunk in transcode_stream(synthesis_cache.stream(
+            text=data.get("text", ""),
+            voice=voice,
+            rate=data.get("rate", "+10%"),
+            pitch=data.get("pitch", "-18Hz"),
+            volume=data.get("volume", "+0%")
+        ), output_format):
             if chunk["type"] == "audio":
-                # Send audio chunk as base64 (for compatibility)
-                await websocket.send_json({
-                    "type": "audio",
-                    "data": base64.b64encode(chunk["data"]).decode("utf-8")
-                })
+                await send_ws_audio(websocket, chunk["data"], protocol)
             elif chunk["type"] == "WordBoundary":
                 # Send word boundary info for synchronization
                 await websocket.send_json({
@@ -671,6 +4355,8 @@ async def websocket_synthesize(websocket: WebSocket):
 
     except WebSocketDisconnect:
         print("WebSocket disconnected")
+    except UpstreamBusy as e:
+        await send_ws_busy(websocket, e)
     except Exception as e:
         import traceback
         print(f"ERROR: {str(e)}")
@@ -683,159 +4369,360 @@ async def websocket_synthesize(websocket: WebSocket):
         except:
             pass
 
-@app.websocket("/ws/tts")
-async def websocket_tts_with_rag(websocket: WebSocket):
-    """Stream TTS with RAG via WebSocket"""
-    await websocket.accept()
-
-    try:
-        # Receive the request data
-        data = await websocket.receive_json()
+# WebSocket session configuration
+# A /ws/tts connection whose first message has "session": true answers many
+# queries. Each query has a request_id that is added to all of its JSON
+# messages. Later queries are searched, answered and synthesized while an
+# earlier answer is still being sent, but answers go out one after another in
+# arrival order, so binary audio frames belong to the answer whose
+# "streaming" status came before them.
+WS_SESSION_MAX_PENDING = int(os.getenv("WS_SESSION_MAX_PENDING", "4"))
+# Earlier (query, answer) pairs included in the prompt with "history": true
+WS_SESSION_HISTORY_TURNS = int(os.getenv("WS_SESSION_HISTORY_TURNS", "6"))
+# Fields of the first message that apply to every query unless it overrides them
+WS_SESSION_FIELDS = (
+    "auth_key", "user_hash", "collection_name", "top_k", "instruct", "provider",
+    "model", "voice", "output_format", "use_cache", "timing"
+)
 
-        # Validate auth_key exists
-        auth_key = data.get("auth_key")
-        if not auth_key:
-            error_msg = "Missing auth_key in request"
-            await websocket.send_json({
-                "type": "error",
-                "message": error_msg
-            })
-            return
+class WSRAGTurn:
+    """One /ws/tts query; messages() yields its JSON messages, and bytes for audio"""
 
-        # Decrypt auth_key to get API keys
-        keys = decrypt_auth_key(auth_key)
-        embedding_api_key = keys['embedding_api_key']
-        llm_api_key = keys['llm_api_key']
+    def __init__(self, data: dict, protocol: str, keys: Optional[Dict[str, dict]] = None,
+                 history: Optional[List[tuple]] = None, previous: Optional[asyncio.Future] = None):
+        self.data = data
+        self.protocol = protocol
+        # auth_key -> decrypted keys, shared by the turns of a session
+        self.keys = keys if keys is not None else {}
+        # Conversation so far, and the previous turn's answer it has to wait for
+        self.history = history
+        self.previous = previous
+        self.answered = asyncio.get_running_loop().create_future()
+        self.trace: Optional[Trace] = None
 
-        # Step 1: Search embeddings
-        await websocket.send_json({
-            "type": "status",
-            "status": "searching",
-            "message": "Searching embeddings..."
-        })
+    async def messages(self) -> AsyncIterator:
+        data = self.data
+        stages = None
+        try:
+            # Validate auth_key exists
+            auth_key = data.get("auth_key")
+            if not auth_key:
+                yield {"type": "error", "message": "Missing auth_key in request"}
+                return
 
-        async with httpx.AsyncClient() as client:
-            search_response = await client.post(
-                f"{EMBEDDING_API_URL}/search",
-                json={
-                    "api_key": EMBEDDING_API_KEY,
-                    "query": data.get("query"),
-                    "user_hash": data.get("user_hash"),
-                    "collection_name": data.get("collection_name"),
-                    "top_k": data.get("top_k", 5)
-                },
-                timeout=30.0
-            )
-            search_response.raise_for_status()
-            search_data = search_response.json()
+            voice = data.get("voice", "en-HK-SamNeural")
+            if not voice_catalogue.is_valid(voice):
+                yield {"type": "error", "message": f"Unknown voice: {voice}"}
+                return
 
-        await websocket.send_json({
-            "type": "status",
-            "status": "search_complete",
-            "message": f"Found {len(search_data.get('results', []))} results"
-        })
+            try:
+                output_format = validate_output_format(data.get("output_format", DEFAULT_OUTPUT_FORMAT))
+            except ValueError as e:
+                yield {"type": "error", "message": str(e)}
+                return
 
-        # Step 2: Generate AI response
-        await websocket.send_json({
-            "type": "status",
-            "status": "generating",
-            "message": "Generating AI response..."
-        })
+            self.trace = trace = Trace(data.get("trace_id"), provider=data.get("provider"), model=data.get("model"))
+            current_trace.set(trace)
+            current_user.set(data.get("user_hash") or "")
 
-        ai_response = ""
-        try:
-            # Try streaming AI response
-            for content in call_llm_stream(
+            # Answers that build on a conversation are never cached
+            answer_key = answer_cache.key(
+                query=data.get("query"),
+                user_hash=data.get("user_hash"),
+                collection_name=data.get("collection_name"),
+                top_k=data.get("top_k", 5),
+                instruct=data.get("instruct", ""),
                 provider=data.get("provider"),
                 model=data.get("model"),
-                api_key=llm_api_key,
-                system_prompt=data.get("instruct", ""),
-                user_prompt=f"Query: {data.get('query')}\n\nSearch Results: {search_data}"
-            ):
-                ai_response += content
-                # Stream AI response chunks
-                await websocket.send_json({
-                    "type": "ai_response",
-                    "content": content
-                })
+                voice=voice
+            ) if data.get("use_cache", True) and self.history is None else None
+            cached = answer_cache.get(answer_key)
+            if cached is not None:
+                trace.mark("cache_hit")
+                # Cached answers are still only served to a valid auth_key
+                if auth_key not in self.keys:
+                    self.keys[auth_key] = decrypt_auth_key(auth_key)
+                # Replay the cached answer as fast as the client can take it
+                yield {
+                    "type": "status",
+                    "status": "cache_hit",
+                    "message": "Replaying cached answer...",
+                    "protocol": self.protocol,
+                    "trace_id": trace.trace_id
+                }
+                events = cached.events()
+                document_urls = cached.document_urls
+            else:
+                generation = answer_cache.generation(data.get("collection_name"))
 
-        except Exception as stream_error:
-            # Fallback to non-streaming
-            print(f"Streaming failed, falling back to non-streaming: {stream_error}")
-            ai_response = call_llm_complete(
-                provider=data.get("provider"),
-                model=data.get("model"),
-                api_key=llm_api_key,
-                system_prompt=data.get("instruct", ""),
-                user_prompt=f"Query: {data.get('query')}\n\nSearch Results: {search_data}"
-            )
-            await websocket.send_json({
-                "type": "ai_response",
-                "content": ai_response
-            })
+                # Step 1: Search embeddings while the auth_key is decrypted and
+                # the LLM and TTS connections are warmed up
+                stages = start_rag_stages(
+                    auth_key, data.get("query"), data.get("user_hash"),
+                    data.get("collection_name"), data.get("top_k", 5), data.get("provider"),
+                    keys=self.keys.get(auth_key)
+                )
+                yield {
+                    "type": "status",
+                    "status": "searching",
+                    "message": "Searching embeddings...",
+                    "protocol": self.protocol,
+                    "trace_id": trace.trace_id
+                }
 
-        # Step 3: Synthesize and stream audio
-        await websocket.send_json({
-            "type": "status",
-            "status": "synthesizing",
-            "message": "Converting response to speech..."
-        })
+                keys = self.keys[auth_key] = await stages.result("auth")
+                search_data = await stages.result("search")
 
-        communicate = edge_tts.Communicate(
-            text=ai_response,
-            voice=data.get("voice", "en-HK-SamNeural"),
-            rate="+0%",
-            pitch="+0Hz"
-        )
+                yield {
+                    "type": "status",
+                    "status": "search_complete",
+                    "message": f"Found {len(search_data.get('results', []))} results"
+                }
 
-        await websocket.send_json({
-            "type": "status",
-            "status": "streaming",
-            "message": "Streaming audio chunks..."
-        })
+                # Filter documents with score > RAG_MIN_SCORE
+                document_urls = extract_document_urls(search_data)
 
-        # Stream audio chunks
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                # Send audio chunk as base64
-                await websocket.send_json({
-                    "type": "audio",
-                    "data": base64.b64encode(chunk["data"]).decode("utf-8")
-                })
-            elif chunk["type"] == "WordBoundary":
-                await websocket.send_json({
-                    "type": "word_boundary",
-                    "offset": chunk.get("offset"),
-                    "duration": chunk.get("duration"),
-                    "text": chunk.get("text")
+                # Step 2: Generate AI response; finished sentences are synthesized and
+                # streamed as audio while the rest of the answer is still generating
+                yield {
+                    "type": "status",
+                    "status": "generating",
+                    "message": "Generating AI response..."
+                }
+
+                if self.previous is not None:
+                    # The previous answer is part of this prompt
+                    await asyncio.shield(self.previous)
+
+                events = answer_cache.record(answer_key, generation, document_urls, speak_token_stream(
+                    call_llm_stream_with_fallback(
+                        provider=data.get("provider"),
+                        model=data.get("model"),
+                        api_key=keys['llm_api_key'],
+                        system_prompt=data.get("instruct", ""),
+                        user_prompt=build_user_prompt(data.get("query"), search_data, data.get("model"), self.history)
+                    ),
+                    voice=voice
+                ))
+
+            ai_response = ""
+            streaming_audio = False
+            # One continuous stream in the requested format across all segments
+            async for event in transcode_stream(events, output_format):
+                if event["type"] == "text":
+                    ai_response += event["content"]
+                    # Stream AI response chunks
+                    yield {"type": "ai_response", "content": event["content"]}
+                elif event["type"] == "audio":
+                    if not streaming_audio:
+                        streaming_audio = True
+                        trace.mark("tts_first_chunk")
+                        yield {
+                            "type": "status",
+                            "status": "streaming",
+                            "message": "Streaming audio chunks..."
+                        }
+                    yield event["data"]
+                elif event["type"] == "WordBoundary":
+                    yield {
+                        "type": "word_boundary",
+                        "offset": event.get("offset"),
+                        "duration": event.get("duration"),
+                        "text": event.get("text")
+                    }
+
+            trace.mark("tts_done")
+
+            if self.history is not None:
+                self.history.append((data.get("query"), ai_response))
+                del self.history[:-WS_SESSION_HISTORY_TURNS]
+            self.answered.set_result(ai_response)
+
+            if data.get("timing"):
+                yield {"type": "timing", **trace.timing()}
+
+            # Send completion with metadata
+            yield {
+                "type": "status",
+                "status": "completed",
+                "message": "All processing completed",
+                "query": data.get("query"),
+                "ai_response": ai_response,
+                "document_urls": document_urls,
+                "cached": cached is not None,
+                "trace_id": trace.trace_id
+            }
+            trace.finish()
+        finally:
+            if stages is not None:
+                stages.close()
+            # A failed turn must not hold up the next one
+            if not self.answered.done():
+                self.answered.set_result(None)
+
+async def send_ws_message(websocket: WebSocket, message, protocol: str):
+    """Send a WSRAGTurn message: audio bytes with the negotiated protocol, anything else as JSON"""
+    if isinstance(message, bytes):
+        await send_ws_audio(websocket, message, protocol)
+    else:
+        await websocket.send_json(message)
+
+def ws_turn_error(turn: WSRAGTurn, error: Exception) -> dict:
+    """Error message for a failed session turn; also closes its trace"""
+    if isinstance(error, UpstreamBusy):
+        status, detail = "busy", str(error)
+        message = {"type": "error", "status": "busy", "message": detail, "retry_after": error.retry_after}
+    elif isinstance(error, httpx.HTTPError):
+        status, detail = "error", f"Error calling embedding API: {str(error)}"
+        message = {"type": "error", "message": detail}
+    else:
+        import traceback
+        print(f"ERROR: {str(error)}")
+        print(traceback.format_exc())
+        status, detail = "error", str(error)
+        message = {"type": "error", "message": detail}
+    if turn.trace is not None:
+        turn.trace.finish(status, detail)
+        message["trace_id"] = turn.trace.trace_id
+    return message
+
+async def run_ws_tts_session(websocket: WebSocket, first: dict, protocol: str):
+    """Answer every query sent on the connection, preparing later answers while earlier ones are sent"""
+    defaults = {field: first[field] for field in WS_SESSION_FIELDS if field in first}
+    keys: Dict[str, dict] = {}
+    history: Optional[List[tuple]] = [] if first.get("history") else None
+    previous: Optional[asyncio.Future] = None
+    # (request_id, message queue, producer task) in arrival order
+    turns: asyncio.Queue = asyncio.Queue()
+    pending: Dict[str, asyncio.Task] = {}
+    received = 0
+
+    async def produce(turn: WSRAGTurn, output: asyncio.Queue):
+        try:
+            async for message in turn.messages():
+                output.put_nowait(message)
+        except asyncio.CancelledError:
+            if turn.trace is not None:
+                turn.trace.finish("cancelled")
+            output.put_nowait({"type": "status", "status": "cancelled", "message": "Query cancelled"})
+        except Exception as e:
+            output.put_nowait(ws_turn_error(turn, e))
+        finally:
+            output.put_nowait(None)
+
+    async def emit():
+        while True:
+            item = await turns.get()
+            if item is None:
+                return
+            request_id, output, task = item
+            while True:
+                message = await output.get()
+                if message is None:
+                    break
+                if not isinstance(message, bytes):
+                    message = {**message, "request_id": request_id}
+                await send_ws_message(websocket, message, protocol)
+            if task is not None and pending.get(request_id) is task:
+                del pending[request_id]
+
+    await websocket.send_json({
+        "type": "status",
+        "status": "session_started",
+        "protocol": protocol,
+        "history": history is not None,
+        "max_pending": WS_SESSION_MAX_PENDING
+    })
+    emitter = asyncio.create_task(emit())
+    try:
+        message = first if first.get("query") else None
+        while True:
+            if message is None:
+                receive = asyncio.create_task(websocket.receive_json())
+                # Stop listening if sending fails (e.g. the client went away)
+                await asyncio.wait({receive, emitter}, return_when=asyncio.FIRST_COMPLETED)
+                if not receive.done():
+                    receive.cancel()
+                    await emitter
+                    return
+                message = receive.result()
+            kind = message.get("type", "query")
+            if kind == "end":
+                break
+            if kind == "cancel":
+                task = pending.get(str(message.get("request_id")))
+                if task is not None:
+                    task.cancel()
+                message = None
+                continue
+
+            received += 1
+            request_id = str(message.get("request_id") or received)
+            output: asyncio.Queue = asyncio.Queue()
+            task = None
+            if request_id in pending:
+                output.put_nowait({"type": "error", "message": f"request_id {request_id} is already in use"})
+                output.put_nowait(None)
+            elif len(pending) >= WS_SESSION_MAX_PENDING:
+                output.put_nowait({
+                    "type": "error",
+                    "status": "busy",
+                    "message": f"At most {WS_SESSION_MAX_PENDING} queries can be pending in a session"
                 })
+                output.put_nowait(None)
+            else:
+                turn = WSRAGTurn({**defaults, **message}, protocol, keys, history, previous)
+                if history is not None:
+                    previous = turn.answered
+                task = pending[request_id] = asyncio.create_task(produce(turn, output))
+            turns.put_nowait((request_id, output, task))
+            message = None
 
-        # Filter documents with score > 0.4
-        document_urls = []
-        if "results" in search_data:
-            document_urls = [
-                doc.get("metadata", {}).get("url", "")
-                for doc in search_data["results"]
-                if doc.get("score", 0) > 0.4 and doc.get("metadata", {}).get("url")
-            ]
+        # "end": finish sending what was asked, then close
+        turns.put_nowait(None)
+        await emitter
+        await websocket.send_json({"type": "status", "status": "session_ended"})
+    finally:
+        emitter.cancel()
+        for task in pending.values():
+            task.cancel()
 
-        # Send completion with metadata
-        await websocket.send_json({
-            "type": "status",
-            "status": "completed",
-            "message": "All processing completed",
-            "query": data.get("query"),
-            "ai_response": ai_response,
-            "document_urls": document_urls
-        })
+@app.websocket("/ws/tts")
+async def websocket_tts_with_rag(websocket: WebSocket):
+    """Stream TTS with RAG via WebSocket (one query, or many with "session": true)"""
+    await websocket.accept()
+    turn = None
+
+    try:
+        # Receive the request data
+        data = await websocket.receive_json()
+        protocol = negotiate_ws_protocol(websocket, data)
+        if data.get("session"):
+            await run_ws_tts_session(websocket, data, protocol)
+            return
+
+        turn = WSRAGTurn(data, protocol)
+        async for message in turn.messages():
+            await send_ws_message(websocket, message, protocol)
 
     except WebSocketDisconnect:
         print("WebSocket disconnected")
+        if turn is not None and turn.trace is not None:
+            turn.trace.finish("cancelled")
+    except UpstreamBusy as e:
+        trace = turn.trace if turn is not None else None
+        if trace is not None:
+            trace.finish("busy", str(e))
+        await send_ws_busy(websocket, e, trace.trace_id if trace else None)
     except httpx.HTTPError as e:
+        trace = turn.trace if turn is not None else None
+        if trace is not None:
+            trace.finish("error", f"Error calling embedding API: {str(e)}")
         try:
             await websocket.send_json({
                 "type": "error",
-                "message": f"Error calling embedding API: {str(e)}"
+                "message": f"Error calling embedding API: {str(e)}",
+                "trace_id": trace.trace_id if trace else None
             })
         except:
             pass
@@ -843,13 +4730,21 @@ async def websocket_tts_with_rag(websocket: WebSocket):
         import traceback
         print(f"ERROR: {str(e)}")
         print(traceback.format_exc())
+        trace = turn.trace if turn is not None else None
+        if trace is not None:
+            trace.finish("error", str(e))
         try:
             await websocket.send_json({
                 "type": "error",
-                "message": str(e)
+                "message": str(e),
+                "trace_id": trace.trace_id if trace else None
             })
         except:
             pass
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    if WORKERS > 1:
+        # Workers import the app themselves, so it has to be passed by name
+        uvicorn.run("main:app", host="0.0.0.0", port=8001, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -114,6 +114,12 @@ if ($upload_type === 'text') {
             // Update document with embedding status
             if ($embedding_result['success']) {
                 updateEmbeddingStatus($insert_id, 'success', $embedding_result['chunks'], null);
+
+                // Make cached answers pick up the new document
+                $cache_result = invalidateSearchCache($user_hash, $collection_name);
+                if (!$cache_result['success']) {
+                    error_log("Search cache invalidation failed: " . $cache_result['error']);
+                }
             } else {
                 updateEmbeddingStatus($insert_id, 'failed', null, $embedding_result['error']);
             }
@@ -235,6 +241,12 @@ if ($upload_type === 'text') {
             // Update document with embedding status
             if ($embedding_result['success']) {
                 updateEmbeddingStatus($insert_id, 'success', $embedding_result['chunks'], null);
+
+                // Make cached answers pick up the new document
+                $cache_result = invalidateSearchCache($user_hash, $collection_name);
+                if (!$cache_result['success']) {
+                    error_log("Search cache invalidation failed: " . $cache_result['error']);
+                }
             } else {
                 updateEmbeddingStatus($insert_id, 'failed', null, $embedding_result['error']);
             }
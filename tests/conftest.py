@@ -0,0 +1,61 @@
+"""Shared fixtures: main.py with its upstreams (search, LLM, edge-tts) replaced by fakes"""
+import asyncio
+import os
+
+os.environ.setdefault("ENCRYPTION_SECRET_KEY", "test-secret")
+os.environ.setdefault("EMBEDDING_API_KEY", "test-embedding-key")
+os.environ.setdefault("VOICE_CATALOGUE_REFRESH", "false")
+os.environ.setdefault("EDGE_TTS_HEALTH_INTERVAL", "0")
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+class FakeUpstreams:
+    """Records what the app asked the fake upstreams for"""
+
+    def __init__(self):
+        self.prompts = []
+        self.decrypted = []
+
+    async def search(self, query, user_hash, collection_name, top_k):
+        await asyncio.sleep(0.05)
+        return {"results": [{"score": 0.9, "text": "doc", "metadata": {"url": "https://example.com/doc.pdf"}}]}
+
+    async def llm_stream(self, provider, model, api_key, system_prompt, user_prompt):
+        self.prompts.append(user_prompt)
+        query = user_prompt.split("Query: ", 1)[1].split("\n", 1)[0]
+        for token in [f"Answer to {query} is long enough here. ", "Second sentence here."]:
+            await asyncio.sleep(0.1 if "slow" in query else 0.01)
+            yield token
+
+    async def tts(self, text, voice, rate="+0%", pitch="+0Hz", volume="+0%"):
+        yield {"type": "audio", "data": text.encode()}
+
+    def decrypt(self, auth_key):
+        self.decrypted.append(auth_key)
+        return {"embedding_api_key": "e", "llm_api_key": "l"}
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    fake = FakeUpstreams()
+
+    async def warm_llm_provider(provider, api_key):
+        pass
+
+    async def warm():
+        pass
+
+    monkeypatch.setattr(main, "fetch_search_results", fake.search)
+    monkeypatch.setattr(main, "call_llm_stream", fake.llm_stream)
+    monkeypatch.setattr(main, "tts_stream", fake.tts)
+    monkeypatch.setattr(main, "decrypt_auth_key", fake.decrypt)
+    monkeypatch.setattr(main, "warm_llm_provider", warm_llm_provider)
+    monkeypatch.setattr(main.synthesis_engine, "warm", warm)
+    return fake
+
+@pytest.fixture
+def client(upstreams):
+    with TestClient(main.app) as client:
+        yield client
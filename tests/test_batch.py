@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+import main
+
+@pytest.mark.parametrize("configured,expected_calls", [(0, 1), (-2, 1), (3, 3)])
+def test_busy_is_raised_after_the_last_attempt(monkeypatch, configured, expected_calls):
+    calls = []
+
+    async def synthesize(**kwargs):
+        calls.append(kwargs)
+        raise main.UpstreamBusy("edge-tts", 429, 0)
+
+    monkeypatch.setattr(main, "BATCH_BUSY_ATTEMPTS", configured)
+    monkeypatch.setattr(main.synthesis_cache, "synthesize", synthesize)
+    item = main.TTSRequest(text="Hello there.")
+    with pytest.raises(main.UpstreamBusy):
+        asyncio.run(main.synthesize_batch_item(item))
+    assert len(calls) == expected_calls
+
+def test_batch_audio_outlives_the_audio_ttl(monkeypatch):
+    async def synthesize(**kwargs):
+        return main.SynthesizedAudio(kwargs["text"].encode(), [])
+
+    async def run():
+        return [result async for result, _ in main.run_synthesis_batch([main.TTSRequest(text="Batch item.")])]
+
+    now = main.time.time()
+    monkeypatch.setattr(main.synthesis_cache, "synthesize", synthesize)
+    monkeypatch.setattr(main.audio_store, "ttl", 10)
+    monkeypatch.setattr(main, "BATCH_AUDIO_TTL", 3600)
+    monkeypatch.setattr(main.time, "time", lambda: now)
+    [result] = asyncio.run(run())
+    asyncio.run(main.audio_store.save("single.mp3", b"single"))
+
+    # Past the audio TTL, still well within the job TTL
+    monkeypatch.setattr(main.time, "time", lambda: now + 600)
+    main.audio_store.purge_expired()
+    assert asyncio.run(main.audio_store.exists(result["filename"]))
+    assert not asyncio.run(main.audio_store.exists("single.mp3"))
+
+    monkeypatch.setattr(main.time, "time", lambda: now + 3601)
+    main.audio_store.purge_expired()
+    assert not asyncio.run(main.audio_store.exists(result["filename"]))
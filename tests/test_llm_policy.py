@@ -0,0 +1,81 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+class Calls(list):
+    """Every (provider, model) the policy called; the first calls raise the queued errors"""
+
+    def __init__(self):
+        super().__init__()
+        self.errors = []
+
+@pytest.fixture
+def calls(monkeypatch):
+    made = Calls()
+
+    async def call_llm_stream(provider, model, api_key, system_prompt, user_prompt):
+        made.append((provider, model))
+        if made.errors:
+            raise made.errors.pop(0)
+        yield "answer"
+
+    monkeypatch.setattr(main, "call_llm_stream", call_llm_stream)
+    monkeypatch.setattr(main, "provider_models", lambda provider: None)
+    monkeypatch.setattr(main, "LLM_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(main, "LLM_RETRY_BASE_DELAY", 0.0)
+    monkeypatch.setattr(main, "LLM_HEDGE_ENABLED", False)
+    monkeypatch.setattr(main, "LLM_FALLBACK_MODELS", [("mistral", "fallback-model")])
+    return made
+
+def answer(provider="mistral", model="primary-model"):
+    async def collect():
+        policy = main.LLMPolicy()
+        return [token async for token in policy.stream(provider, model, "key", "system", "user")]
+    return asyncio.run(collect())
+
+@pytest.mark.parametrize("error", [KeyError("choices"), TypeError("bad chunk"), AttributeError("delta")])
+def test_programming_errors_are_raised_on_first_attempt(calls, error):
+    calls.errors.append(error)
+    with pytest.raises(type(error)):
+        answer()
+    assert calls == [("mistral", "primary-model")]
+
+def test_transport_errors_are_retried(calls):
+    calls.errors.append(httpx.ConnectError("refused"))
+    assert answer() == ["answer"]
+    assert calls == [("mistral", "primary-model"), ("mistral", "primary-model")]
+
+def test_non_retryable_status_moves_to_fallback(calls):
+    request = httpx.Request("POST", "https://api.mistral.ai/v1/chat/completions")
+    response = httpx.Response(404, request=request)
+    calls.errors.append(httpx.HTTPStatusError("not found", request=request, response=response))
+    assert answer() == ["answer"]
+    assert calls == [("mistral", "primary-model"), ("mistral", "fallback-model")]
+
+@pytest.mark.parametrize("status,retryable", [(429, True), (503, True), (400, False), (401, False)])
+def test_is_retryable_statuses(status, retryable):
+    request = httpx.Request("POST", "https://example.com")
+    error = httpx.HTTPStatusError("status", request=request, response=httpx.Response(status, request=request))
+    assert main.is_retryable(error) is retryable
+
+def test_unknown_errors_are_not_retryable():
+    assert main.is_retryable(RuntimeError("bug")) is False
+
+def test_metric_labels_collapse_unknown_names(monkeypatch):
+    monkeypatch.setattr(main, "provider_models", lambda provider: {"mistral-large-latest": {"mistral-large"}})
+    assert main.llm_metric_labels("Mistral", "mistral-large-latest") == {"provider": "mistral", "model": "mistral-large-latest"}
+    assert main.llm_metric_labels("mistral", "mistral-large") == {"provider": "mistral", "model": "mistral-large"}
+    assert main.llm_metric_labels("mistral", "made-up-model") == {"provider": "mistral", "model": "other"}
+    assert main.llm_metric_labels("made-up-provider", "x") == {"provider": "other", "model": "other"}
+
+def test_llm_histograms_do_not_grow_with_client_supplied_names(calls):
+    async def collect():
+        return [token async for token in main.call_llm_stream_with_fallback("mistral", "junk-model-123", "key", "s", "u")]
+
+    assert asyncio.run(collect()) == ["answer"]
+    exposition = main.render_metrics(main.metrics.collect())
+    assert 'model="other"' in exposition
+    assert "junk-model-123" not in exposition
@@ -0,0 +1,70 @@
+import base64
+import json
+import subprocess
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(not main.FFMPEG_AVAILABLE, reason="ffmpeg is not installed")
+
+BODY = {
+    "query": "What is stored?",
+    "auth_key": "a",
+    "user_hash": "u",
+    "collection_name": "col",
+    "top_k": 3,
+    "instruct": "i",
+    "provider": "mistral",
+    "model": "m",
+    "use_cache": False
+}
+
+@pytest.fixture
+def mp3_tts(monkeypatch, upstreams):
+    """edge-tts stand-in returning a short real MP3 for every sentence"""
+    mp3 = subprocess.run(
+        [main.FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "sine=frequency=440:duration=0.5",
+         "-ac", "1", "-ar", "24000", "-c:a", "libmp3lame", "-b:a", "48k", "-f", "mp3", "pipe:1"],
+        check=True, capture_output=True
+    ).stdout
+
+    async def tts(text, voice, rate="+0%", pitch="+0Hz", volume="+0%"):
+        for start in range(0, len(mp3), 4096):
+            yield {"type": "audio", "data": mp3[start:start + 4096]}
+
+    monkeypatch.setattr(main, "tts_stream", tts)
+
+@pytest.fixture
+def ffmpeg_runs(monkeypatch):
+    runs = []
+    start_ffmpeg = main._start_ffmpeg
+
+    async def counted(output_format):
+        runs.append(output_format.name)
+        return await start_ffmpeg(output_format)
+
+    monkeypatch.setattr(main, "_start_ffmpeg", counted)
+    return runs
+
+def sse_events(text):
+    for block in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        yield lines.get("event"), json.loads(lines["data"])
+
+def test_tts_stream_transcodes_once_to_one_ogg_stream(client, mp3_tts, ffmpeg_runs):
+    response = client.post("/tts/stream", json={**BODY, "output_format": "ogg"})
+    events = list(sse_events(response.text))
+
+    segments = [data for event, data in events if event == "audio"]
+    assert len(segments) >= 2
+    audio = b"".join(base64.b64decode(segment["data"]) for segment in segments)
+    # One Ogg/Opus stream: a single header the client can join segments under
+    assert audio.startswith(b"OggS")
+    assert audio.count(b"OpusHead") == 1
+    assert ffmpeg_runs == ["ogg-24khz-16bit-mono-opus"]
+
+    completed = [data for event, data in events if event == "complete"][0]
+    assert completed["audio_url"].endswith(".ogg")
+    # The stored file is the streamed audio, not a second transcode
+    assert client.get(completed["audio_url"]).content == audio
@@ -0,0 +1,37 @@
+import asyncio
+
+import main
+
+class FakeClient:
+    def __init__(self):
+        self.aio = self
+        self.closed = False
+
+    async def aclose(self):
+        self.closed = True
+
+def test_evicted_client_is_closed_after_its_last_lease():
+    async def scenario():
+        cache = main.ProviderClientCache(max_size=1)
+        first = cache.get("google", "key-1", FakeClient)
+        with cache.lease(first):
+            # A second key evicts the client while a request still streams on it
+            cache.get("google", "key-2", FakeClient)
+            await asyncio.sleep(0)
+            assert not first.closed
+            assert cache.stats()["retired"] == 1
+        await asyncio.sleep(0)
+        assert first.closed
+        assert cache.stats()["retired"] == 0
+
+    asyncio.run(scenario())
+
+def test_unused_evicted_client_is_closed_right_away():
+    async def scenario():
+        cache = main.ProviderClientCache(max_size=1)
+        first = cache.get("google", "key-1", FakeClient)
+        cache.get("google", "key-2", FakeClient)
+        await asyncio.sleep(0)
+        assert first.closed
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+import asyncio
+import sqlite3
+import threading
+
+import main
+
+def test_audio_reads_do_not_block_the_loop_on_a_locked_database(tmp_path):
+    state = main.SharedState(str(tmp_path / "state.db"))
+    store = main.SharedAudioStore(main.DiskAudioBackend(str(tmp_path)), ttl=60, max_bytes=1 << 20, state=state)
+
+    async def scenario():
+        await store.save("a.mp3", b"audio")
+        # Another worker holds the write lock for a while
+        locked = threading.Event()
+        unlock = threading.Event()
+
+        def hold_lock():
+            other = sqlite3.connect(state.path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            locked.set()
+            unlock.wait()
+            other.execute("COMMIT")
+            other.close()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+        read = asyncio.create_task(store.read("a.mp3"))
+        # The loop keeps running while the read waits for the lock
+        await asyncio.sleep(0.2)
+        assert not read.done()
+        unlock.set()
+        assert await read == b"audio"
+        holder.join()
+
+    asyncio.run(scenario())
+    assert asyncio.run(store.exists("a.mp3"))
+    assert not store.readers
+    assert state.db.execute("SELECT COUNT(*) FROM audio_readers").fetchone()[0] == 0
@@ -0,0 +1,15 @@
+import main
+
+def test_long_and_short_texts_are_both_downloads(client, monkeypatch):
+    monkeypatch.setattr(main, "LONG_TEXT_MIN_CHARS", 200)
+    monkeypatch.setattr(main, "LONG_TEXT_SEGMENT_CHARS", 100)
+    short = client.post("/synthesize", json={"text": "A short sentence."})
+    long = client.post("/synthesize", json={"text": "This sentence is part of a long text. " * 20})
+    assert short.status_code == long.status_code == 200
+    assert short.headers["content-disposition"].startswith("attachment;")
+    assert long.headers["content-disposition"].startswith("attachment;")
+    assert "x-audio-url" in long.headers
+
+def test_chunked_endpoint_stays_inline(client):
+    response = client.post("/synthesize/chunked", json={"text": "Play this right away."})
+    assert response.headers["content-disposition"].startswith("inline;")
@@ -0,0 +1,23 @@
+import pytest
+
+import main
+
+def test_unknown_upstreams_get_no_limiter():
+    with pytest.raises(ValueError):
+        main.upstream_limits.get("no-such-provider")
+    assert "no-such-provider" not in main.upstream_limits.limiters
+
+def test_tts_stream_rejects_unknown_provider_before_limiting(client):
+    response = client.post("/tts/stream", json={
+        "query": "What?",
+        "auth_key": "a",
+        "user_hash": "u",
+        "collection_name": "col",
+        "top_k": 3,
+        "instruct": "i",
+        "provider": "junk-provider",
+        "model": "m"
+    })
+    assert response.status_code == 400
+    assert "junk-provider" not in main.upstream_limits.limiters
+    assert "junk-provider" not in client.get("/metrics").text
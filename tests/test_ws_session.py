@@ -0,0 +1,63 @@
+import json
+
+BODY = {
+    "auth_key": "a",
+    "user_hash": "u",
+    "collection_name": "col",
+    "top_k": 3,
+    "instruct": "i",
+    "provider": "mistral",
+    "model": "m",
+    "use_cache": False
+}
+
+def receive(websocket):
+    message = websocket.receive()
+    if message.get("text") is not None:
+        return json.loads(message["text"])
+    return message.get("bytes")
+
+def receive_until(websocket, status):
+    messages = []
+    while True:
+        message = receive(websocket)
+        messages.append(message)
+        if isinstance(message, dict) and (message.get("status") == status or message.get("type") == "error"):
+            return messages
+
+def test_single_query_status_messages_are_typed(client):
+    with client.websocket_connect("/ws/tts") as websocket:
+        websocket.send_json({**BODY, "query": "single"})
+        messages = receive_until(websocket, "completed")
+
+    statuses = [m for m in messages if isinstance(m, dict) and "status" in m]
+    assert [m["status"] for m in statuses][:3] == ["searching", "search_complete", "generating"]
+    assert all(m["type"] == "status" for m in statuses)
+    assert statuses[-1]["status"] == "completed"
+
+def test_session_pipelines_queries_in_order(client, upstreams):
+    with client.websocket_connect("/ws/tts") as websocket:
+        websocket.send_json({**BODY, "session": True, "history": True})
+        assert receive(websocket)["status"] == "session_started"
+        websocket.send_json({"query": "slow one", "request_id": "r1"})
+        websocket.send_json({"query": "two"})
+        websocket.send_json({"query": "three", "request_id": "r3"})
+        websocket.send_json({"type": "cancel", "request_id": "r3"})
+        websocket.send_json({"type": "end"})
+        messages = receive_until(websocket, "session_ended")
+
+    statuses = [
+        (m.get("request_id"), m["status"])
+        for m in messages
+        if isinstance(m, dict) and "status" in m
+    ]
+    assert all(m["type"] == "status" for m in messages if isinstance(m, dict) and "status" in m)
+    assert statuses[:10] == [
+        ("r1", "searching"), ("r1", "search_complete"), ("r1", "generating"), ("r1", "streaming"), ("r1", "completed"),
+        ("2", "searching"), ("2", "search_complete"), ("2", "generating"), ("2", "streaming"), ("2", "completed")
+    ]
+    assert statuses[-2:] == [("r3", "cancelled"), (None, "session_ended")]
+    # The auth_key is decrypted once per session
+    assert upstreams.decrypted == ["a"]
+    # The second query sees the first answer
+    assert "User: slow one\nAssistant: Answer to slow one" in upstreams.prompts[1]
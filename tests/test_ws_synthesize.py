@@ -0,0 +1,34 @@
+import uuid
+
+import main
+from fastapi.testclient import TestClient
+
+class FakeCommunicate:
+    """edge_tts.Communicate stand-in that only reports words when asked for them"""
+
+    def __init__(self, text, voice, *, boundary="SentenceBoundary", **kwargs):
+        self.text = text
+        self.boundary = boundary
+
+    async def stream(self):
+        offset = 0
+        for word in self.text.split():
+            yield {"type": "audio", "data": word.encode()}
+            if self.boundary == "WordBoundary":
+                yield {"type": "WordBoundary", "offset": offset, "duration": 1000, "text": word}
+            offset += 1000
+        yield {"type": "SentenceBoundary", "offset": 0, "duration": offset, "text": self.text}
+
+def test_word_boundaries_reach_the_client(monkeypatch):
+    monkeypatch.setattr(main.edge_tts, "Communicate", FakeCommunicate)
+    text = f"Hello there {uuid.uuid4().hex}"
+    with TestClient(main.app) as client, client.websocket_connect("/ws/synthesize") as websocket:
+        websocket.send_json({"text": text, "voice": "en-US-AriaNeural"})
+        words = []
+        while True:
+            message = websocket.receive_json()
+            if message["type"] == "word_boundary":
+                words.append(message["text"])
+            elif message.get("status") == "completed" or message["type"] == "error":
+                break
+    assert words == text.split()
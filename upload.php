@@ -62,6 +62,12 @@ if (isset($_GET['delete'])) {
                     error_log("Qdrant deletion attempt for doc_id=$id, user_hash=$target_user_hash, collection=$collection_name");
                     if ($delete_result['success']) {
                         error_log("Qdrant deletion successful");
+
+                        // Make cached answers forget the deleted document
+                        $cache_result = invalidateSearchCache($target_user_hash, $collection_name);
+                        if (!$cache_result['success']) {
+                            error_log("Search cache invalidation failed: " . $cache_result['error']);
+                        }
                     } else {
                         error_log("Qdrant deletion failed: " . ($delete_result['error'] ?? 'Unknown error'));
                     }